@@ -44,6 +44,23 @@ class Configuration(BaseModel):
         metadata={"description": "The maximum search results to retrieve."},
     )
 
+    rerank_model: Optional[str] = Field(
+        default=None,
+        metadata={
+            "description": "The cross-encoder model of the services' /rerank, which keeps only the most relevant search results in the reflection and answer prompts (all of them are kept when unset)."
+        },
+    )
+
+    max_prompt_results: int = Field(
+        default=8,
+        metadata={"description": "The maximum search results in the reflection and answer prompts, when reranking."},
+    )
+
+    services_url: str = Field(
+        default="http://localhost:80",
+        metadata={"description": "The base url of the services, which serve /rerank."},
+    )
+
 
     @classmethod
     def from_runnable_config(
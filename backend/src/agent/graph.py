@@ -24,7 +24,7 @@ from agent.prompts import (
     reflection_instructions,
     answer_instructions,
 )
-from agent.openai_compatible_models import get_chat, remove_thinking
+from agent.openai_compatible_models import get_chat, remove_thinking, rerank
 from agent.web_search import simple_search, identify_region
 from agent.memory_recollection import MemoryManager, WebSearchMemory
 from agent.utils import get_research_topic
@@ -39,6 +39,26 @@ logger = logging.getLogger(__name__)
 
 memory_manager = MemoryManager()
 
+def select_results(research_topic:str, web_research_results, configurable:Configuration) -> list[str]:
+    """Keep the search results most relevant to the research topic, so that the reasoning model doesn't prefill all of them.
+
+    All the results are kept when no rerank model is configured, when they fit in the prompt, or when the rerank fails.
+    """
+    results = sorted(web_research_results)
+    if not configurable.rerank_model or len(results) <= configurable.max_prompt_results:
+        return results
+    try:
+        indexes = rerank(
+            configurable.services_url,
+            configurable.rerank_model,
+            research_topic,
+            results,
+            top_n=configurable.max_prompt_results)
+    except Exception as ex:
+        logger.warning("Failed to rerank %d search results, keeping all of them: %s", len(results), ex)
+        return results
+    return [results[i] for i in indexes]
+
 # Nodes
 def generate_query(state: InitialState, config: RunnableConfig) -> IntermediateState:
     configurable = Configuration.from_runnable_config(config)
@@ -184,10 +204,11 @@ def reflection(state: IntermediateState, config: RunnableConfig) -> Intermediate
 
     # Format the prompt
     current_date = get_current_date()
+    research_topic = state["research_query"] or get_research_topic(state["messages"])
     formatted_prompt = reflection_instructions.format(
         current_date=current_date,
-        research_topic=state["research_query"] or get_research_topic(state["messages"]),
-        summaries="\n\n---\n\n".join(state["web_research_result"]),
+        research_topic=research_topic,
+        summaries="\n\n---\n\n".join(select_results(research_topic, state["web_research_result"], configurable)),
     )
     # init Reasoning Model
     llm = get_chat(
@@ -221,6 +242,8 @@ def evaluate_research(
     return return_state
 
 def finalize_answer(state: IntermediateState, config: RunnableConfig) -> FinalState:
+    configurable = Configuration.from_runnable_config(config)
+
     reasoning_model = state.get("reasoning_model")
 
     # Format the prompt
@@ -228,7 +251,7 @@ def finalize_answer(state: IntermediateState, config: RunnableConfig) -> FinalSt
     formatted_prompt = answer_instructions.format(
         current_date=current_date,
         research_topic=state["research_query"],
-        summaries="\n---\n\n".join(state["web_research_result"]),
+        summaries="\n---\n\n".join(select_results(state["research_query"], state["web_research_result"], configurable)),
         sources="\n---\n\n".join(state["sources_gathered"]),
     )
 
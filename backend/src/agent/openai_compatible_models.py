@@ -63,6 +63,16 @@ def get_chat(**kwargs):
         **merged_kwargs
     )
 
+def rerank(base_url:str, model:str, query:str, documents:list[str], top_n:int = None, timeout:float = 30) -> list[int]:
+    """Returns the indexes of the documents most relevant to the query first, as scored by the services' cross-encoder /rerank."""
+    import requests
+    response = requests.post(
+        f"{base_url.rstrip('/')}/rerank/",
+        json={"model": model, "query": query, "documents": documents, "top_n": top_n, "return_documents": False},
+        timeout=timeout)
+    response.raise_for_status()
+    return [result["index"] for result in response.json()["results"]]
+
 def get_text_embedding(model:str = None, **kwargs):
     """Returns langchain OpenAI embeddings compatible client for general text embeddings."""
     default_model = model or "ibm-granite/granite-embedding-278m-multilingual"
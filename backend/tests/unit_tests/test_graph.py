@@ -5,7 +5,7 @@ from langchain_core.messages import BaseMessage, AIMessage
 from agent.configuration import Configuration
 from agent.state import SearchTaskInput, RecollTaskInput, InitialState, IntermediateState, FinalState
 from agent.tools_and_schemas import AggregatedSearchResults, WebSearchMemory
-from agent.graph import generate_query, reconcile_research, recollection, web_research, reflection, evaluate_research, finalize_answer, continue_to_parallel_recollection, continue_to_parallel_web_research, graph
+from agent.graph import select_results, generate_query, reconcile_research, recollection, web_research, reflection, evaluate_research, finalize_answer, continue_to_parallel_recollection, continue_to_parallel_web_research, graph
 
 
 # Fixtures for mocking dependencies
@@ -330,6 +330,24 @@ def test_finalize_answer(configuration, mock_from_runnable_config, mock_get_chat
     )
     mock_get_chat.assert_called_once_with(model=configuration.small_model, temperature=0, max_retries=2)
 
+def test_select_results(configuration):
+    """Test the rerank of the search results in the prompts"""
+    results = frozenset(["result1", "result2", "result3"])
+
+    # No rerank model, all the results are kept
+    assert select_results("topic", results, configuration) == ["result1", "result2", "result3"]
+
+    configuration.rerank_model = "mock-reranker"
+    configuration.max_prompt_results = 2
+    with patch("agent.graph.rerank") as mock_rerank:
+        mock_rerank.return_value = [2, 0]
+        assert select_results("topic", results, configuration) == ["result3", "result1"]
+        mock_rerank.assert_called_once_with(configuration.services_url, "mock-reranker", "topic", ["result1", "result2", "result3"], top_n=2)
+
+        # The prompts aren't trimmed when the services are unavailable
+        mock_rerank.side_effect = ConnectionError("unavailable")
+        assert select_results("topic", results, configuration) == ["result1", "result2", "result3"]
+
 # Test transitions
 @pytest.mark.parametrize("max_research_loops", (1, 2, 3, 4))
 def test_end_to_end(configuration, 
@@ -0,0 +1,39 @@
+"""Compare a cold load (from the model files, writing the artifact) with a warm load (from the artifact) of a model.
+
+Usage:
+    python benchmarks/benchmark_artifact_cache.py --model meta-llama/Llama-3.2-1B-Instruct --profile cpu
+"""
+import argparse
+import os
+import shutil
+import time
+from services.internal.registry import Models
+from services.internal.loader import SUPPORTED, EXECUTION_PROFILES, MODEL_EXECUTION_PROFILES
+from services.internal import artifacts
+
+def load(registry:Models, model_id:str) -> dict:
+    loader = SUPPORTED[model_id](registry)
+    start = time.perf_counter()
+    loaded = loader.load(registry.models[model_id])
+    seconds = time.perf_counter() - start
+    timings = {phase: round(elapsed, 2) for phase, elapsed in loader.load_timings.items()}
+    loader.unload(loaded)
+    return {"seconds": round(seconds, 2), "phases": timings}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default="meta-llama/Llama-3.2-1B-Instruct")
+    parser.add_argument("--profile", default="default", choices=list(EXECUTION_PROFILES.keys()))
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    registry = Models(os.getenv("HF_HOME"))
+    MODEL_EXECUTION_PROFILES[args.model] = args.profile
+    # Cold, without any artifact of the model
+    shutil.rmtree(registry.models[args.model].location / artifacts.ARTIFACTS_DIR, ignore_errors=True)
+    print({"load": "cold", **load(registry, args.model)})  # noqa: T201
+    for _ in range(args.repeats):
+        print({"load": "warm", **load(registry, args.model)})  # noqa: T201
+
+if __name__ == "__main__":
+    main()
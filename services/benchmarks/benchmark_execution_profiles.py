@@ -0,0 +1,59 @@
+"""Compare the generation throughput of a model under each execution profile.
+
+Usage:
+    python benchmarks/benchmark_execution_profiles.py --model meta-llama/Llama-3.2-1B-Instruct --profiles default cpu
+"""
+import argparse
+import os
+import time
+from services.internal.registry import Models
+from services.internal.loader import EXECUTION_PROFILES, MODEL_EXECUTION_PROFILES
+from services.internal.inference import TransformerInference, Dialog, Message
+
+PROMPT = "Write a short story about a lighthouse keeper."
+
+def run(registry:Models, model_id:str, profile:str, max_new_tokens:int, repeats:int) -> dict:
+    MODEL_EXECUTION_PROFILES[model_id] = profile
+    inference = TransformerInference(registry)
+    try:
+        start = time.perf_counter()
+        inference.serve(model_id)
+        load_seconds = time.perf_counter() - start
+
+        # Warm up, so that one-off initialization (e.g. oneDNN primitives) isn't measured
+        inference.generate_response(Dialog(user_input=Message(role="user", content=PROMPT)), max_new_tokens=8)
+
+        generated_tokens = 0
+        start = time.perf_counter()
+        for _ in range(repeats):
+            dialog = inference.generate_response(
+                Dialog(user_input=Message(role="user", content=PROMPT)),
+                max_new_tokens=max_new_tokens,
+                do_sample=False)
+            generated_tokens += len(inference.loaded.pre_processor_model(dialog.content)["input_ids"])
+        generation_seconds = time.perf_counter() - start
+
+        return {
+            "profile": profile,
+            "load_seconds": round(load_seconds, 2),
+            "generation_seconds": round(generation_seconds, 2),
+            "tokens_per_second": round(generated_tokens / generation_seconds, 2),
+        }
+    finally:
+        inference.reset()
+        MODEL_EXECUTION_PROFILES.pop(model_id, None)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default="meta-llama/Llama-3.2-1B-Instruct")
+    parser.add_argument("--profiles", nargs="+", default=list(EXECUTION_PROFILES.keys()), choices=list(EXECUTION_PROFILES.keys()))
+    parser.add_argument("--max-new-tokens", type=int, default=128)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    registry = Models(os.getenv("HF_HOME"))
+    for profile in args.profiles:
+        print(run(registry, args.model, profile, args.max_new_tokens, args.repeats))  # noqa: T201
+
+if __name__ == "__main__":
+    main()
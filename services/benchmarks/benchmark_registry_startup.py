@@ -0,0 +1,48 @@
+"""Compare the registry startup time with and without its index, over a synthetic cache of many models.
+
+Usage:
+    python benchmarks/benchmark_registry_startup.py --providers 20 --models 25
+"""
+import argparse
+import json
+import tempfile
+import time
+from pathlib import Path
+from services.internal.registry import Models
+
+def populate(root:Path, providers:int, models:int):
+    for p in range(providers):
+        for m in range(models):
+            model_dir = root / "hub" / f"provider-{p}" / f"model-{m}"
+            (model_dir / ".cache" / "huggingface" / "download").mkdir(parents=True)
+            (model_dir / "config.json").write_text(json.dumps({"num_hidden_layers": 2}))
+            (model_dir / "tokenizer.json").write_text("{}")
+            (model_dir / "model.safetensors").write_bytes(b"\0" * 1024)
+            (model_dir / ".cache" / "huggingface" / "download" / "config.json.metadata").write_text(f"{p:04x}{m:04x}\netag\n0\n")
+
+def timed(**kwargs) -> tuple[float, Models]:
+    start = time.perf_counter()
+    registry = Models(**kwargs)
+    return time.perf_counter() - start, registry
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--providers", type=int, default=20)
+    parser.add_argument("--models", type=int, default=25)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        populate(Path(root), args.providers, args.models)
+        for _ in range(args.repeats):
+            seconds, registry = timed(cache_location=root, use_index=False)
+            print({"startup": "full scan", "models": len(registry.models), "seconds": round(seconds, 3)})  # noqa: T201
+        Path(root, "services", "registry_index.json").unlink(missing_ok=True)
+        seconds, registry = timed(cache_location=root)
+        print({"startup": "indexing", "models": len(registry.models), "inspected": registry.inspected, "seconds": round(seconds, 3)})  # noqa: T201
+        for _ in range(args.repeats):
+            seconds, registry = timed(cache_location=root)
+            print({"startup": "indexed", "models": len(registry.models), "inspected": registry.inspected, "seconds": round(seconds, 3)})  # noqa: T201
+
+if __name__ == "__main__":
+    main()
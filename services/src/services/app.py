@@ -1,3 +1,4 @@
+import asyncio
 import os
 import tempfile
 from typing import AsyncIterator
@@ -9,12 +10,19 @@ from fastapi.responses import JSONResponse
 from starlette.middleware.sessions import SessionMiddleware
 from services.registry import registry_router
 from services.healthcheck import healthcheck_router
-from services.chat import chat_router
-from services.embeddings import embeddings_router
+from services.chat import chat_router, PREFETCHER
+from services.embeddings import embeddings_router, JOBS as EMBEDDING_JOBS
+from services.vectors import vectors_router
+from services.rerank import rerank_router
 from services.models import models_router
 from services.lm_studio_load_balancer import lm_studio_lb_router
 from services.mcp_tools.mcp_server import MCPProjectServer
 from services.lifespan import ManagedLifespan, State
+from services.internal.pool import preload
+from services.internal import metrics
+from services.internal.watcher import RegistryWatcher, REGISTRY_WATCH_ENABLED
+from services.internal.blobs import BLOB_STORE_ENABLED
+from services.registry import REGISTRY, IMPORTS, BLOBS
 
 lifespan = ManagedLifespan()
 
@@ -31,6 +39,14 @@ origins = [
 mcp_transport = os.getenv("MCP_TRANSPORT", "streamable-http")
 mcp_debug = bool(os.getenv("MCP_DEBUG", "True"))
 
+# Comma separated model ids, that are loaded in the background at startup
+preload_models = [model_id.strip() for model_id in os.getenv("SERVICES_PRELOAD_MODELS", "").split(",") if model_id.strip()]
+# When true, the startup completes (and requests are accepted) only after the preloads finished
+preload_hold_readiness = os.getenv("SERVICES_PRELOAD_HOLD_READINESS", "False").lower() == "true"
+# Whether this process watches the cache, deduplicates the model files, resumes the interrupted jobs and saves the
+# prefetch transitions, with several workers only the first one does (see services.serve)
+primary_worker = True
+
 mcp_server = MCPProjectServer(
     root=os.getenv("MCP_ROOT", tempfile.gettempdir()),
     enable_fs=True,
@@ -45,6 +61,66 @@ async def setup_mcp(app: FastAPI) -> AsyncIterator[State]:
     except get_cancelled_exc_class():
         raise
 
+@lifespan.add
+async def preload_pools(app: FastAPI) -> AsyncIterator[State]:
+    preloading = asyncio.create_task(asyncio.to_thread(preload, preload_models), name="preload")
+    if preload_hold_readiness:
+        await preloading
+    yield {"preloading": preloading}
+
+@lifespan.add
+async def watch_registry(app: FastAPI) -> AsyncIterator[State]:
+    if not REGISTRY_WATCH_ENABLED:
+        yield None
+        return
+    watcher = RegistryWatcher(REGISTRY, follow=not primary_worker)
+    watcher.start()
+    yield {"registry_watcher": watcher}
+    await asyncio.to_thread(watcher.stop)
+
+@lifespan.add
+async def import_jobs(app: FastAPI) -> AsyncIterator[State]:
+    resumed = IMPORTS.resume_interrupted() if primary_worker else []
+    if resumed:
+        logger.info("Resumed %d interrupted imports", len(resumed))
+    yield {"imports": IMPORTS}
+    await asyncio.to_thread(IMPORTS.stop)
+
+def deduplicate_models():
+    model_dirs = [REGISTRY.cache_root / model_id for model_id in list(REGISTRY.models.keys())]
+    report = BLOBS.scan(model_dirs)
+    logger.info("The models take %d bytes, %d of which are identical copies", report.total_bytes, report.reclaimable_bytes)
+    if BLOB_STORE_ENABLED:
+        if report.reclaimable_bytes:
+            BLOBS.dedupe(report)
+        BLOBS.collect_garbage()
+    BLOBS.save()
+
+@lifespan.add
+async def deduplicate_model_files(app: FastAPI) -> AsyncIterator[State]:
+    if not primary_worker:
+        yield None
+        return
+    # In the background, hashing the candidate copies of a large cache takes a while the first time
+    deduplicating = asyncio.create_task(asyncio.to_thread(deduplicate_models), name="deduplicate")
+    yield {"deduplicating": deduplicating}
+
+@lifespan.add
+async def embedding_jobs(app: FastAPI) -> AsyncIterator[State]:
+    resumed = EMBEDDING_JOBS.resume_interrupted() if primary_worker else []
+    if resumed:
+        logger.info("Resumed %d interrupted embedding jobs", len(resumed))
+    yield {"embedding_jobs": EMBEDDING_JOBS}
+    await asyncio.to_thread(EMBEDDING_JOBS.stop)
+
+@lifespan.add
+async def save_prefetch_transitions(app: FastAPI) -> AsyncIterator[State]:
+    if not primary_worker:
+        # Kept in memory, instead of overwriting the transitions that the primary worker saves
+        PREFETCHER.path = None
+    yield {"prefetcher": PREFETCHER}
+    PREFETCHER.save()
+
 app = FastAPI(lifespan=lifespan)
 
 # TODO: is not really production quaility, this needs to be pulled from some secret vault instead.
@@ -58,6 +134,16 @@ async def reuse_session(request: Request, call_next):
         response.set_cookie(key="session", value=request.cookies.get("session"), httponly=True)
     return response
 
+@app.middleware("http")
+async def count_requests(request: Request, call_next):
+    # Looked up on every request, since the multi-worker server replaces the counters before forking
+    counters = metrics.REQUEST_COUNTERS
+    counters.started()
+    try:
+        return await call_next(request)
+    finally:
+        counters.finished()
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
@@ -70,6 +156,8 @@ app.mount("/mcp", mcp_server.create_app(transport=mcp_transport), "MCP Server")
 app.include_router(router=healthcheck_router, prefix='/health', tags=["Health Check"])
 app.include_router(router=chat_router, prefix='/chat', tags=["OpenAI API compatible"])
 app.include_router(router=embeddings_router, prefix='/embeddings', tags=["OpenAI API compatible"])
+app.include_router(router=vectors_router, prefix='/vectors', tags=["Vector Collections"])
+app.include_router(router=rerank_router, prefix='/rerank', tags=["Rerank"])
 app.include_router(router=registry_router, prefix='/registry', tags=["Model Registry"])
 app.include_router(router=models_router, prefix='/models', tags=["OpenAI API compatible"])
 app.include_router(router=lm_studio_lb_router, prefix='/lm_studio_lb', tags=["LM Studio LB Proxy"])
@@ -1,17 +1,23 @@
 import asyncio
 import json
+import os
 import time
 from typing import Optional, List, Union, AsyncIterator, Literal
 from fastapi import APIRouter, HTTPException
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
+from starlette.background import BackgroundTask
 
 from services.internal.inference import Message, Dialog, TransformerInference
+from services.internal.pool import InferencePool
+from services.internal.prefetch import Prefetcher
+from services.internal.metrics import METRICS
 from services.registry import REGISTRY
 
 chat_router = APIRouter()
 
-INFERENCE = TransformerInference(REGISTRY)
+POOL = InferencePool(REGISTRY, TransformerInference, capacity=int(os.getenv("SERVICES_CHAT_POOL_SIZE", "1")))
+PREFETCHER = Prefetcher(os.getenv("SERVICES_PREFETCH_TABLE", str(REGISTRY.cache_root.parent / "services" / "prefetch.json")))
 
 class ChatCompletionRequest(BaseModel):
     model: str
@@ -23,6 +29,9 @@ class ChatCompletionRequest(BaseModel):
     top_p: Optional[float] = 1.0
     top_k: Optional[int] = 50
     stream: Optional[bool] = False
+    timeout: Optional[float] = None # seconds since the request was received, after which a partial response is returned
+    deadline: Optional[float] = None # Unix timestamp (in seconds), same as timeout but absolute
+    user: Optional[str] = None # The end user (e.g. an agent's session), whose sequence of requested models is learned for prefetching
 
 
 
@@ -233,7 +242,7 @@ class ChoiceLogprobs(BaseModel):
 
 
 class Choice(BaseModel):
-    finish_reason: Literal["stop", "length", "tool_calls", "content_filter", "function_call"]
+    finish_reason: Literal["stop", "length", "tool_calls", "content_filter", "function_call", "repetition"]
     """The reason the model stopped generating tokens.
 
     This will be `stop` if the model hit a natural stop point or a provided stop
@@ -241,6 +250,7 @@ class Choice(BaseModel):
     reached, `content_filter` if content was omitted due to a flag from our content
     filters, `tool_calls` if the model called a tool, or `function_call`
     (deprecated) if the model called a function.
+    This will be `repetition` if the generation was aborted for looping on the same tokens.
     """
 
     index: int
@@ -253,6 +263,17 @@ class Choice(BaseModel):
     """A chat completion message generated by the model."""
 
 
+class CompletionTimings(BaseModel):
+    queued: float
+    """Seconds from receiving the request until the generation started (including loading the model)."""
+
+    generation: float
+    """Seconds spent generating the completion."""
+
+    deadline_exceeded: bool
+    """Whether the generation was stopped by the request's deadline, in which case the completion is partial."""
+
+
 class ChatCompletionResponse(BaseModel):
     id: str
     """A unique identifier for the chat completion."""
@@ -303,20 +324,53 @@ class ChatCompletionResponse(BaseModel):
     usage: Optional[CompletionUsage] = None
     """Usage statistics for the completion request."""
 
+    timings: Optional[CompletionTimings] = None
+    """Timing information of the completion request."""
 
-async def _resp_async_generator(dialog:Dialog, async_iter: AsyncIterator[str], request:ChatCompletionRequest):
+
+def request_deadline(request:ChatCompletionRequest, received:float) -> Optional[float]:
+    deadlines = []
+    if request.timeout is not None:
+        deadlines.append(received + request.timeout)
+    if request.deadline is not None:
+        deadlines.append(request.deadline)
+    return min(deadlines) if deadlines else None
+
+def completion_timings(dialog:Dialog, received:float) -> CompletionTimings:
+    started_at = dialog.started_at or received
+    return CompletionTimings(
+        queued=started_at - received,
+        generation=(dialog.completed_at or time.time()) - started_at,
+        deadline_exceeded=dialog.deadline_exceeded)
+
+async def _resp_async_generator(dialog:Dialog, async_iter: AsyncIterator[str], request:ChatCompletionRequest, received:float):
     i = 0
-    async for token in async_iter:
-        chunk = {
-            "id": f"{str(dialog.id)}/{i}",
-            "object": "chat.completion.chunk",
-            "created": time.time(),
-            "model": request.model,
-            "choices": [{"delta": {"content": token + " "}}],
-        }
-        yield json.dumps(chunk) + "\n\n"
-        i += 1
-        await asyncio.sleep(1)
+    try:
+        async for token in async_iter:
+            chunk = {
+                "id": f"{str(dialog.id)}/{i}",
+                "object": "chat.completion.chunk",
+                "created": time.time(),
+                "model": request.model,
+                "choices": [{"delta": {"content": token + " "}}],
+            }
+            yield json.dumps(chunk) + "\n\n"
+            i += 1
+            await asyncio.sleep(1)
+    except TimeoutError:
+        # The response has started already, so the exceeded deadline is reported by the final chunk instead of a 408
+        dialog.finish_reason = "length"
+        dialog.deadline_exceeded = True
+
+    chunk = {
+        "id": f"{str(dialog.id)}/{i}",
+        "object": "chat.completion.chunk",
+        "created": time.time(),
+        "model": request.model,
+        "choices": [{"delta": {}, "finish_reason": dialog.finish_reason}],
+        "timings": completion_timings(dialog, received).model_dump(),
+    }
+    yield json.dumps(chunk) + "\n\n"
 
 def process_generation_kwargs(request:ChatCompletionRequest) -> dict:
     generation_kwargs = {}
@@ -337,27 +391,41 @@ def process_generation_kwargs(request:ChatCompletionRequest) -> dict:
 
 @chat_router.post("/completions")
 async def chat_completions(request: ChatCompletionRequest):
+    received = time.time()
+    deadline = request_deadline(request, received)
     try:
-        if not INFERENCE.ready or INFERENCE.model_id != request.model:
-            INFERENCE.reset()
-            INFERENCE.serve(request.model)
+        if deadline is not None and received >= deadline:
+            raise TimeoutError("The deadline was exceeded while queued")
+
+        # Loading the model blocks, so it's waited for off the event loop
+        inference = await asyncio.to_thread(POOL.acquire, request.model)
+        if deadline is not None and time.time() >= deadline:
+            # Waited for the model (to be loaded, or released) past the deadline
+            POOL.release(inference)
+            METRICS.increment("generation_deadline_dropped", model=request.model)
+            raise TimeoutError("The deadline was exceeded while queued")
+        PREFETCHER.prefetch_after(request.model, request.user or "default")
         input = request.messages[-1]
-        dialog = Dialog(user_input=input, history=request.messages)
+        dialog = Dialog(user_input=input, history=request.messages, model_id=request.model, deadline=deadline)
 
         if request.stream:
-            async_iter = INFERENCE.async_generate_response(dialog=dialog, **process_generation_kwargs(request))
+            async_iter = inference.async_generate_response(dialog=dialog, **process_generation_kwargs(request))
             return StreamingResponse(
-                _resp_async_generator(dialog, async_iter, request), media_type="application/x-ndjson"
+                _resp_async_generator(dialog, async_iter, request, received), media_type="application/x-ndjson",
+                background=BackgroundTask(POOL.release, inference)
             )
         else:
-            dialog = INFERENCE.generate_response(dialog=dialog, **process_generation_kwargs(request))
+            try:
+                dialog = inference.generate_response(dialog=dialog, **process_generation_kwargs(request))
+            finally:
+                POOL.release(inference)
             choices = list[Choice]()
             if isinstance(dialog.latest_response.content, str):
-                choices.append(Choice(finish_reason="stop", index=0, message=ChatCompletionMessage(content=dialog.latest_response.content, role=dialog.latest_response.role)))
+                choices.append(Choice(finish_reason=dialog.finish_reason or "stop", index=0, message=ChatCompletionMessage(content=dialog.latest_response.content, role=dialog.latest_response.role)))
             else:
                 i = 0
                 for response_choice in dialog.latest_response.content:
-                    choices.append(Choice(finish_reason="stop", index=i, message=ChatCompletionMessage(content=response_choice, role=dialog.latest_response.role)))
+                    choices.append(Choice(finish_reason=dialog.finish_reason[i] if dialog.finish_reason else "stop", index=i, message=ChatCompletionMessage(content=response_choice, role=dialog.latest_response.role)))
                     i += 1
                 
             return ChatCompletionResponse(
@@ -365,9 +433,14 @@ async def chat_completions(request: ChatCompletionRequest):
                 choices=choices,
                 created=int(time.time()),
                 model=request.model,
-                object="chat.completion")
+                object="chat.completion",
+                timings=completion_timings(dialog, received))
 
     except ValueError as e:
         raise HTTPException(400, detail=str(e))
     except NotImplementedError as e:
-        raise HTTPException(404, detail=str(e))
\ No newline at end of file
+        raise HTTPException(404, detail=str(e))
+    except MemoryError as e:
+        raise HTTPException(507, detail=str(e))
+    except TimeoutError as e:
+        raise HTTPException(408, detail=str(e))
\ No newline at end of file
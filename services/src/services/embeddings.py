@@ -1,21 +1,88 @@
+import os
+import math
+import asyncio
+import functools
+import numpy as np
 from typing import Optional, Union
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Request, Response, status
+from fastapi.responses import FileResponse, StreamingResponse
 from pydantic import BaseModel
-from array import array
 from typing import List, Literal
 from services.internal.inference import EmbeddingsInference
+from services.internal.pool import InferencePool
+from services.internal.batcher import EmbeddingsBatcher
+from services.internal.embedding_cache import EmbeddingCache, EMBEDDING_CACHE_ENABLED
+from services.internal.embedding_formats import EmbeddingPrecision, OCTET_STREAM, NPY, quantize, to_base64, to_npy, dumps
+from services.internal.embedding_jobs import EmbeddingJobs, EmbeddingJob, EMBEDDING_JOB_PROCESSES
+from services.internal.chunking import Chunk, DocumentPooler, InvalidDocument, DEFAULT_OVERLAP_TOKENS, max_seq_length, max_window, token_windows, read_documents
 from services.registry import REGISTRY
-import base64
+import logging
+
+logger = logging.getLogger(__name__)
 
 embeddings_router = APIRouter()
 
-INFERENCE = EmbeddingsInference(REGISTRY)
+POOL = InferencePool(REGISTRY, EmbeddingsInference, capacity=int(os.getenv("SERVICES_EMBEDDINGS_POOL_SIZE", "1")))
+
+def encode(model_id:str, sentences:list[str], dimensions:Optional[int] = None) -> list:
+    encode_kwargs = dict()
+    if dimensions is not None:
+        encode_kwargs["truncate_dim"] = dimensions
+
+    inference = POOL.acquire(model_id)
+    try:
+        return inference.encode(sentences, **encode_kwargs)
+    finally:
+        POOL.release(inference)
+
+BATCHER = EmbeddingsBatcher(encode)
+# Offline jobs hold their shards while interactive requests are being encoded
+JOBS = EmbeddingJobs(REGISTRY, busy=lambda: bool(BATCHER.pending or BATCHER.running))
+EMBEDDING_CACHE = EmbeddingCache(os.getenv("SERVICES_EMBEDDING_CACHE_DIR", str(REGISTRY.cache_root.parent / "services" / "embeddings"))) if EMBEDDING_CACHE_ENABLED else None
+
+async def embed(model_id:str, sentences:list[str], dimensions:Optional[int] = None) -> list:
+    """The embeddings of the sentences, the duplicated and cached ones aren't encoded (again)."""
+    model_info = REGISTRY.models.get(model_id)
+    revision = model_info.revision if model_info is not None else None
+    # The disk tier is read (and written) off the event loop
+    rows = await asyncio.to_thread(EMBEDDING_CACHE.get, model_id, revision, dimensions, sentences) if EMBEDDING_CACHE is not None else [None] * len(sentences)
+
+    missing = dict[str, list[int]]() # sentence -> its indexes
+    for i, (sentence, row) in enumerate(zip(sentences, rows)):
+        if row is None:
+            missing.setdefault(sentence, []).append(i)
+    if missing:
+        unique = list(missing.keys())
+        embeddings = await BATCHER.encode(model_id, unique, dimensions)
+        if EMBEDDING_CACHE is not None:
+            await asyncio.to_thread(EMBEDDING_CACHE.put, model_id, revision, dimensions, unique, embeddings)
+        for sentence, embedding in zip(unique, embeddings):
+            for i in missing[sentence]:
+                rows[i] = embedding
+    return rows
+
+@functools.lru_cache(maxsize=8)
+def tokenizer_for(model_id:str, revision:Optional[str]):
+    # Loaded on its own, so that the usage of cached embeddings doesn't require the model
+    from transformers import AutoTokenizer
+    return AutoTokenizer.from_pretrained(REGISTRY.models[model_id].location, local_files_only=True)
+
+def count_tokens(model_id:str, sentences:list[str]) -> int:
+    """The tokens that the encoder embeds, the sentences being truncated to its max_seq_length as the encoder does."""
+    tokenizer = tokenizer_for(model_id, REGISTRY.models[model_id].revision)
+    max_length = max_seq_length(REGISTRY.models[model_id].location)
+    return sum(len(input_ids) for input_ids in tokenizer(sentences, truncation=True, max_length=max_length)["input_ids"])
+
+def estimate_tokens(sentences:list[str], max_length:Optional[int] = None) -> int:
+    """The tokens of the sentences, estimated at 4 characters per token when the tokenizer can't count them."""
+    return sum(min(math.ceil(len(sentence) / 4), max_length or math.inf) for sentence in sentences)
 
 class CreateEmbeddingsRequest(BaseModel):
     model: str
     input: Optional[Union[str, list[str]]]
     dimensions: Optional[int] = None #truncate_dim for Matryoshka Embeddings e.g. jinaai/jina-embeddings-v3 
     encoding_format: Optional[str] = "float" # can also be base64
+    precision: EmbeddingPrecision = "float32" # see quantize, the raw formats (Accept: application/octet-stream or application/x-npy) honor it too
 
 class Usage(BaseModel):
     prompt_tokens: int
@@ -54,49 +121,193 @@ class CreateEmbeddingResponse(BaseModel):
 
 
 @embeddings_router.post("/")
-async def embeddings_create(request: CreateEmbeddingsRequest) -> CreateEmbeddingResponse:
+async def embeddings_create(request: CreateEmbeddingsRequest, http_request: Request) -> CreateEmbeddingResponse:
 
     try:
-        if not INFERENCE.ready or INFERENCE.model_id != request.model:
-            INFERENCE.reset()
-            INFERENCE.serve(request.model)
-
-        encode_kwargs = dict()
-        if request.dimensions is not None:
-            encode_kwargs["truncate_dim"] = request.dimensions
-
         sentences = list()
         if isinstance(request.input, str):
             sentences.append(request.input)
         else:
             sentences.extend(request.input)
 
-        embeddings = INFERENCE.encode(sentences, **encode_kwargs)
-
-        emedding_list = list[Embedding]()
-        response = CreateEmbeddingResponse(
-            object="list", 
-            data=emedding_list, 
-            model=request.model, 
-            usage=Usage(prompt_tokens=len(request.input), total_tokens=len(request.input)+sum([len(x) for x in embeddings]))
-        )
-
-        i = 0
-        for embedding in embeddings:
-            floats = embedding.tolist()
-            if request.encoding_format == "base64":
-                floats = base64.b64encode(array("f", floats)).decode("utf-8")
-            response.data.append(
-                Embedding(
-                    object="embedding", 
-                    index=i, 
-                    embedding= floats)
-            )
-            i += 1
-
-        return response
+        rows = await embed(request.model, sentences, request.dimensions)
+        embeddings = quantize(np.stack(rows), request.precision)
+        try:
+            tokens = await asyncio.to_thread(count_tokens, request.model, sentences)
+        except Exception as ex:
+            # The usage is reported anyway, the embeddings were computed
+            logger.warning("Failed to count the tokens of %s, they're estimated: %s", request.model, ex)
+            location = REGISTRY.models[request.model].location if request.model in REGISTRY.models else None
+            tokens = estimate_tokens(sentences, max_seq_length(location) if location is not None else None)
+
+        accept = http_request.headers.get("accept", "")
+        if OCTET_STREAM in accept or NPY in accept:
+            headers = {
+                "X-Embeddings-Shape": ",".join(str(size) for size in embeddings.shape),
+                "X-Embeddings-Dtype": str(embeddings.dtype),
+                "X-Usage-Tokens": str(tokens),
+            }
+            if NPY in accept:
+                return Response(to_npy(embeddings), media_type=NPY, headers=headers)
+            return Response(embeddings.tobytes(), media_type=OCTET_STREAM, headers=headers)
+
+        if request.encoding_format == "base64":
+            data = [to_base64(embedding) for embedding in embeddings]
+        else:
+            data = list(embeddings)
+        # Rendered directly, a pydantic model per embedding costs more than the encoding of large batches
+        content = {
+            "object": "list",
+            "data": [{"object": "embedding", "index": i, "embedding": embedding} for i, embedding in enumerate(data)],
+            "model": request.model,
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        }
+        return Response(dumps(content), media_type="application/json")
 
     except ValueError as e:
         raise HTTPException(400, detail=str(e))
     except NotImplementedError as e:
-        raise HTTPException(404, detail=str(e))
\ No newline at end of file
+        raise HTTPException(404, detail=str(e))
+    except MemoryError as e:
+        raise HTTPException(507, detail=str(e))
+
+# The chunks of the documents are embedded this many at a time, which bounds the memory of a streamed corpus
+DOCUMENT_BATCH_CHUNKS = int(os.getenv("SERVICES_DOCUMENT_BATCH_CHUNKS", "64"))
+
+@embeddings_router.post("/documents")
+async def embeddings_documents(
+        http_request: Request,
+        model: str,
+        dimensions: Optional[int] = None,
+        window: Optional[int] = None,
+        overlap: int = DEFAULT_OVERLAP_TOKENS,
+        pooling: Literal["mean", "none"] = "mean",
+        batch_size: int = DOCUMENT_BATCH_CHUNKS) -> StreamingResponse:
+    """
+    Embed long documents, streamed as NDJSON {"id": ..., "text": ...} lines, without truncating them: each document is
+    split into overlapping windows of tokens, which are embedded in batches of `batch_size` chunks.
+
+    The response is streamed as NDJSON too, a line per chunk ("none" pooling) or per document ("mean" pooling of its
+    chunks, weighted by their tokens). A document that fails is reported as an {"id": ..., "error": ...} line,
+    and a malformed line as a {"line": ..., "error": ...} line.
+    The ids are expected to be unique within a request.
+    """
+    if model not in REGISTRY.models:
+        raise HTTPException(404, detail="No such model.")
+    if not POOL.accepts(model):
+        # Before the response starts, a failure to load the model would otherwise be reported by every document
+        raise HTTPException(404, detail=f"{model} doesn't compute embeddings.")
+    try:
+        tokenizer = await asyncio.to_thread(tokenizer_for, model, REGISTRY.models[model].revision)
+        longest = max_window(tokenizer, max_seq_length(REGISTRY.models[model].location))
+        window = window or longest
+        if window > longest or overlap >= window:
+            raise ValueError(f"The window must be at most {longest} tokens, and larger than the overlap")
+    except ValueError as e:
+        raise HTTPException(400, detail=str(e))
+
+    async def lines():
+        pooler = DocumentPooler()
+        batch = list[tuple[Chunk, str]]()
+
+        failed = set[str]()
+
+        async def flush():
+            try:
+                embeddings = await embed(model, [text for _, text in batch], dimensions)
+            except Exception as ex:
+                # Reported by the documents of the batch, the response has started already
+                logger.warning("Failed to embed a batch of %d chunks with %s: %s", len(batch), model, ex)
+                for document_id in dict.fromkeys(chunk.document_id for chunk, _ in batch):
+                    if document_id not in failed:
+                        failed.add(document_id)
+                        yield dumps({"id": document_id, "error": str(ex)}) + b"\n"
+                batch.clear()
+                return
+            for (chunk, _), embedding in zip(batch, embeddings):
+                if chunk.document_id in failed:
+                    continue
+                if pooling == "none":
+                    yield dumps({"id": chunk.document_id, "chunk": chunk.index, "start": chunk.start, "end": chunk.end, "tokens": chunk.tokens, "embedding": embedding}) + b"\n"
+                elif (pooled := pooler.add(chunk, embedding)) is not None:
+                    document_id, chunks, tokens, document_embedding = pooled
+                    yield dumps({"id": document_id, "chunks": chunks, "tokens": tokens, "embedding": document_embedding}) + b"\n"
+            batch.clear()
+
+        async for document in read_documents(http_request.stream()):
+            if isinstance(document, InvalidDocument):
+                yield dumps(document.model_dump(exclude_none=True)) + b"\n"
+                continue
+            try:
+                chunks = await asyncio.to_thread(token_windows, tokenizer, document, window, overlap)
+            except Exception as ex:
+                yield dumps({"id": document.id, "error": str(ex)}) + b"\n"
+                continue
+            pooler.expect(document.id, len(chunks))
+            for chunk in chunks:
+                if document.id in failed:
+                    break
+                batch.append((chunk, document.text[chunk.start:chunk.end]))
+                if len(batch) >= batch_size:
+                    async for line in flush():
+                        yield line
+        if batch:
+            async for line in flush():
+                yield line
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+def _embedding_job(job_id:str) -> EmbeddingJob:
+    try:
+        return JOBS.get(job_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="No such embedding job.")
+
+@embeddings_router.post("/jobs", status_code=status.HTTP_202_ACCEPTED)
+async def create_embedding_job(
+        http_request: Request,
+        model: str,
+        dimensions: Optional[int] = None,
+        processes: int = EMBEDDING_JOB_PROCESSES) -> EmbeddingJob:
+    """
+    Embed a JSONL body (of strings or {"text": ...} objects) in the background, through a pool of encoder processes.
+    The progress is polled from /jobs/{job_id}, and the embeddings are downloaded from /jobs/{job_id}/output as a .npy file.
+    """
+    if model not in REGISTRY.models:
+        raise HTTPException(404, detail="No such model.")
+    path = JOBS.new_input()
+    # Written as it's received, the body of a large corpus isn't held in memory
+    with path.open("wb") as f:
+        async for data in http_request.stream():
+            f.write(data)
+    return JOBS.submit(model, path, dimensions=dimensions, processes=processes)
+
+@embeddings_router.get("/jobs")
+def get_embedding_jobs() -> List[EmbeddingJob]:
+    # Including the jobs that the other worker processes run
+    JOBS.load()
+    return sorted(JOBS.jobs.values(), key=lambda job: job.created)
+
+@embeddings_router.get("/jobs/{job_id}")
+def get_embedding_job(job_id:str) -> EmbeddingJob:
+    return _embedding_job(job_id)
+
+@embeddings_router.get("/jobs/{job_id}/output")
+def get_embedding_job_output(job_id:str) -> FileResponse:
+    job = _embedding_job(job_id)
+    if job.state != "succeeded" or not os.path.exists(job.output):
+        raise HTTPException(status_code=409, detail=f"The embedding job is {job.state}.")
+    return FileResponse(job.output, media_type=NPY, filename=f"{job_id}.npy")
+
+@embeddings_router.post("/jobs/{job_id}/resume", status_code=status.HTTP_202_ACCEPTED)
+def resume_embedding_job(job_id:str) -> EmbeddingJob:
+    _embedding_job(job_id)
+    try:
+        return JOBS.resume(job_id)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+@embeddings_router.delete("/jobs/{job_id}")
+def cancel_embedding_job(job_id:str) -> EmbeddingJob:
+    _embedding_job(job_id)
+    return JOBS.cancel(job_id)
@@ -1,12 +1,19 @@
-from fastapi import status, APIRouter, HTTPException
+from fastapi import status, APIRouter, HTTPException, Response
 from pydantic import BaseModel
 from services.registry import REGISTRY
+from services.internal import metrics
+from services.internal.metrics import METRICS
+from services.internal.pool import model_states
 
 healthcheck_router = APIRouter()
 
 class HealthCheck(BaseModel):
     status: str
 
+class Readiness(BaseModel):
+    status: str
+    models: dict[str, str]
+
 
 @healthcheck_router.get(
     "/",
@@ -18,3 +25,33 @@ def get_health() -> HealthCheck:
         raise HTTPException(status_code=500, detail="No Models")
     
     return HealthCheck(status="OK")
+
+
+@healthcheck_router.get(
+    "/metrics",
+    status_code=status.HTTP_200_OK,
+)
+def get_metrics() -> dict:
+    return METRICS.snapshot()
+
+
+@healthcheck_router.get(
+    "/load",
+    status_code=status.HTTP_200_OK,
+)
+def get_load() -> dict:
+    return metrics.REQUEST_COUNTERS.snapshot()
+
+
+@healthcheck_router.get(
+    "/ready",
+    status_code=status.HTTP_200_OK,
+    response_model=Readiness
+)
+def get_readiness(response: Response) -> Readiness:
+    states = model_states()
+    if any(state in ("pending", "loading") for state in states.values()):
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+        return Readiness(status="Loading", models=states)
+
+    return Readiness(status="OK", models=states)
@@ -0,0 +1,145 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+from pathlib import Path
+from pydantic import BaseModel
+from typing import Any, Optional
+import logging
+
+logger = logging.getLogger(__name__)
+
+# After the first load, the converted weights are written next to the model, so that later loads map them as is
+ARTIFACT_CACHE_ENABLED = os.getenv("SERVICES_ARTIFACT_CACHE", "True").lower() == "true"
+# Relative to the model location, under .cache so that it isn't mistaken for the model's own files
+ARTIFACTS_DIR = Path(".cache") / "services" / "artifacts"
+WEIGHTS_FILE = "model.safetensors"
+MANIFEST_FILE = "manifest.json"
+
+class ArtifactManifest(BaseModel):
+    model_id: str
+    revision: str
+    key: str
+    options: dict[str, Any]
+    """The load options the weights were converted with e.g. dtype."""
+
+    weights_bytes: int
+    created: int
+
+def artifact_options(auto_class, dtype:Any, attn_implementation:Optional[str]) -> dict[str, Any]:
+    import torch
+    import transformers
+    return {
+        "auto_class": auto_class.__name__,
+        "dtype": str(dtype).removeprefix("torch."),
+        "attn_implementation": attn_implementation,
+        "quantization": None,
+        # The layout of the state dict may change between versions
+        "torch": torch.__version__,
+        "transformers": transformers.__version__,
+    }
+
+def artifact_key(revision:str, options:dict[str, Any]) -> str:
+    return hashlib.sha256(json.dumps({"revision": revision, **options}, sort_keys=True).encode()).hexdigest()[:16]
+
+def artifact_dir(location:Path, key:str) -> Path:
+    return Path(location) / ARTIFACTS_DIR / key
+
+def single_device(device_map:Any) -> Optional[str]:
+    """The device of a device map that places the whole model on a single device, otherwise None."""
+    if isinstance(device_map, str):
+        return None if device_map in ("auto", "balanced", "sequential") else device_map
+    if isinstance(device_map, dict):
+        devices = set(device_map.values())
+        if len(devices) == 1:
+            device = devices.pop()
+            return f"cuda:{device}" if isinstance(device, int) else str(device)
+    return None
+
+def find_artifact(location:Path, key:str) -> Optional[ArtifactManifest]:
+    directory = artifact_dir(location, key)
+    if not (directory / MANIFEST_FILE).exists() or not (directory / WEIGHTS_FILE).exists():
+        return None
+    try:
+        return ArtifactManifest.model_validate_json((directory / MANIFEST_FILE).read_text())
+    except ValueError as ex:
+        logger.warning("Ignoring the invalid artifact manifest %s: %s", directory, ex)
+        return None
+
+def write_artifact(model, model_id:str, location:Path, revision:str, options:dict[str, Any]) -> ArtifactManifest:
+    """Write the loaded (converted) weights as a single safetensors file, with a manifest of the revision and load options."""
+    from safetensors.torch import save_model
+    key = artifact_key(revision, options)
+    directory = artifact_dir(location, key)
+    # Written aside and renamed, so that a concurrent or interrupted load never sees a partial artifact
+    staging = directory.with_name(f"{key}.{os.getpid()}.tmp")
+    staging.mkdir(parents=True, exist_ok=True)
+    try:
+        # Deduplicates the tied weights, which are re-tied on load
+        save_model(model, str(staging / WEIGHTS_FILE))
+        manifest = ArtifactManifest(
+            model_id=model_id,
+            revision=revision,
+            key=key,
+            options=options,
+            weights_bytes=(staging / WEIGHTS_FILE).stat().st_size,
+            created=int(time.time()))
+        (staging / MANIFEST_FILE).write_text(manifest.model_dump_json(indent=2))
+        if directory.exists():
+            shutil.rmtree(directory)
+        staging.rename(directory)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+    prune_artifacts(location, keep=key)
+    return manifest
+
+def prune_artifacts(location:Path, keep:str) -> int:
+    """
+    Remove the model's artifacts other than `keep` e.g. written for a previous revision or other load options.
+    The artifacts that are being written (by other processes) are left alone.
+
+    Returns:
+        int: The number of artifacts removed.
+    """
+    root = Path(location) / ARTIFACTS_DIR
+    if not root.is_dir():
+        return 0
+    removed = 0
+    for directory in root.iterdir():
+        if directory.name == keep or directory.suffix == ".tmp" or not directory.is_dir():
+            continue
+        logger.info("Removing the stale artifact %s", directory)
+        shutil.rmtree(directory, ignore_errors=True)
+        removed += 1
+    return removed
+
+def read_artifact(auto_class, config, location:Path, manifest:ArtifactManifest, device:str, dtype:Any, **model_kwargs):
+    """Build the model without initializing its weights, and assign the artifact's tensors (mapped straight to the device) to it."""
+    from accelerate import init_empty_weights
+    from safetensors.torch import load_file
+    # Only the parameters are left empty, the (non-persistent) buffers are computed as usual
+    with init_empty_weights():
+        model = auto_class.from_config(config, torch_dtype=dtype, **model_kwargs)
+    # Not tied by every transformers version while the weights are empty
+    model.tie_weights()
+    # The tied weights are a single parameter under several names, only one of which was written
+    tied = dict[int, list[str]]()
+    for name, parameter in model.named_parameters(remove_duplicate=False):
+        tied.setdefault(id(parameter), []).append(name)
+
+    state_dict = load_file(str(artifact_dir(location, manifest.key) / WEIGHTS_FILE), device=device)
+    result = model.load_state_dict(state_dict, strict=False, assign=True)
+    for names in tied.values():
+        written = next((name for name in names if name in state_dict), None)
+        if written is None or len(names) == 1:
+            continue
+        parameter = model.get_parameter(written)
+        for name in names:
+            module_name, _, attribute = name.rpartition(".")
+            setattr(model.get_submodule(module_name), attribute, parameter)
+
+    empty = [name for name, parameter in model.named_parameters() if parameter.device.type == "meta"]
+    if empty or result.unexpected_keys:
+        raise ValueError(f"The artifact {manifest.key} of {manifest.model_id} doesn't match the model, missing: {empty}, unexpected: {result.unexpected_keys}")
+    return model.to(device).eval()
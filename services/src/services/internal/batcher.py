@@ -0,0 +1,106 @@
+import os
+import time
+import asyncio
+from typing import Any, Callable, Optional, Sequence
+from services.internal.metrics import METRICS
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Concurrent requests for the same model (and dimensions) are encoded together, up to this number of sentences
+EMBEDDINGS_MAX_BATCH_SIZE = int(os.getenv("SERVICES_EMBEDDINGS_MAX_BATCH_SIZE", "64"))
+# How long the first request of a batch waits for others to join it, 0 disables the batching
+EMBEDDINGS_BATCH_WAIT_SECONDS = float(os.getenv("SERVICES_EMBEDDINGS_BATCH_WAIT_MS", "5")) / 1000
+QUEUE_DELAY_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.5, 1)
+
+BatchKey = tuple[str, Optional[int]] # model id, dimensions
+
+class PendingRequest:
+    def __init__(self, sentences:list[str], future:asyncio.Future):
+        self.sentences = sentences
+        self.future = future
+        self.enqueued = time.perf_counter()
+
+class EmbeddingsBatcher:
+    def __init__(self,
+                 encode:Callable[[str, list[str], Optional[int]], Sequence[Any]],
+                 max_batch_size:int = EMBEDDINGS_MAX_BATCH_SIZE,
+                 max_wait:float = EMBEDDINGS_BATCH_WAIT_SECONDS):
+        """
+        Gathers the concurrent embedding requests of a model, and encodes them in a single forward pass
+        (in a worker thread), once the batch is full or its first request waited `max_wait`.
+
+        Args:
+            encode(Callable): Encodes the sentences with the model, truncated to the dimensions (if not None).
+            max_batch_size(int): See `EMBEDDINGS_MAX_BATCH_SIZE`. A larger request is encoded on its own.
+            max_wait(float): See `EMBEDDINGS_BATCH_WAIT_SECONDS`.
+        """
+        self.encode_batch = encode
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.pending = dict[BatchKey, list[PendingRequest]]()
+        self.timers = dict[BatchKey, asyncio.TimerHandle]()
+        self.running = set[asyncio.Task]() # Referenced until done, the loop only keeps weak references to its tasks
+
+    async def encode(self, model_id:str, sentences:list[str], dimensions:Optional[int] = None) -> Sequence[Any]:
+        """The embeddings of the sentences, encoded along with the concurrent requests of the same model and dimensions."""
+        key = (model_id, dimensions)
+        request = PendingRequest(sentences, asyncio.get_running_loop().create_future())
+        if self.max_wait <= 0 or len(sentences) >= self.max_batch_size:
+            await self._run(key, [request])
+            return await request.future
+
+        batch = self.pending.setdefault(key, [])
+        if sum(len(pending.sentences) for pending in batch) + len(sentences) > self.max_batch_size:
+            # Doesn't fit, so the batch is flushed and this request starts the next one
+            self._flush(key)
+            batch = self.pending.setdefault(key, [])
+        batch.append(request)
+        if sum(len(pending.sentences) for pending in batch) >= self.max_batch_size:
+            self._flush(key)
+        elif key not in self.timers:
+            self.timers[key] = asyncio.get_running_loop().call_later(self.max_wait, self._flush, key)
+        return await request.future
+
+    def _flush(self, key:BatchKey):
+        timer = self.timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self.pending.pop(key, None)
+        if batch:
+            task = asyncio.create_task(self._run(key, batch), name=f"embeddings batch {key[0]}")
+            self.running.add(task)
+            task.add_done_callback(self.running.discard)
+
+    async def _run(self, key:BatchKey, batch:list[PendingRequest]):
+        model_id, dimensions = key
+        sentences = [sentence for request in batch for sentence in request.sentences]
+        started = time.perf_counter()
+        for request in batch:
+            METRICS.observe("embeddings_queue_delay_seconds", started - request.enqueued, buckets=QUEUE_DELAY_BUCKETS, model=model_id)
+        METRICS.observe("embeddings_batch_sentences", len(sentences), model=model_id)
+        METRICS.observe("embeddings_batch_requests", len(batch), model=model_id)
+        try:
+            embeddings = await asyncio.to_thread(self.encode_batch, model_id, sentences, dimensions)
+        except ValueError as ex:
+            if len(batch) == 1:
+                if not batch[0].future.done():
+                    batch[0].future.set_exception(ex)
+                return
+            # A bad input fails only its own request
+            logger.info("Failed to encode a batch of %d requests, encoding them one by one: %s", len(batch), ex)
+            for request in batch:
+                await self._run(key, [request])
+            return
+        except Exception as ex:
+            for request in batch:
+                if not request.future.done():
+                    request.future.set_exception(ex)
+            return
+
+        start = 0
+        for request in batch:
+            end = start + len(request.sentences)
+            if not request.future.done():
+                request.future.set_result(embeddings[start:end])
+            start = end
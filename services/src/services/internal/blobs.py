@@ -0,0 +1,203 @@
+import os
+import json
+import hashlib
+import threading
+from pathlib import Path
+from pydantic import BaseModel
+from typing import Iterable, Iterator, Optional
+from services.internal.metrics import METRICS
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Identical model files (e.g. the tokenizer of the variants of a family) are hard-linked to a single blob, when imported or scanned
+BLOB_STORE_ENABLED = os.getenv("SERVICES_BLOB_STORE", "True").lower() == "true"
+# Under the hub cache, hidden so that neither the registry nor its watcher see it
+BLOBS_DIR = ".blobs"
+DIGESTS_FILE = "digests.json"
+# The suffix of the links that replace the copies of a blob, see `BlobStore.dedupe`
+BLOB_STAGING_SUFFIX = ".blob"
+HASH_CHUNK_SIZE = 16 * 1024 * 1024
+
+class DuplicateFiles(BaseModel):
+    digest: str
+    size: int
+    paths: list[str]
+    """One path per copy, the other hard links of a copy aren't listed."""
+
+class StorageReport(BaseModel):
+    total_bytes: int = 0
+    """The bytes the model files take on disk, hard-linked files are counted once."""
+
+    reclaimable_bytes: int = 0
+    """The bytes that linking the identical copies to a single blob would free."""
+
+    duplicates: list[DuplicateFiles] = []
+
+class BlobStore:
+    def __init__(self, root:Path):
+        """
+        A content-addressed store, in which every distinct model file is a blob named by its sha256, that the model
+        directories hard-link to. Identical files thus take disk space, and page cache, only once.
+        The model files must be replaced rather than modified in place (as the hub client does), since the copies share the blob.
+
+        Args:
+            root(Path): The blobs directory, which must be on the same file system as the models.
+        """
+        self.root = Path(root)
+        # <device>:<inode>:<size>:<mtime> -> sha256, so that the files are hashed once, whatever their number of links
+        self.digests = dict[str, str]()
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        path = self.root / DIGESTS_FILE
+        if not path.exists():
+            return
+        try:
+            self.digests = json.loads(path.read_text())
+        except (OSError, ValueError) as ex:
+            logger.warning("Ignoring the blob digests %s: %s", path, ex)
+
+    def save(self):
+        with self._lock:
+            digests = json.dumps(self.digests)
+        try:
+            self.root.mkdir(parents=True, exist_ok=True)
+            staging = self.root / f"{DIGESTS_FILE}.{os.getpid()}.tmp"
+            staging.write_text(digests)
+            staging.replace(self.root / DIGESTS_FILE)
+        except OSError as ex:
+            logger.warning("Failed to save the blob digests %s: %s", self.root, ex)
+
+    def blob_path(self, digest:str) -> Path:
+        return self.root / digest[:2] / digest
+
+    def digest(self, path:Path, stat:Optional[os.stat_result] = None) -> str:
+        stat = stat or path.stat()
+        key = f"{stat.st_dev}:{stat.st_ino}:{stat.st_size}:{stat.st_mtime_ns}"
+        digest = self.digests.get(key)
+        if digest is None:
+            sha256 = hashlib.sha256()
+            with path.open("rb") as f:
+                while chunk := f.read(HASH_CHUNK_SIZE):
+                    sha256.update(chunk)
+            digest = sha256.hexdigest()
+            with self._lock:
+                self.digests[key] = digest
+        return digest
+
+    @staticmethod
+    def model_files(model_dir:Path) -> Iterator[Path]:
+        """The files of a model, without its caches (e.g. the hub client's metadata and the load artifacts) and partial downloads."""
+        for root, dirs, files in os.walk(model_dir):
+            dirs[:] = [d for d in dirs if not d.startswith(".")]
+            for name in files:
+                path = Path(root) / name
+                if not name.endswith(".incomplete") and not path.is_symlink():
+                    yield path
+
+    def scan(self, model_dirs:Iterable[Path]) -> StorageReport:
+        """Find the identical copies of the model files. Only the files whose size matches another copy's are hashed."""
+        copies = dict[int, dict[tuple[int, int], Path]]() # size -> (device, inode) -> one of its paths
+        report = StorageReport()
+        for model_dir in model_dirs:
+            for path in self.model_files(model_dir):
+                stat = path.stat()
+                same_size = copies.setdefault(stat.st_size, {})
+                if (stat.st_dev, stat.st_ino) not in same_size:
+                    same_size[(stat.st_dev, stat.st_ino)] = path
+                    report.total_bytes += stat.st_size
+
+        for size, same_size in copies.items():
+            if size == 0 or len(same_size) < 2:
+                continue
+            same_digest = dict[str, list[Path]]()
+            for path in same_size.values():
+                same_digest.setdefault(self.digest(path), []).append(path)
+            for digest, paths in same_digest.items():
+                if len(paths) > 1:
+                    report.reclaimable_bytes += size * (len(paths) - 1)
+                    report.duplicates.append(DuplicateFiles(digest=digest, size=size, paths=sorted(str(path) for path in paths)))
+
+        report.duplicates.sort(key=lambda duplicate: duplicate.size * len(duplicate.paths), reverse=True)
+        METRICS.set("cache_reclaimable_bytes", report.reclaimable_bytes)
+        return report
+
+    def dedupe(self, report:StorageReport) -> int:
+        """
+        Hard-link the identical copies that the scan found to their blob, the first copy of a file becomes its blob.
+        Files without copies are left as they are, they would take the same space whether they're linked or not.
+        The modification times of the directories are kept, so that the registry doesn't see the models as changed.
+        A linked copy takes the modification time of its blob (which its other links share), so a copy whose model's
+        revision is derived from the modification times (see `revision_uses_mtime`) is linked only if they're equal.
+
+        Returns:
+            int: The bytes that were freed.
+        """
+        directories = dict[Path, os.stat_result]()
+        uses_mtime = dict[Path, bool]()
+        freed = 0
+        try:
+            for duplicate in report.duplicates:
+                blob = self.blob_path(duplicate.digest)
+                for path in map(Path, duplicate.paths):
+                    stat = path.stat()
+                    if not blob.exists():
+                        blob.parent.mkdir(parents=True, exist_ok=True)
+                        os.link(path, blob)
+                        continue
+                    blob_stat = blob.stat()
+                    if (blob_stat.st_dev, blob_stat.st_ino) == (stat.st_dev, stat.st_ino):
+                        continue
+                    if blob_stat.st_size != stat.st_size or self.digest(path, stat) != duplicate.digest:
+                        logger.warning("The blob %s doesn't match %s, it's ignored", blob, path)
+                        continue
+                    if blob_stat.st_mtime_ns != stat.st_mtime_ns:
+                        if path.parent not in uses_mtime:
+                            uses_mtime[path.parent] = self.revision_uses_mtime(path)
+                        if uses_mtime[path.parent]:
+                            logger.debug("Not linking %s, its modification time is part of its model's revision", path)
+                            continue
+                    directories.setdefault(path.parent, path.parent.stat())
+                    # Linked aside and renamed over the copy, so that the file never goes missing
+                    staging = path.with_name(f"{path.name}.{os.getpid()}{BLOB_STAGING_SUFFIX}")
+                    os.link(blob, staging)
+                    os.replace(staging, path)
+                    if stat.st_nlink == 1:
+                        freed += stat.st_size
+        except OSError as ex:
+            # e.g. the blobs are on another file system (EXDEV), or the file system doesn't support hard links
+            logger.warning("Failed to deduplicate the model files: %s", ex)
+        finally:
+            for directory, stat in directories.items():
+                os.utime(directory, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        if freed:
+            logger.info("Freed %d bytes by linking the identical model files to their blobs", freed)
+            METRICS.increment("cache_deduplicated_bytes", freed)
+        return freed
+
+    def revision_uses_mtime(self, path:Path) -> bool:
+        """Whether the registry derives the revision of the file's model from the modification times of its files (see
+        `Models.read_revision`), i.e. the file is at the top of a model directory that has no hub metadata."""
+        try:
+            parts = path.relative_to(self.root.parent).parts
+        except ValueError:
+            return True
+        location = self.root.parent.joinpath(*parts[:2])
+        return path.parent == location and not any((location / ".cache" / "huggingface" / "download").glob("*.metadata"))
+
+    def collect_garbage(self) -> int:
+        """Remove the blobs that no model links to anymore (e.g. once the models were removed, or updated)."""
+        freed = 0
+        for blob in self.root.glob("*/*"):
+            try:
+                stat = blob.stat()
+                if stat.st_nlink == 1:
+                    blob.unlink()
+                    freed += stat.st_size
+            except FileNotFoundError:
+                continue
+        if freed:
+            logger.info("Freed %d bytes of blobs that no model links to", freed)
+        return freed
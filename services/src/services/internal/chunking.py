@@ -0,0 +1,126 @@
+import os
+import json
+import numpy as np
+from pathlib import Path
+from pydantic import BaseModel
+from typing import AsyncIterator, Optional, Union
+
+# The longest window, in tokens, when the tokenizer doesn't tell the model's maximal length
+DEFAULT_WINDOW_TOKENS = int(os.getenv("SERVICES_DOCUMENT_WINDOW_TOKENS", "512"))
+# The number of tokens that consecutive windows of a document share
+DEFAULT_OVERLAP_TOKENS = int(os.getenv("SERVICES_DOCUMENT_OVERLAP_TOKENS", "32"))
+
+class Document(BaseModel):
+    id: str
+    text: str
+
+class InvalidDocument(BaseModel):
+    line: int
+    """The (1-based) line of the stream that isn't a document."""
+
+    id: Optional[str] = None
+    error: str
+
+class Chunk(BaseModel):
+    document_id: str
+    index: int
+    start: int
+    """The character offsets of the chunk in the document."""
+
+    end: int
+    tokens: int
+
+def max_seq_length(location:Path) -> Optional[int]:
+    """
+    The length that a SentenceTransformer truncates its inputs to (see `get_max_seq_length`), special tokens included,
+    read from the model's files so that the model isn't loaded. None when the model doesn't configure it.
+    """
+    try:
+        config = json.loads((Path(location) / "sentence_bert_config.json").read_text())
+    except (OSError, ValueError):
+        return None
+    return config.get("max_seq_length")
+
+def max_window(tokenizer, max_length:Optional[int] = None) -> int:
+    """
+    The longest window the model embeds without truncating it, leaving room for the special tokens.
+
+    Args:
+        max_length(int): The length the model truncates its inputs to (see `max_seq_length`), which is often shorter than
+            the tokenizer's model_max_length e.g. 256 tokens for all-MiniLM-L6-v2, whose tokenizer allows 512.
+    """
+    model_max_length = max_length or getattr(tokenizer, "model_max_length", None)
+    # Tokenizers without a configured length report a huge sentinel
+    if not model_max_length or model_max_length > 100_000:
+        model_max_length = DEFAULT_WINDOW_TOKENS
+    return model_max_length - tokenizer.num_special_tokens_to_add()
+
+def token_windows(tokenizer, document:Document, window:int, overlap:int = DEFAULT_OVERLAP_TOKENS) -> list[Chunk]:
+    """Split the document into windows of at most `window` tokens, each one starting `window - overlap` tokens after the previous one."""
+    if overlap >= window:
+        raise ValueError(f"The overlap ({overlap}) must be smaller than the window ({window})")
+    offsets = tokenizer(document.text, add_special_tokens=False, return_offsets_mapping=True)["offset_mapping"]
+    if not offsets:
+        return [Chunk(document_id=document.id, index=0, start=0, end=len(document.text), tokens=0)]
+    chunks = list[Chunk]()
+    for start in range(0, len(offsets), window - overlap):
+        end = min(start + window, len(offsets))
+        chunks.append(Chunk(document_id=document.id, index=len(chunks), start=offsets[start][0], end=offsets[end - 1][1], tokens=end - start))
+        if end == len(offsets):
+            break
+    return chunks
+
+def parse_document(line:bytes, number:int) -> Union[Document, InvalidDocument]:
+    try:
+        value = json.loads(line)
+    except ValueError as ex:
+        return InvalidDocument(line=number, error=f"Invalid JSON: {ex}")
+    try:
+        return Document.model_validate(value)
+    except ValueError as ex:
+        document_id = value.get("id") if isinstance(value, dict) else None
+        return InvalidDocument(line=number, id=document_id if isinstance(document_id, str) else None, error=str(ex))
+
+async def read_documents(lines:AsyncIterator[bytes]) -> AsyncIterator[Union[Document, InvalidDocument]]:
+    """Parse a stream of NDJSON documents as the bytes arrive, e.g. from a request body, a malformed line doesn't end the stream."""
+    buffer = b""
+    number = 0
+    async for data in lines:
+        buffer += data
+        *complete, buffer = buffer.split(b"\n")
+        for line in complete:
+            number += 1
+            if line.strip():
+                yield parse_document(line, number)
+    if buffer.strip():
+        yield parse_document(buffer, number + 1)
+
+class DocumentPooler:
+    def __init__(self):
+        """Averages the embeddings of the chunks of each document, weighted by their tokens, as the chunks are embedded."""
+        self.sums = dict[str, np.ndarray]()
+        self.weights = dict[str, int]()
+        self.tokens = dict[str, int]()
+        self.chunks = dict[str, int]()
+        self.remaining = dict[str, int]()
+
+    def expect(self, document_id:str, chunks:int):
+        self.chunks[document_id] = self.remaining[document_id] = chunks
+        self.weights[document_id] = self.tokens[document_id] = 0
+
+    def add(self, chunk:Chunk, embedding:np.ndarray) -> Optional[tuple[str, int, int, np.ndarray]]:
+        """
+        Returns:
+            tuple: Once all the chunks of the document were added, its id, number of chunks, tokens and pooled embedding.
+        """
+        document_id = chunk.document_id
+        weight = max(chunk.tokens, 1)
+        self.sums[document_id] = self.sums[document_id] + embedding * weight if document_id in self.sums else embedding * weight
+        self.weights[document_id] += weight
+        self.tokens[document_id] += chunk.tokens
+        self.remaining[document_id] -= 1
+        if self.remaining[document_id] > 0:
+            return None
+        pooled = self.sums.pop(document_id) / self.weights.pop(document_id)
+        del self.remaining[document_id]
+        return document_id, self.chunks.pop(document_id), self.tokens.pop(document_id), pooled
@@ -0,0 +1,208 @@
+import os
+import fcntl
+import hashlib
+import threading
+import unicodedata
+import numpy as np
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional
+from services.internal.metrics import METRICS
+import logging
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_CACHE_ENABLED = os.getenv("SERVICES_EMBEDDING_CACHE", "True").lower() == "true"
+# The in-memory (LRU) tier, in bytes of embeddings
+EMBEDDING_CACHE_MEMORY_BYTES = int(float(os.getenv("SERVICES_EMBEDDING_CACHE_MEMORY_MB", "256")) * 1024 ** 2)
+# The persistent (memory-mapped) tier, which stops growing once full, 0 disables it
+EMBEDDING_CACHE_DISK_BYTES = int(float(os.getenv("SERVICES_EMBEDDING_CACHE_DISK_GB", "2")) * 1024 ** 3)
+KEY_BYTES = 16
+KEYS_FILE = "keys.bin"
+VECTORS_FILE = "vectors.f32"
+DIMENSIONS_FILE = "dimensions"
+LOCK_FILE = "lock"
+
+def normalize(text:str) -> str:
+    # The same text typed or pasted differently e.g. composed or decomposed accents, is encoded to the same tokens
+    return unicodedata.normalize("NFC", text)
+
+def embedding_key(model_id:str, revision:Optional[str], dimensions:Optional[int], text:str) -> bytes:
+    return hashlib.blake2b(
+        "\0".join([model_id, revision or "", str(dimensions or ""), normalize(text)]).encode(),
+        digest_size=KEY_BYTES).digest()
+
+class EmbeddingShard:
+    def __init__(self, directory:Path):
+        """
+        The persisted embeddings of a model revision and dimensions, as two append-only files: the rows of float32
+        vectors, which are memory-mapped, and their keys, which are loaded into an index.
+        The worker processes share the files, the appends are serialized by a lock on the shard, and each process
+        reads the rows that the others appended (see `refresh`).
+        """
+        self.directory = Path(directory)
+        self.index = dict[bytes, int]() # key -> row
+        self.rows = 0 # The rows that were read into the index
+        self.dimensions:Optional[int] = None
+        self.vectors:Optional[np.memmap] = None
+        self.refresh()
+
+    @property
+    def bytes(self) -> int:
+        return self.rows * (self.dimensions or 0) * 4
+
+    @contextmanager
+    def _locked(self, exclusive:bool):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with (self.directory / LOCK_FILE).open("a") as f:
+            # Released once the file is closed
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            yield
+
+    def refresh(self):
+        """Index the rows that were appended since they were last read, by this or another process."""
+        if not (self.directory / KEYS_FILE).exists():
+            return
+        with self._locked(exclusive=False):
+            self._read_tail()
+
+    def _read_tail(self):
+        paths = [self.directory / name for name in (DIMENSIONS_FILE, VECTORS_FILE, KEYS_FILE)]
+        if not all(path.exists() for path in paths):
+            return
+        if self.dimensions is None:
+            self.dimensions = int(paths[0].read_text())
+        # The keys are written after their rows, so a row without a key (interrupted append) is ignored
+        rows = min(paths[2].stat().st_size // KEY_BYTES, paths[1].stat().st_size // 4 // self.dimensions)
+        if rows <= self.rows:
+            return
+        with paths[2].open("rb") as f:
+            f.seek(self.rows * KEY_BYTES)
+            keys = f.read((rows - self.rows) * KEY_BYTES)
+        for i in range(rows - self.rows):
+            self.index[keys[i * KEY_BYTES:(i + 1) * KEY_BYTES]] = self.rows + i
+        self.rows = rows
+        self._map()
+
+    def _map(self):
+        self.vectors = np.memmap(self.directory / VECTORS_FILE, dtype=np.float32, mode="r", shape=(self.rows, self.dimensions)) if self.rows else None
+
+    def get(self, key:bytes) -> Optional[np.ndarray]:
+        row = self.index.get(key)
+        if row is None:
+            return None
+        if self.vectors is None or row >= self.vectors.shape[0]:
+            self._map()
+        return np.array(self.vectors[row])
+
+    def append(self, keys:list[bytes], vectors:np.ndarray):
+        with self._locked(exclusive=True):
+            # Including the rows of the other processes, which aren't appended twice nor truncated
+            self._read_tail()
+            if self.dimensions is None:
+                (self.directory / DIMENSIONS_FILE).write_text(str(vectors.shape[1]))
+                self.dimensions = vectors.shape[1]
+            if vectors.shape[1] != self.dimensions:
+                return
+            new = [i for i, key in enumerate(keys) if key not in self.index]
+            if not new:
+                return
+            with (self.directory / VECTORS_FILE).open("ab") as f:
+                # Truncated to the complete rows, dropping the rows of an interrupted append
+                f.truncate(self.rows * self.dimensions * 4)
+                f.write(np.ascontiguousarray(vectors[new], dtype=np.float32).tobytes())
+            with (self.directory / KEYS_FILE).open("ab") as f:
+                f.truncate(self.rows * KEY_BYTES)
+                f.write(b"".join(keys[i] for i in new))
+            for key in (keys[i] for i in new):
+                self.index[key] = self.rows
+                self.rows += 1
+
+class EmbeddingCache:
+    def __init__(self,
+                 path:Optional[Path] = None,
+                 memory_bytes:int = EMBEDDING_CACHE_MEMORY_BYTES,
+                 disk_bytes:int = EMBEDDING_CACHE_DISK_BYTES):
+        """
+        Caches the embeddings by model, revision, dimensions and (normalized) text, in a memory tier of the most
+        recently used embeddings, backed by a persistent disk tier.
+
+        Args:
+            path(Path): The directory of the disk tier, None to keep the embeddings in memory only.
+            memory_bytes(int): See `EMBEDDING_CACHE_MEMORY_BYTES`.
+            disk_bytes(int): See `EMBEDDING_CACHE_DISK_BYTES`.
+        """
+        self.path = Path(path) if path else None
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.memory = OrderedDict[bytes, np.ndarray]()
+        self.memory_used = 0
+        self.shards = dict[str, EmbeddingShard]()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def shard(self, model_id:str, revision:Optional[str], dimensions:Optional[int]) -> Optional[EmbeddingShard]:
+        if self.path is None or self.disk_bytes <= 0:
+            return None
+        name = hashlib.sha256(f"{model_id}\0{revision or ''}\0{dimensions or ''}".encode()).hexdigest()[:16]
+        if name not in self.shards:
+            self.shards[name] = EmbeddingShard(self.path / name)
+        return self.shards[name]
+
+    def get(self, model_id:str, revision:Optional[str], dimensions:Optional[int], texts:list[str]) -> list[Optional[np.ndarray]]:
+        """The cached embeddings of the texts, None for those that must be encoded."""
+        rows = list[Optional[np.ndarray]]()
+        keys = [embedding_key(model_id, revision, dimensions, text) for text in texts]
+        with self._lock:
+            shard = self.shard(model_id, revision, dimensions)
+            if shard is not None and any(key not in self.memory for key in keys):
+                # The rows that the other worker processes appended meanwhile
+                shard.refresh()
+            for key in keys:
+                row = self.memory.get(key)
+                if row is not None:
+                    self.memory.move_to_end(key)
+                    METRICS.increment("embedding_cache_hits", tier="memory")
+                elif shard is not None and (row := shard.get(key)) is not None:
+                    self._remember(key, row)
+                    METRICS.increment("embedding_cache_hits", tier="disk")
+                rows.append(row)
+            hits = sum(row is not None for row in rows)
+            self.hits += hits
+            self.misses += len(rows) - hits
+            METRICS.increment("embedding_cache_misses", len(rows) - hits)
+            if self.hits + self.misses:
+                METRICS.set("embedding_cache_hit_ratio", self.hits / (self.hits + self.misses))
+        return rows
+
+    def put(self, model_id:str, revision:Optional[str], dimensions:Optional[int], texts:list[str], embeddings:np.ndarray):
+        keys = [embedding_key(model_id, revision, dimensions, text) for text in texts]
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        with self._lock:
+            for key, row in zip(keys, embeddings):
+                # Copied, so that the memory tier doesn't keep the whole batch alive
+                self._remember(key, row.copy())
+            shard = self.shard(model_id, revision, dimensions)
+            if shard is None or embeddings.ndim != 2:
+                return
+            new = list({key: i for i, key in enumerate(keys) if key not in shard.index}.values())
+            if not new or sum(other.bytes for other in self.shards.values()) + embeddings[new].nbytes > self.disk_bytes:
+                return
+            try:
+                shard.append([keys[i] for i in new], embeddings[new])
+            except OSError as ex:
+                logger.warning("Failed to persist embeddings into %s: %s", shard.directory, ex)
+            METRICS.set("embedding_cache_bytes", sum(other.bytes for other in self.shards.values()), tier="disk")
+
+    def _remember(self, key:bytes, row:np.ndarray):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return
+        self.memory[key] = row
+        self.memory_used += row.nbytes
+        while self.memory_used > self.memory_bytes and self.memory:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_used -= evicted.nbytes
+        METRICS.set("embedding_cache_bytes", self.memory_used, tier="memory")
@@ -0,0 +1,51 @@
+import io
+import json
+import numpy as np
+from typing import Any, Literal
+
+EmbeddingPrecision = Literal["float32", "float16", "int8", "binary"]
+
+# Raw responses, negotiated with the Accept header, instead of JSON
+OCTET_STREAM = "application/octet-stream"
+NPY = "application/x-npy"
+
+def quantize(embeddings:np.ndarray, precision:EmbeddingPrecision) -> np.ndarray:
+    """
+    Convert the (rows of) embeddings to the precision:
+        float16: half the bytes, with ~3 significant digits.
+        int8: each vector scaled to [-127, 127] by its largest magnitude, which keeps the cosine similarities.
+        binary: the signs of the dimensions, packed 8 per byte (uint8), for hamming distances.
+    """
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    if precision == "float32":
+        return embeddings
+    if precision == "float16":
+        return embeddings.astype(np.float16)
+    if precision == "int8":
+        scale = np.abs(embeddings).max(axis=-1, keepdims=True)
+        scale[scale == 0] = 1
+        return np.rint(embeddings / scale * 127).astype(np.int8)
+    if precision == "binary":
+        return np.packbits(embeddings > 0, axis=-1)
+    raise ValueError(f"Unsupported precision: {precision}")
+
+def to_base64(row:np.ndarray) -> str:
+    # Straight from the (contiguous) buffer of the row, without going through a list of floats
+    import pybase64
+    return pybase64.b64encode(memoryview(np.ascontiguousarray(row))).decode("ascii")
+
+def to_npy(embeddings:np.ndarray) -> bytes:
+    buffer = io.BytesIO()
+    np.save(buffer, embeddings, allow_pickle=False)
+    return buffer.getvalue()
+
+def dumps(content:dict[str, Any]) -> bytes:
+    """
+    Render a response whose embeddings are numpy rows (or base64 strings), without validating a pydantic model per item.
+    orjson serializes the rows natively when it's installed, otherwise they're converted to lists.
+    """
+    try:
+        import orjson
+    except ImportError:
+        return json.dumps(content, separators=(",", ":"), default=lambda value: value.tolist()).encode()
+    return orjson.dumps(content, option=orjson.OPT_SERIALIZE_NUMPY)
@@ -0,0 +1,369 @@
+import os
+import json
+import time
+import uuid
+import threading
+import multiprocessing
+import numpy as np
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+from pydantic import BaseModel, Field
+from typing import Callable, Iterator, Optional
+from services.internal.action_manager import ActionManager
+from services.internal.imports import JobState
+from services.internal.job_claims import JobClaims
+from services.internal.registry import Models
+from services.internal.metrics import METRICS
+import logging
+
+logger = logging.getLogger(__name__)
+
+# The encoder processes of a job, each pinned to its own share of the cores
+EMBEDDING_JOB_PROCESSES = int(os.getenv("SERVICES_EMBEDDING_JOB_PROCESSES", str(max(1, min(4, (os.cpu_count() or 1) // 2)))))
+# The number of inputs that are sent to an encoder process at once
+EMBEDDING_JOB_SHARD_SIZE = int(os.getenv("SERVICES_EMBEDDING_JOB_SHARD_SIZE", "256"))
+# The niceness of the encoder processes, so that the interactive requests get the cores first
+EMBEDDING_JOB_NICENESS = int(os.getenv("SERVICES_EMBEDDING_JOB_NICENESS", "10"))
+EMBEDDING_JOB_DEVICE = os.getenv("SERVICES_EMBEDDING_JOB_DEVICE", "cpu")
+# The job state is persisted at most once in this number of seconds
+EMBEDDING_JOB_SAVE_INTERVAL = 1.0
+# Behind the imports and other actions of the default priority (10)
+EMBEDDING_JOB_PRIORITY = 20
+
+class EmbeddingJobProgress(BaseModel):
+    total: int = 0
+    done: int = 0
+    inputs_per_second: float = 0.0
+
+class EmbeddingJob(BaseModel):
+    id: str
+    model: str
+    dimensions: Optional[int] = None
+    processes: int = EMBEDDING_JOB_PROCESSES
+    input: str
+    """A JSONL file, whose lines are strings or {"text": ...} objects."""
+
+    output: str
+    """A .npy file of float32 rows, in the order of the input lines, that is written as the shards are encoded."""
+
+    state: JobState = "queued"
+    progress: EmbeddingJobProgress = Field(default_factory=EmbeddingJobProgress)
+    error: Optional[str] = None
+    created: float = Field(default_factory=time.time)
+    updated: float = Field(default_factory=time.time)
+
+    @property
+    def finished(self) -> bool:
+        return self.state in ("succeeded", "failed", "cancelled")
+
+def core_sets(processes:int) -> list[Optional[list[int]]]:
+    """Split the cores of this process into disjoint sets, one per encoder process (None where affinity isn't supported)."""
+    if not hasattr(os, "sched_getaffinity"):
+        return [None] * processes
+    cores = sorted(os.sched_getaffinity(0))
+    processes = min(processes, len(cores))
+    return [cores[i::processes] for i in range(processes)]
+
+_ENCODER = None
+_DIMENSIONS = None
+
+def _init_encoder(location:str, device:str, dimensions:Optional[int], cores:"multiprocessing.Queue", niceness:int):
+    global _ENCODER, _DIMENSIONS
+    import torch
+    from sentence_transformers import SentenceTransformer
+    assigned = cores.get()
+    if assigned is not None:
+        os.sched_setaffinity(0, assigned)
+        torch.set_num_threads(len(assigned))
+    if niceness:
+        os.nice(niceness)
+    _ENCODER = SentenceTransformer(location, device=device, local_files_only=True)
+    _DIMENSIONS = dimensions
+
+def _encode_shard(texts:list[str]) -> np.ndarray:
+    return np.asarray(_ENCODER.encode(texts, truncate_dim=_DIMENSIONS), dtype=np.float32)
+
+def read_inputs(path:Path, skip:int = 0) -> Iterator[str]:
+    """The inputs of the file, after the first `skip` ones, the blank lines aren't inputs."""
+    with Path(path).open() as f:
+        lines = (line for line in f if line.strip())
+        for i, line in enumerate(lines):
+            if i < skip:
+                continue
+            value = json.loads(line)
+            yield value if isinstance(value, str) else value["text"]
+
+def count_inputs(path:Path) -> int:
+    with Path(path).open() as f:
+        return sum(1 for line in f if line.strip())
+
+class EmbeddingJobs:
+    def __init__(self, registry:Models, jobs_dir:Optional[Path] = None, busy:Callable[[], bool] = lambda: False):
+        """
+        Embeds JSONL files of inputs in the background, sharding them across a pool of encoder processes.
+        Jobs are persisted, so those that were interrupted are resumed from their last written row.
+        The worker processes share the jobs through `jobs_dir`, each job is run by the process that claimed it (see `JobClaims`).
+
+        Args:
+            registry(Models): The registry of the embeddings models.
+            jobs_dir(Path): Where the jobs, their inputs and outputs are kept, defaults to <HF_HOME>/services/embedding_jobs.
+            busy(Callable): True while interactive embeddings are being served, during which no shard is sent to the encoders.
+        """
+        self.registry = registry
+        self.jobs_dir = Path(jobs_dir or registry.cache_root.parent / "services" / "embedding_jobs")
+        self.busy = busy
+        self.jobs = dict[str, EmbeddingJob]()
+        self.claims = JobClaims(self.jobs_dir)
+        self.cancelled = set[str]()
+        self.stopping = threading.Event()
+        self.manager:Optional[ActionManager] = None
+        self._thread:Optional[threading.Thread] = None
+        self._lock = threading.RLock()
+        self.load()
+
+    def load(self):
+        """Read the jobs as they were last saved, including those of the other worker processes."""
+        if not self.jobs_dir.exists():
+            return
+        for path in self.jobs_dir.glob("*.job.json"):
+            job = self._read(path)
+            if job is not None:
+                with self._lock:
+                    if job.id not in self.claims.held:
+                        self.jobs[job.id] = job
+
+    def _read(self, path:Path) -> Optional[EmbeddingJob]:
+        try:
+            job = EmbeddingJob.model_validate_json(path.read_text())
+        except (OSError, ValueError) as ex:
+            logger.warning("Ignoring the embedding job %s: %s", path, ex)
+            return None
+        if not job.finished and not self.claims.is_claimed(job.id):
+            job.state = "failed"
+            job.error = "Interrupted"
+        return job
+
+    def get(self, job_id:str) -> EmbeddingJob:
+        """
+        The job, as it was last saved by the process that runs it, when that's another worker process.
+
+        Raises:
+            KeyError: There's no such job.
+        """
+        with self._lock:
+            if job_id in self.claims.held:
+                return self.jobs[job_id]
+        path = self.jobs_dir / f"{job_id}.job.json"
+        job = self._read(path) if path.exists() else None
+        with self._lock:
+            if job is not None and job_id not in self.claims.held:
+                self.jobs[job_id] = job
+            return self.jobs[job_id]
+
+    def save(self, job:EmbeddingJob):
+        job.updated = time.time()
+        try:
+            self.jobs_dir.mkdir(parents=True, exist_ok=True)
+            staging = self.jobs_dir / f"{job.id}.job.json.tmp"
+            staging.write_text(job.model_dump_json())
+            staging.replace(self.jobs_dir / f"{job.id}.job.json")
+        except OSError as ex:
+            logger.warning("Failed to save the embedding job %s: %s", job.id, ex)
+
+    def start(self):
+        with self._lock:
+            if self.manager is not None:
+                return
+            self.stopping.clear()
+            self.manager = ActionManager(1, force_new_loop=True)
+            self._thread = threading.Thread(target=self.manager.loop.run_forever, name="embedding jobs", daemon=True)
+            self._thread.start()
+            self.manager.loop.call_soon_threadsafe(self.manager.start)
+
+    def stop(self):
+        with self._lock:
+            if self.manager is None:
+                return
+            # The running job stops after its current shards, and is resumed by `resume_interrupted`
+            self.stopping.set()
+            self.manager.loop.call_soon_threadsafe(self.manager.loop.stop)
+            self._thread.join(timeout=30)
+            self.manager = None
+            self._thread = None
+
+    def new_input(self) -> Path:
+        """A path to write the input file of a job to, next to the jobs."""
+        self.jobs_dir.mkdir(parents=True, exist_ok=True)
+        return self.jobs_dir / f"{uuid.uuid4()}.input.jsonl"
+
+    def submit(self, model:str, input:Path, dimensions:Optional[int] = None, processes:int = EMBEDDING_JOB_PROCESSES) -> EmbeddingJob:
+        """Embed the input file (e.g. written at `new_input`), with the embeddings model."""
+        if model not in self.registry.models:
+            raise NotImplementedError(f"No such model: {model}")
+        job_id = str(uuid.uuid4())
+        job = EmbeddingJob(
+            id=job_id,
+            model=model,
+            dimensions=dimensions,
+            processes=max(1, processes),
+            input=str(input),
+            output=str(self.jobs_dir / f"{job_id}.npy"))
+        with self._lock:
+            self.claims.claim(job.id)
+            self.jobs[job.id] = job
+        self.save(job)
+        self._schedule(job)
+        return job
+
+    def resume(self, job_id:str) -> EmbeddingJob:
+        """Run a failed or cancelled job again, from its last written row."""
+        with self._lock:
+            running = job_id in self.claims.held
+            if not running and not self.claims.claim(job_id):
+                raise ValueError(f"Embedding job {job_id} is run by another worker process, it can't be resumed")
+            job = self.jobs.get(job_id) if running else self._read(self.jobs_dir / f"{job_id}.job.json") or self.jobs.get(job_id)
+            if job is None:
+                self.claims.release(job_id)
+                raise KeyError(job_id)
+            if not running and not job.finished:
+                # Saved last by a process that no longer runs it
+                job.state = "failed"
+                job.error = "Interrupted"
+            self.jobs[job_id] = job
+            if not job.finished or job.state == "succeeded":
+                if not running:
+                    self.claims.release(job_id)
+                raise ValueError(f"Embedding job {job_id} is {job.state}, it can't be resumed")
+            self.claims.clear_cancel(job_id)
+            self.cancelled.discard(job.id)
+            job.state = "queued"
+            job.error = None
+        self.save(job)
+        self._schedule(job)
+        return job
+
+    def resume_interrupted(self) -> list[EmbeddingJob]:
+        """Resume the interrupted jobs, that no other worker process resumed (or runs) already."""
+        self.load()
+        resumed = list[EmbeddingJob]()
+        for job in list(self.jobs.values()):
+            if job.state == "failed" and job.error == "Interrupted":
+                try:
+                    resumed.append(self.resume(job.id))
+                except ValueError:
+                    continue
+        return resumed
+
+    def cancel(self, job_id:str) -> EmbeddingJob:
+        with self._lock:
+            job = self.get(job_id)
+            if not job.finished:
+                self.cancelled.add(job_id)
+                if job_id not in self.claims.held:
+                    self.claims.request_cancel(job_id)
+                elif job.state == "queued":
+                    job.state = "cancelled"
+                    self.save(job)
+        return job
+
+    def _schedule(self, job:EmbeddingJob):
+        self.start()
+        self.manager.loop.call_soon_threadsafe(
+            lambda: self.manager.schedule(self._run, job.id, id=f"embedding job {job.id}", priority=EMBEDDING_JOB_PRIORITY))
+        METRICS.increment("embedding_jobs_submitted")
+
+    def _cancelled(self, job_id:str) -> bool:
+        # Or by another worker process
+        if job_id not in self.cancelled and self.claims.cancel_requested(job_id):
+            self.cancelled.add(job_id)
+        return job_id in self.cancelled
+
+    def _should_stop(self, job_id:str) -> bool:
+        return self._cancelled(job_id) or self.stopping.is_set()
+
+    def _run(self, job_id:str):
+        job = self.jobs[job_id]
+        with self._lock:
+            if self._cancelled(job_id):
+                job.state = "cancelled"
+                self.save(job)
+                self.claims.release(job_id)
+                return
+            if job.state != "queued":
+                self.claims.release(job_id)
+                return
+            job.state = "running"
+        self.save(job)
+        try:
+            job.progress.total = count_inputs(Path(job.input))
+            self._encode(job)
+            if job.progress.done < job.progress.total:
+                raise InterruptedError()
+            job.state = "succeeded"
+            METRICS.increment("embedding_jobs_succeeded")
+        except InterruptedError:
+            if self._cancelled(job_id):
+                job.state = "cancelled"
+            else:
+                job.state = "failed"
+                job.error = "Interrupted"
+        except Exception as ex:
+            logger.exception("Failed to run the embedding job %s: %s", job_id, ex)
+            job.state = "failed"
+            job.error = str(ex)
+            METRICS.increment("embedding_jobs_failed")
+        finally:
+            self.save(job)
+            self.claims.release(job_id)
+
+    def _encode(self, job:EmbeddingJob):
+        location = str(self.registry.models[job.model].location)
+        sets = core_sets(job.processes)
+        context = multiprocessing.get_context("spawn")
+        cores = context.Queue()
+        for assigned in sets:
+            cores.put(assigned)
+
+        output:Optional[np.memmap] = None
+        if job.progress.done and Path(job.output).exists():
+            output = np.lib.format.open_memmap(job.output, mode="r+")
+
+        inputs = read_inputs(Path(job.input), skip=job.progress.done)
+        pending = deque[tuple[int, Future]]() # the first row of the shard, its encoding
+        resumed_from = next_row = job.progress.done
+        started = saved_at = time.monotonic()
+        with ProcessPoolExecutor(len(sets), mp_context=context, initializer=_init_encoder,
+                                 initargs=(location, EMBEDDING_JOB_DEVICE, job.dimensions, cores, EMBEDDING_JOB_NICENESS)) as executor:
+            while True:
+                # Keeps every encoder busy with a second shard queued, unless the interactive requests need the cores
+                while len(pending) < 2 * len(sets) and not self._should_stop(job.id):
+                    if self.busy():
+                        if pending:
+                            break
+                        time.sleep(0.05)
+                        continue
+                    shard = [text for _, text in zip(range(EMBEDDING_JOB_SHARD_SIZE), inputs)]
+                    if not shard:
+                        break
+                    pending.append((next_row, executor.submit(_encode_shard, shard)))
+                    next_row += len(shard)
+                if not pending:
+                    break
+
+                row, future = pending.popleft()
+                embeddings = future.result()
+                if output is None:
+                    Path(job.output).parent.mkdir(parents=True, exist_ok=True)
+                    output = np.lib.format.open_memmap(job.output, mode="w+", dtype=np.float32, shape=(job.progress.total, embeddings.shape[1]))
+                output[row:row + len(embeddings)] = embeddings
+                job.progress.done = row + len(embeddings)
+                job.progress.inputs_per_second = (job.progress.done - resumed_from) / max(time.monotonic() - started, 1e-9)
+                if time.monotonic() - saved_at > EMBEDDING_JOB_SAVE_INTERVAL:
+                    # Flushed before the progress is saved, so that a resumed job never skips unwritten rows
+                    output.flush()
+                    self.save(job)
+                    saved_at = time.monotonic()
+        if output is not None:
+            output.flush()
+        METRICS.set("embedding_job_inputs_per_second", job.progress.inputs_per_second, model=job.model)
@@ -0,0 +1,116 @@
+import os
+import json
+import struct
+from collections import Counter
+from pathlib import Path
+from pydantic import BaseModel
+from typing import Optional
+import logging
+
+logger = logging.getLogger(__name__)
+
+SAFETENSORS_DTYPE_BYTES = {
+    "F64": 8, "I64": 8, "U64": 8,
+    "F32": 4, "I32": 4, "U32": 4,
+    "F16": 2, "BF16": 2, "I16": 2, "U16": 2,
+    "F8_E4M3": 1, "F8_E5M2": 1, "I8": 1, "U8": 1, "BOOL": 1,
+}
+SAFETENSORS_DTYPE_NAMES = {
+    "F64": "float64", "F32": "float32", "F16": "float16", "BF16": "bfloat16",
+    "F8_E4M3": "float8_e4m3fn", "F8_E5M2": "float8_e5m2", "I8": "int8", "U8": "uint8",
+}
+TORCH_DTYPE_BYTES = {
+    "float64": 8, "float32": 4, "float": 4, "float16": 2, "half": 2, "bfloat16": 2,
+    "float8_e4m3fn": 1, "float8_e5m2": 1, "int8": 1, "uint8": 1,
+}
+
+class ModelFootprint(BaseModel):
+    parameters: Optional[int] = None
+    """The number of parameters, from the safetensors headers."""
+
+    dtype: Optional[str] = None
+    """The dominant dtype of the stored weights e.g. bfloat16."""
+
+    weights_bytes: int = 0
+    """The size of the weights, as stored."""
+
+    disk_bytes: int = 0
+    """The size of all the model's files."""
+
+    context_length: Optional[int] = None
+    """The maximal number of positions (tokens) of the model."""
+
+    num_layers: Optional[int] = None
+    """The number of hidden (transformer) layers."""
+
+    kv_bytes_per_token: Optional[int] = None
+    """The size of the KV cache of a single token, across all the layers, in the stored dtype."""
+
+    def weights_bytes_as(self, dtype:Optional[str]) -> int:
+        """The size of the weights once loaded as the given dtype ("auto" or None keep the stored dtype)."""
+        if not dtype or dtype == "auto" or self.parameters is None or dtype not in TORCH_DTYPE_BYTES:
+            return self.weights_bytes
+        return self.parameters * TORCH_DTYPE_BYTES[dtype]
+
+def read_safetensors_header(path:Path) -> dict:
+    with path.open("rb") as f:
+        (length,) = struct.unpack("<Q", f.read(8))
+        # A corrupt (or non safetensors) file would otherwise have its whole length, or more, read as the header
+        if length > os.fstat(f.fileno()).st_size - 8:
+            raise ValueError(f"The header of {path} is longer than the file")
+        return json.loads(f.read(length))
+
+def _text_config(config:dict) -> dict:
+    # Multi-modal models nest the language model's configuration
+    return config.get("text_config") or config.get("llm_config") or config
+
+def estimate_footprint(location:Path) -> ModelFootprint:
+    """Estimate the footprint of a model from its config.json and safetensors headers, without loading the weights."""
+    location = Path(location)
+    footprint = ModelFootprint()
+    files = [path for path in location.rglob("*") if path.is_file() and ".cache" not in path.parts]
+    footprint.disk_bytes = sum(path.stat().st_size for path in files)
+
+    parameters = 0
+    dtype_bytes = Counter[str]()
+    safetensors = [path for path in files if path.suffix == ".safetensors" and path.parent == location]
+    for shard in safetensors:
+        try:
+            header = read_safetensors_header(shard)
+        except (OSError, ValueError, struct.error) as ex:
+            logger.warning("Failed to read the safetensors header of %s: %s", shard, ex)
+            continue
+        for name, tensor in header.items():
+            if name == "__metadata__":
+                continue
+            count = 1
+            for dim in tensor["shape"]:
+                count *= dim
+            parameters += count
+            dtype_bytes[tensor["dtype"]] += tensor["data_offsets"][1] - tensor["data_offsets"][0]
+
+    if dtype_bytes:
+        footprint.parameters = parameters
+        footprint.weights_bytes = sum(dtype_bytes.values())
+        dominant = dtype_bytes.most_common(1)[0][0]
+        footprint.dtype = SAFETENSORS_DTYPE_NAMES.get(dominant, dominant.lower())
+    else:
+        footprint.weights_bytes = sum(path.stat().st_size for path in files if path.suffix in (".bin", ".pt", ".pth", ".ckpt"))
+
+    config_path = location / "config.json"
+    if config_path.exists():
+        with config_path.open() as f:
+            config = _text_config(json.load(f))
+        footprint.dtype = footprint.dtype or config.get("torch_dtype")
+        footprint.context_length = config.get("max_position_embeddings") or config.get("n_positions") or config.get("max_seq_len")
+        footprint.num_layers = config.get("num_hidden_layers") or config.get("n_layer") or config.get("num_layers")
+        heads = config.get("num_attention_heads") or config.get("n_head")
+        kv_heads = config.get("num_key_value_heads") or heads
+        hidden_size = config.get("hidden_size") or config.get("n_embd")
+        head_dim = config.get("head_dim") or (hidden_size // heads if hidden_size and heads else None)
+        if footprint.num_layers and kv_heads and head_dim:
+            element_bytes = TORCH_DTYPE_BYTES.get(footprint.dtype, 2)
+            # Keys and values, for every layer
+            footprint.kv_bytes_per_token = 2 * footprint.num_layers * kv_heads * head_dim * element_bytes
+
+    return footprint
@@ -0,0 +1,418 @@
+import os
+import time
+import uuid
+import shutil
+import asyncio
+import threading
+from abc import ABC, abstractmethod
+from pathlib import Path
+from pydantic import BaseModel, Field
+from typing import Callable, Literal, Optional
+from services.internal.action_manager import ActionManager
+from services.internal.registry import Models
+from services.internal.blobs import BlobStore
+from services.internal.job_claims import JobClaims
+from services.internal.metrics import METRICS
+import logging
+
+logger = logging.getLogger(__name__)
+
+# The number of models that are imported at the same time, the other jobs are queued
+IMPORT_CONCURRENCY = int(os.getenv("SERVICES_IMPORT_CONCURRENCY", "1"))
+# Partial downloads are kept under this (hidden) directory of the hub cache, so that the registry doesn't see them
+IMPORTS_STAGING_DIR = ".imports"
+# The job state is persisted at most once in this number of seconds while downloading
+IMPORT_SAVE_INTERVAL = 1.0
+
+JobState = Literal["queued", "running", "succeeded", "failed", "cancelled"]
+
+class ImportCancelled(Exception):
+    pass
+
+class HubFile(BaseModel):
+    path: str
+    size: int
+
+class ImportProgress(BaseModel):
+    total_files: int = 0
+    downloaded_files: int = 0
+    total_bytes: int = 0
+    downloaded_bytes: int = 0
+
+class ImportJob(BaseModel):
+    id: str
+    model_id: str
+    revision: Optional[str] = None
+    """The requested revision, replaced by the resolved commit once the files were listed."""
+
+    state: JobState = "queued"
+    progress: ImportProgress = Field(default_factory=ImportProgress)
+    error: Optional[str] = None
+    created: float = Field(default_factory=time.time)
+    updated: float = Field(default_factory=time.time)
+
+    @property
+    def finished(self) -> bool:
+        return self.state in ("succeeded", "failed", "cancelled")
+
+class Hub(ABC):
+    @abstractmethod
+    def list_files(self, model_id:str, revision:Optional[str], token:Optional[str]) -> tuple[str, list[HubFile]]:
+        """The resolved revision of the model, and its files."""
+
+    @abstractmethod
+    def download(self, model_id:str, file:HubFile, revision:str, local_dir:Path, token:Optional[str],
+                 on_bytes:Callable[[int], None], should_stop:Callable[[], bool]):
+        """Download a file into local_dir, resuming a partial download, and reporting the bytes as they are written."""
+
+class HuggingFaceHub(Hub):
+    def list_files(self, model_id:str, revision:Optional[str], token:Optional[str]) -> tuple[str, list[HubFile]]:
+        from huggingface_hub import HfApi
+        info = HfApi().model_info(model_id, revision=revision, files_metadata=True, token=token)
+        return info.sha, [HubFile(path=sibling.rfilename, size=sibling.size or 0) for sibling in info.siblings]
+
+    def download(self, model_id:str, file:HubFile, revision:str, local_dir:Path, token:Optional[str],
+                 on_bytes:Callable[[int], None], should_stop:Callable[[], bool]):
+        from huggingface_hub import hf_hub_download
+        from tqdm import tqdm
+        lock = threading.Lock()
+        reported = 0
+
+        def report(done:int):
+            nonlocal reported
+            with lock:
+                done = min(done, file.size)
+                if done > reported:
+                    on_bytes(done - reported)
+                    reported = done
+
+        class Progress(tqdm):
+            # The bytes are reported through the progress bars of the download (a file downloaded through Xet has two,
+            # the furthest one counts), which is stopped by raising from them, keeping the .incomplete file to resume
+            def __init__(self, *args, initial:int = 0, **kwargs):
+                super().__init__(*args, initial=initial, disable=True, **kwargs)
+                self.done = initial
+                report(self.done)
+
+            def update(self, n:int = 1):
+                self.done += n
+                report(self.done)
+                if should_stop():
+                    raise ImportCancelled()
+
+        # Resumes from the .incomplete file of an interrupted download
+        hf_hub_download(model_id, file.path, revision=revision, local_dir=str(local_dir), token=token, tqdm_class=Progress)
+        report(file.size)
+
+class LocalDirectoryHub(Hub):
+    def __init__(self, root:Path, chunk_size:int = 1024 * 1024):
+        """A stand-in for the hub, that serves the models of a local directory laid out as <root>/<provider>/<model>."""
+        self.root = Path(root)
+        self.chunk_size = chunk_size
+
+    def list_files(self, model_id:str, revision:Optional[str], token:Optional[str]) -> tuple[str, list[HubFile]]:
+        model_dir = self.root / model_id
+        if not model_dir.is_dir():
+            raise FileNotFoundError(f"No such model: {model_id}")
+        files = [
+            HubFile(path=path.relative_to(model_dir).as_posix(), size=path.stat().st_size)
+            for path in sorted(model_dir.rglob("*")) if path.is_file()]
+        return revision or "local", files
+
+    def download(self, model_id:str, file:HubFile, revision:str, local_dir:Path, token:Optional[str],
+                 on_bytes:Callable[[int], None], should_stop:Callable[[], bool]):
+        target = local_dir / file.path
+        partial = target.with_name(target.name + ".incomplete")
+        target.parent.mkdir(parents=True, exist_ok=True)
+        offset = partial.stat().st_size if partial.exists() else 0
+        if offset:
+            on_bytes(offset)
+        with (self.root / model_id / file.path).open("rb") as source, partial.open("ab") as destination:
+            source.seek(offset)
+            while chunk := source.read(self.chunk_size):
+                if should_stop():
+                    raise ImportCancelled()
+                destination.write(chunk)
+                on_bytes(len(chunk))
+        partial.replace(target)
+
+class ImportJobs:
+    def __init__(self, registry:Models, hub:Hub, jobs_dir:Optional[Path] = None, concurrency:int = IMPORT_CONCURRENCY,
+                 blobs:Optional[BlobStore] = None):
+        """
+        Imports models into the registry in the background, through an `ActionManager` that runs on its own thread.
+        Jobs are persisted, so those that were interrupted (e.g. by a restart) can be resumed, skipping the downloaded files.
+        The worker processes share the jobs through `jobs_dir`, each job is run by the process that claimed it (see `JobClaims`).
+
+        Args:
+            registry(Models): The registry the models are imported into.
+            hub(Hub): Where the models are downloaded from.
+            jobs_dir(Path): Where the jobs are persisted, defaults to <HF_HOME>/services/imports.
+            concurrency(int): See `IMPORT_CONCURRENCY`.
+            blobs(BlobStore): The imported files are linked to its blobs, None to keep them as downloaded.
+        """
+        self.registry = registry
+        self.hub = hub
+        self.jobs_dir = Path(jobs_dir or registry.cache_root.parent / "services" / "imports")
+        self.concurrency = concurrency
+        self.blobs = blobs
+        self.jobs = dict[str, ImportJob]()
+        self.claims = JobClaims(self.jobs_dir)
+        self.tokens = dict[str, str]() # Kept in memory only, so resuming a gated model after a restart requires the token again
+        self.cancelled = set[str]()
+        self.stopping = threading.Event()
+        self.manager:Optional[ActionManager] = None
+        self._thread:Optional[threading.Thread] = None
+        self._lock = threading.RLock()
+        self.load()
+
+    def load(self):
+        """Read the jobs as they were last saved, including those of the other worker processes."""
+        if not self.jobs_dir.exists():
+            return
+        for path in self.jobs_dir.glob("*.json"):
+            job = self._read(path)
+            if job is not None:
+                with self._lock:
+                    if job.id not in self.claims.held:
+                        self.jobs[job.id] = job
+
+    def _read(self, path:Path) -> Optional[ImportJob]:
+        try:
+            job = ImportJob.model_validate_json(path.read_text())
+        except (OSError, ValueError) as ex:
+            logger.warning("Ignoring the import job %s: %s", path, ex)
+            return None
+        if not job.finished and not self.claims.is_claimed(job.id):
+            # Interrupted, until it's resumed
+            job.state = "failed"
+            job.error = "Interrupted"
+        return job
+
+    def get(self, job_id:str) -> ImportJob:
+        """
+        The job, as it was last saved by the process that runs it, when that's another worker process.
+
+        Raises:
+            KeyError: There's no such job.
+        """
+        with self._lock:
+            if job_id in self.claims.held:
+                return self.jobs[job_id]
+        job = self._read(self.jobs_dir / f"{job_id}.json") if (self.jobs_dir / f"{job_id}.json").exists() else None
+        with self._lock:
+            if job is not None and job_id not in self.claims.held:
+                self.jobs[job_id] = job
+            return self.jobs[job_id]
+
+    def save(self, job:ImportJob):
+        job.updated = time.time()
+        try:
+            self.jobs_dir.mkdir(parents=True, exist_ok=True)
+            staging = self.jobs_dir / f"{job.id}.json.tmp"
+            staging.write_text(job.model_dump_json())
+            staging.replace(self.jobs_dir / f"{job.id}.json")
+        except OSError as ex:
+            logger.warning("Failed to save the import job %s: %s", job.id, ex)
+
+    def start(self):
+        with self._lock:
+            if self.manager is not None:
+                return
+            self.stopping.clear()
+            self.manager = ActionManager(self.concurrency, force_new_loop=True)
+            self._thread = threading.Thread(target=self.manager.loop.run_forever, name="imports", daemon=True)
+            self._thread.start()
+            self.manager.loop.call_soon_threadsafe(self.manager.start)
+
+    def stop(self):
+        with self._lock:
+            if self.manager is None:
+                return
+            # Running downloads stop at their next chunk, and are resumed by `resume_interrupted`
+            self.stopping.set()
+            self.manager.loop.call_soon_threadsafe(self.manager.loop.stop)
+            self._thread.join(timeout=10)
+            self.manager = None
+            self._thread = None
+
+    def submit(self, model_id:str, revision:Optional[str] = None, token:Optional[str] = None) -> ImportJob:
+        job = ImportJob(id=str(uuid.uuid4()), model_id=model_id, revision=revision)
+        with self._lock:
+            self.claims.claim(job.id)
+            self.jobs[job.id] = job
+            if token:
+                self.tokens[job.id] = token
+        self.save(job)
+        self._schedule(job)
+        return job
+
+    def resume(self, job_id:str, token:Optional[str] = None) -> ImportJob:
+        """Run a failed or cancelled job again, the files it already downloaded are kept."""
+        with self._lock:
+            running = job_id in self.claims.held
+            if not running and not self.claims.claim(job_id):
+                raise ValueError(f"Import job {job_id} is run by another worker process, it can't be resumed")
+            job = self.jobs.get(job_id) if running else self._read(self.jobs_dir / f"{job_id}.json") or self.jobs.get(job_id)
+            if job is None:
+                self.claims.release(job_id)
+                raise KeyError(job_id)
+            if not running and not job.finished:
+                # Saved last by a process that no longer runs it
+                job.state = "failed"
+                job.error = "Interrupted"
+            self.jobs[job_id] = job
+            if not job.finished or job.state == "succeeded":
+                if not running:
+                    self.claims.release(job_id)
+                raise ValueError(f"Import job {job_id} is {job.state}, it can't be resumed")
+            self.claims.clear_cancel(job_id)
+            if token:
+                self.tokens[job.id] = token
+            self.cancelled.discard(job.id)
+            job.state = "queued"
+            job.error = None
+        self.save(job)
+        self._schedule(job)
+        return job
+
+    def resume_interrupted(self) -> list[ImportJob]:
+        """Resume the interrupted jobs, that no other worker process resumed (or runs) already."""
+        self.load()
+        resumed = list[ImportJob]()
+        for job in list(self.jobs.values()):
+            if job.state == "failed" and job.error == "Interrupted":
+                try:
+                    resumed.append(self.resume(job.id))
+                except ValueError:
+                    continue
+        return resumed
+
+    def cancel(self, job_id:str) -> ImportJob:
+        """Cancel a job, a queued job doesn't start, and a running job stops at its next chunk (or file)."""
+        with self._lock:
+            job = self.get(job_id)
+            if not job.finished:
+                self.cancelled.add(job_id)
+                if job_id not in self.claims.held:
+                    self.claims.request_cancel(job_id)
+                elif job.state == "queued":
+                    job.state = "cancelled"
+                    self.save(job)
+        return job
+
+    def _schedule(self, job:ImportJob):
+        self.start()
+        self.manager.loop.call_soon_threadsafe(
+            lambda: self.manager.schedule(self._run, job.id, id=f"import {job.id}"))
+        METRICS.increment("import_jobs_submitted")
+
+    def staging_dir(self, model_id:str) -> Path:
+        return self.registry.cache_root / IMPORTS_STAGING_DIR / model_id
+
+    def _cancelled(self, job_id:str) -> bool:
+        # Or by another worker process
+        if job_id not in self.cancelled and self.claims.cancel_requested(job_id):
+            self.cancelled.add(job_id)
+        return job_id in self.cancelled
+
+    def _should_stop(self, job_id:str) -> bool:
+        return self._cancelled(job_id) or self.stopping.is_set()
+
+    def _run(self, job_id:str):
+        job = self.jobs[job_id]
+        with self._lock:
+            if self._cancelled(job_id):
+                job.state = "cancelled"
+                self.save(job)
+                self.claims.release(job_id)
+                return
+            if job.state != "queued":
+                # Scheduled twice e.g. resumed while still queued
+                return
+            job.state = "running"
+        self.save(job)
+        token = self.tokens.get(job_id)
+        try:
+            revision, files = self.hub.list_files(job.model_id, job.revision, token)
+            job.revision = revision
+            job.progress = ImportProgress(total_files=len(files), total_bytes=sum(file.size for file in files))
+            staging = self.staging_dir(job.model_id)
+            target = self.registry.cache_root / job.model_id
+            saved_at = time.monotonic()
+
+            def on_bytes(count:int):
+                nonlocal saved_at
+                job.progress.downloaded_bytes += count
+                if time.monotonic() - saved_at > IMPORT_SAVE_INTERVAL:
+                    saved_at = time.monotonic()
+                    self.save(job)
+
+            for file in files:
+                if self._should_stop(job_id):
+                    raise ImportCancelled()
+                # Downloaded before the interruption, or already imported
+                done = next((d / file.path for d in (staging, target) if (d / file.path).exists() and (d / file.path).stat().st_size == file.size), None)
+                if done is None:
+                    self.hub.download(job.model_id, file, revision, staging, token, on_bytes, lambda: self._should_stop(job_id))
+                else:
+                    job.progress.downloaded_bytes += file.size
+                job.progress.downloaded_files += 1
+                self.save(job)
+
+            self.publish(staging, target)
+            self.registry.refresh({job.model_id})
+            if self.blobs is not None:
+                self.dedupe()
+            if job.model_id not in self.registry.models:
+                raise ValueError(f"{job.model_id} was imported, but it isn't an auto-configurable model")
+            job.state = "succeeded"
+            METRICS.increment("import_jobs_succeeded")
+        except ImportCancelled:
+            if self._cancelled(job_id):
+                logger.info("Cancelled the import of %s", job.model_id)
+                job.state = "cancelled"
+            else:
+                logger.info("Interrupted the import of %s", job.model_id)
+                job.state = "failed"
+                job.error = "Interrupted"
+        except Exception as ex:
+            logger.exception("Failed to import %s: %s", job.model_id, ex)
+            job.state = "failed"
+            job.error = str(ex)
+            METRICS.increment("import_jobs_failed")
+        finally:
+            self.save(job)
+            self.claims.release(job_id)
+
+    def dedupe(self):
+        """Link the imported files that are identical to other models' files to a single blob, and remove the unlinked blobs."""
+        try:
+            report = self.blobs.scan(self.registry.cache_root / model_id for model_id in list(self.registry.models.keys()))
+            if report.reclaimable_bytes:
+                self.blobs.dedupe(report)
+            self.blobs.collect_garbage()
+        except OSError as ex:
+            logger.warning("Failed to deduplicate the model files: %s", ex)
+        self.blobs.save()
+
+    @staticmethod
+    def publish(staging:Path, target:Path):
+        """Move the downloaded files into the model directory, the configuration files last, so that a model is never seen half imported."""
+        if not staging.exists():
+            return
+        files = sorted((path for path in staging.rglob("*") if path.is_file()), key=lambda path: path.suffix == ".json")
+        for path in files:
+            destination = target / path.relative_to(staging)
+            destination.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(path, destination)
+        shutil.rmtree(staging, ignore_errors=True)
+
+    async def events(self, job_id:str, interval:float = 1.0):
+        """Yield the job every interval, until it's finished."""
+        while True:
+            job = self.get(job_id)
+            yield job
+            if job.finished:
+                return
+            await asyncio.sleep(interval)
@@ -1,11 +1,26 @@
+import os
+import time
+import numpy as np
 from abc import ABC
+from collections import Counter, OrderedDict
+from contextlib import contextmanager, nullcontext
 from uuid import UUID, uuid4
 from pydantic import BaseModel, Field
-from threading import Thread
-from transformers import TextIteratorStreamer
-from typing import AsyncIterator, Self, Any, Union, Literal
+from threading import Thread, RLock, Condition
+from transformers import TextIteratorStreamer, StoppingCriteriaList
+from typing import AsyncIterator, Iterator, Optional, Self, Any, Union, Literal
 from services.internal.registry import Models
-from services.internal.loader import LoadedModel, SUPPORTED
+from services.internal.loader import (
+    LoadedModel, 
+    SUPPORTED, 
+    AutoModelForCausalLMLoader, 
+    ImageTextToTextModelLoader, 
+    SentenceTransformerLoader,
+    CrossEncoderLoader
+)
+from services.internal.metrics import METRICS
+from services.internal.rerank import RERANK_BATCH_TOKENS, dynamic_batches
+from services.internal.stopping import RunawayGenerationConfig, RunawayGenerationCriteria
 import logging
 
 logger = logging.getLogger(__name__)
@@ -13,6 +28,7 @@ logger = logging.getLogger(__name__)
 DEFAULT_LOADER_CONFIG = {
     "ibm-granite/granite-embedding-278m-multilingual":  { "max_length":768 },
     "sentence-transformers/all-MiniLM-L6-v2":  { "max_length":384 },
+    "cross-encoder/ms-marco-MiniLM-L6-v2":  { "max_length":512 },
 
     "Qwen/Qwen3-4B": {"max_new_tokens":32768},
     "meta-llama/Llama-3.2-1B-Instruct": {"max_new_tokens":32768},
@@ -26,6 +42,17 @@ CUSTOMIZE_PROMPTS = {
     
 }
 
+# Detection of degenerate repetition loops, by model id (None disables the detection), see RunawayGenerationConfig
+DEFAULT_RUNAWAY_GENERATION_CONFIG = RunawayGenerationConfig()
+RUNAWAY_GENERATION_CONFIG = {
+    "meta-llama/Llama-3.2-1B-Instruct": RunawayGenerationConfig(min_repeats=3, entropy_threshold=0.05),
+}
+
+# The number of LoRA adapters kept attached to a resident base model, before the least recently used is detached
+MAX_RESIDENT_ADAPTERS = int(os.getenv("SERVICES_MAX_RESIDENT_ADAPTERS", "4"))
+# The adapter name of the rows that the base model generates, in PEFT's mixed adapter batches
+BASE_ADAPTER = "__base__"
+
 class Message(BaseModel):
     role:str
     content:Union[str,list[str]]
@@ -55,6 +82,12 @@ class Dialog(BaseModel):
     thinking_content:Union[str,list[str]] = ""
     content:Union[str,list[str]] = ""
     images:list = Field(default_factory=list)
+    finish_reason:Union[str,list[str]] = None
+    model_id:str = None # The model, or adapter of the served base model, that responds (defaults to the base model)
+    deadline:float = None # Unix timestamp (in seconds) at which the generation stops, and returns the partial response
+    deadline_exceeded:bool = False
+    started_at:float = None
+    completed_at:float = None
 
     def process_part_of_iteration(self, content:str):
         if not content:
@@ -76,6 +109,10 @@ class Dialog(BaseModel):
         self.thinking = False
         self.content = ""
         self.latest_response = None
+        self.finish_reason = None
+        self.deadline_exceeded = False
+        self.started_at = time.time()
+        self.completed_at = None
         if len(self.history) == 0 or self.history[-1] != self.user_input:
             self.history.append(self.user_input)
 
@@ -88,10 +125,16 @@ class Dialog(BaseModel):
 
         self.latest_response = Message(role="assistant", content=self.content)
         self.history.append(self.latest_response)
+        self.completed_at = time.time()
+        if self.deadline is not None and self.completed_at >= self.deadline:
+            self.deadline_exceeded = True
 
         return self
     
 class BaseInference(ABC):
+    # The loaders of the models that this inference can serve
+    LOADERS:tuple[type, ...] = ()
+
     def __init__(self, registry:Models):
         self.registry = registry
         self.loader = None
@@ -107,11 +150,20 @@ class BaseInference(ABC):
             self.loaded = None
             self.ready = False
 
+    def hibernate(self) -> bool:
+        return self.ready and self.loader.hibernate(self.loaded)
+
+    def wake(self):
+        if self.ready:
+            self.loader.wake(self.loaded)
+
     def serve(self, model_id:str, **kwargs):
         if model_id not in SUPPORTED:
             raise NotImplementedError("model_id: % is not supported yet", model_id)
 
         if self.ready:
+            if self.model_id == model_id:
+                return
             raise ValueError("Already serving %s", self.model_id)
 
         model_info = self.registry.models[model_id]
@@ -123,29 +175,229 @@ class BaseInference(ABC):
         self.ready = True
 
 class EmbeddingsInference(BaseInference):
+    LOADERS = (SentenceTransformerLoader,)
+
     def encode(self, sentances:list[str], **kwargs) -> list:
         arguments = {**self.loader.generation_kwargs, **kwargs}
 
-        return self.loaded.entry_point_model.encode(sentances, **arguments)
+        with self.loader.execution_context(self.loaded):
+            return self.loaded.entry_point_model.encode(sentances, **arguments)
     
     def similarity(self, embedings1:list, embedings2:list, similarity_function:str = None) -> list[list]:
+        from sentence_transformers import SimilarityFunction
         if similarity_function is None:
             similarity_function = "euclidean"
-        self.loaded.entry_point_model.similarity_fn_name = similarity_function
-        return self.loaded.entry_point_model.similarity(embedings1, embedings2)
+        # Not set on the model, which is shared by the concurrent requests
+        return SimilarityFunction.to_similarity_fn(SimilarityFunction(similarity_function))(embedings1, embedings2)
+
+class RerankInference(BaseInference):
+    LOADERS = (CrossEncoderLoader,)
+
+    def rank(self, query:str, passages:list[str], max_batch_tokens:int = RERANK_BATCH_TOKENS) -> tuple[np.ndarray, int]:
+        """
+        Score the relevance of each passage to the query, in batches of pairs of similar lengths (see `dynamic_batches`).
+
+        Returns:
+            tuple: The scores, in the order of the passages, and the number of tokens of the (truncated) pairs.
+        """
+        model = self.loaded.entry_point_model
+        if not passages:
+            return np.zeros(0, dtype=np.float32), 0
+        lengths = [len(input_ids) for input_ids in self.loaded.pre_processor_model(
+            [query] * len(passages), passages, truncation=True, max_length=model.max_length)["input_ids"]]
+
+        scores = np.zeros(len(passages), dtype=np.float32)
+        with self.loader.execution_context(self.loaded):
+            for batch in dynamic_batches(lengths, max_batch_tokens):
+                scores[batch] = model.predict([(query, passages[i]) for i in batch], batch_size=len(batch), show_progress_bar=False, convert_to_numpy=True)
+                METRICS.observe("rerank_batch_pairs", len(batch), buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256), model=self.model_id)
+        return scores, sum(lengths)
+
+class AdapterManager:
+    def __init__(self, registry:Models, loaded:LoadedModel, max_adapters:int = MAX_RESIDENT_ADAPTERS):
+        """
+        Keeps the base model weights resident, and attaches/detaches LoRA adapters on top of them.
+
+        Args:
+            registry(Models): The registry in which the adapters are declared (see `ModelCard.adapter_of`).
+            loaded(LoadedModel): The loaded base model.
+            max_adapters(int): The number of attached adapters, after which the least recently used one is detached.
+        """
+        self.registry = registry
+        self.loaded = loaded
+        self.max_adapters = max_adapters
+        self.peft_model = None
+        self.adapters = OrderedDict[str, str]() # adapter model id -> adapter name, in least recently used order
+        self.in_use = Counter[str]() # model id (the base model's or an adapter's) -> running generations
+        # Guards the attached adapters, the generations select their adapter per row (see `activate`) and run concurrently
+        self._lock = RLock()
+        self._released = Condition(self._lock)
+
+    @staticmethod
+    def adapter_name(model_id:str) -> str:
+        # PEFT uses the adapter name as a module attribute name
+        return model_id.replace("/", "--").replace(".", "_")
+
+    def attach(self, model_id:str) -> str:
+        """Attach the adapter (if it's not attached yet) and mark it as the most recently used.
+
+        Returns:
+            str: The adapter name.
+        """
+        with self._lock:
+            if self.peft_model is None and model_id not in self.adapters:
+                # Wrapping the base model injects the adapter layers into it, not under the generations that use it directly
+                self._released.wait_for(lambda: self.peft_model is not None or not self.in_use[self.loaded.model_id])
+            if model_id in self.adapters:
+                self.adapters.move_to_end(model_id)
+                return self.adapters[model_id]
+
+            # The adapters that generations use aren't detached, so that many may be attached for a while
+            for evicted in [attached for attached in self.adapters if not self.in_use[attached]]:
+                if len(self.adapters) < self.max_adapters:
+                    break
+                self.detach(evicted)
+
+            name = self.adapter_name(model_id)
+            location = str(self.registry.models[model_id].location)
+            if self.peft_model is None:
+                from peft import PeftModel
+                self.peft_model = PeftModel.from_pretrained(self.loaded.entry_point_model, location, adapter_name=name, is_trainable=False)
+                self.peft_model.eval()
+            else:
+                self.peft_model.load_adapter(location, adapter_name=name, is_trainable=False)
+            self.adapters[model_id] = name
+            logger.info("Attached adapter %s to %s (%d attached)", model_id, self.loaded.model_id, len(self.adapters))
+            return name
+
+    def detach(self, model_id:str):
+        with self._lock:
+            name = self.adapters.pop(model_id, None)
+            if name is not None:
+                self.peft_model.delete_adapter(name)
+                logger.info("Detached adapter %s from %s", model_id, self.loaded.model_id)
+
+    def clear(self):
+        with self._lock:
+            for model_id in list(self.adapters.keys()):
+                self.detach(model_id)
+            self.peft_model = None
+
+    @contextmanager
+    def activate(self, model_id:str) -> Iterator[tuple[Any, Optional[str]]]:
+        """
+        Yield the model to generate with, and the name of the adapter (`BASE_ADAPTER` for the base model) that its
+        rows use, None when no adapter is attached. The adapter is selected per row through PEFT's mixed adapter batches
+        rather than enabled on the shared model, so the generations of the base model and of its adapters run concurrently.
+        """
+        with self._lock:
+            name = BASE_ADAPTER if model_id == self.loaded.model_id else self.attach(model_id)
+            self.in_use[model_id] += 1
+            model = self.peft_model if self.peft_model is not None else self.loaded.entry_point_model
+        try:
+            yield model, name if self.peft_model is not None else None
+        finally:
+            with self._lock:
+                self.in_use[model_id] -= 1
+                self._released.notify_all()
 
 class TransformerInference(BaseInference):
+    LOADERS = (AutoModelForCausalLMLoader, ImageTextToTextModelLoader)
+
     def __init__(self, registry:Models):
         super().__init__(registry)
         self.history = []
+        self.adapters:AdapterManager = None
 
     def reset(self):
         if self.ready:
+            self.adapters.clear()
+            self.adapters = None
             super().reset()
             self.history.clear()
 
+    def is_serving(self, model_id:str) -> bool:
+        """Check whether the model, or the base model of the adapter, is already resident."""
+        return self.ready and self.registry.base_model_of(model_id) == self.model_id
+
     def serve(self, model_id:str, **kwargs):
-        super().serve(model_id, **kwargs)
+        """Serve the model, or the base model of the adapter with the adapter attached (it's selected by `Dialog.model_id`)."""
+        base_model_id = self.registry.base_model_of(model_id)
+        if not self.is_serving(model_id):
+            super().serve(base_model_id, **kwargs)
+            self.adapters = AdapterManager(self.registry, self.loaded)
+
+        if model_id != base_model_id:
+            self.adapters.attach(model_id)
+
+    def responding_model(self, dialog:Dialog) -> str:
+        return dialog.model_id or self.model_id
+
+    def _guard_generation(self, model_inputs:dict, config_kwargs:dict) -> RunawayGenerationCriteria:
+        config = RUNAWAY_GENERATION_CONFIG.get(self.model_id, DEFAULT_RUNAWAY_GENERATION_CONFIG)
+        if config is None:
+            return None
+
+        guard = RunawayGenerationCriteria(model_inputs["input_ids"].shape[-1], config, self._padding_token_ids())
+        config_kwargs["stopping_criteria"] = StoppingCriteriaList([*config_kwargs.get("stopping_criteria", []), guard])
+        return guard
+
+    def _apply_deadline(self, dialog:Dialog, config_kwargs:dict):
+        if dialog.deadline is None:
+            return
+
+        remaining = dialog.deadline - time.time()
+        if remaining <= 0:
+            METRICS.increment("generation_deadline_dropped", model=self.responding_model(dialog))
+            raise TimeoutError("The deadline was exceeded before the generation started")
+        config_kwargs["max_time"] = min(remaining, config_kwargs.get("max_time", remaining))
+
+    def _finish_reason(self, guard:RunawayGenerationCriteria, index:int, generated_tokens:int, max_new_tokens:int, dialog:Dialog) -> str:
+        if guard is not None and index in guard.triggered:
+            METRICS.increment("generation_runaway_aborted", model=self.responding_model(dialog))
+            return "repetition"
+        if dialog.deadline is not None and time.time() >= dialog.deadline:
+            METRICS.increment("generation_deadline_exceeded", model=self.responding_model(dialog))
+            return "length"
+        if generated_tokens is not None and max_new_tokens is not None and generated_tokens >= max_new_tokens:
+            return "length"
+        return "stop"
+
+    def _padding_token_ids(self) -> set[int]:
+        # The tokens that end a sequence, or pad it once it's finished
+        generation_config = self.loaded.entry_point_model.generation_config
+        padding = set[int]()
+        for token_ids in (generation_config.pad_token_id, generation_config.eos_token_id):
+            if token_ids is not None:
+                padding.update(token_ids if isinstance(token_ids, (list, tuple)) else [token_ids])
+        return padding
+
+    def _generated_tokens(self, output_ids:list[int], prompt_length:int) -> int:
+        # Sequences that finished before the longest one in the batch are right padded, with the EOS token when there's no pad token
+        generation_config = self.loaded.entry_point_model.generation_config
+        padding = generation_config.pad_token_id if generation_config.pad_token_id is not None else generation_config.eos_token_id
+        padding = set(padding if isinstance(padding, (list, tuple)) else [padding])
+        generated_tokens = len(output_ids) - prompt_length
+        while generated_tokens > 0 and output_ids[prompt_length + generated_tokens - 1] in padding:
+            generated_tokens -= 1
+        return generated_tokens
+
+    def _generate(self, dialog:Dialog, guard:RunawayGenerationCriteria, **generation_kwargs):
+        with self.loader.execution_context(self.loaded), self.adapters.activate(self.responding_model(dialog)) as (model, adapter_name):
+            # After waiting for the adapter to be attached, which isn't part of the generation's time
+            self._apply_deadline(dialog, generation_kwargs)
+            if adapter_name is not None:
+                generation_kwargs["adapter_names"] = [adapter_name] * self._batch_rows(generation_kwargs)
+            with guard.watching(model) if guard is not None else nullcontext():
+                return model.generate(**generation_kwargs)
+
+    @staticmethod
+    def _batch_rows(generation_kwargs:dict) -> int:
+        # PEFT expands the adapter names for beam search, but not for the sampled return sequences
+        rows = generation_kwargs["input_ids"].shape[0]
+        if (generation_kwargs.get("num_beams") or 1) <= 1:
+            rows *= generation_kwargs.get("num_return_sequences") or 1
+        return rows
 
     def process_messages_apply_prompt_template(self, dialog:Dialog):
         messages:list[Message] = [] + dialog.history
@@ -204,9 +456,20 @@ class TransformerInference(BaseInference):
                 **processor_kwargs
                 ).to(self.loaded.entry_point_model.device)
 
+            guard = self._guard_generation(model_inputs, config_kwargs)
+            self._apply_deadline(dialog, config_kwargs)
             streaming_generation_kwargs = { **dict(model_inputs, streamer=streamer), **config_kwargs}
+            errors = list[Exception]()
+
+            def generate():
+                try:
+                    self._generate(dialog, guard, **streaming_generation_kwargs)
+                except Exception as ex:
+                    errors.append(ex)
+                    # Ends the stream, which is waited for below
+                    streamer.end()
 
-            thread = Thread(target=self.loaded.entry_point_model.generate, kwargs=streaming_generation_kwargs)
+            thread = Thread(target=generate)
 
             thread.start()
             for message in streamer:
@@ -216,6 +479,10 @@ class TransformerInference(BaseInference):
                 if cancellable_callback and not cancellable_callback(message):
                     logger.info("Cancelling")
                     break
+            if errors:
+                raise errors[0]
+            dialog.finish_reason = self._finish_reason(
+                guard, 0, guard.generated_tokens if guard else None, config_kwargs.get("max_new_tokens"), dialog)
         except Exception as ex:
             logger.exception(ex)
             raise
@@ -235,17 +502,26 @@ class TransformerInference(BaseInference):
                 ).to(self.loaded.entry_point_model.device)
             
             config_kwargs = { **self.loader.generation_kwargs, **generation_kwargs }
+            guard = self._guard_generation(model_inputs, config_kwargs)
+            self._apply_deadline(dialog, config_kwargs)
 
-            generated_ids = self.loaded.entry_point_model.generate(
+            generated_ids = self._generate(
+                dialog,
+                guard,
                 **model_inputs, 
                 **config_kwargs
             )
             
             output_ids = generated_ids.tolist()
+            prompt_length = model_inputs["input_ids"].shape[-1]
+            finish_reasons = [
+                self._finish_reason(guard, i, self._generated_tokens(ids, prompt_length), config_kwargs.get("max_new_tokens"), dialog)
+                for i, ids in enumerate(output_ids)]
 
             if "num_return_sequences" in generation_kwargs and generation_kwargs["num_return_sequences"] > 1:
                 dialog.content = [None] * generation_kwargs["num_return_sequences"]
                 dialog.thinking_content = [None] * generation_kwargs["num_return_sequences"]
+                dialog.finish_reason = finish_reasons
                 for i in range(generation_kwargs["num_return_sequences"]):
                     if i >= len(output_ids):
                         while len(dialog.content) != len(output_ids):
@@ -261,6 +537,7 @@ class TransformerInference(BaseInference):
                         dialog.content[i] = parts[0]
 
             else:
+                dialog.finish_reason = finish_reasons[0]
                 content = self.loaded.post_processor_model.decode(output_ids[0], skip_special_tokens=True).strip("\n")
                 parts = content.split("</think>")
                 if len(parts) > 1:
@@ -275,4 +552,4 @@ class TransformerInference(BaseInference):
             raise
         finally:
             # Update history
-            dialog.complete_iteration()
\ No newline at end of file
+            dialog.complete_iteration()
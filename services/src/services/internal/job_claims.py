@@ -0,0 +1,59 @@
+import os
+import fcntl
+import threading
+from pathlib import Path
+
+class JobClaims:
+    def __init__(self, jobs_dir:Path):
+        """
+        Which process runs each job, through an exclusive lock on a file per job, so that the worker processes
+        (see services.serve) that share the jobs directory never run (or resume) the same job twice.
+        The OS releases the lock when its process dies, so an unfinished job that isn't claimed was interrupted.
+
+        Args:
+            jobs_dir(Path): The directory of the jobs, where the lock (and cancel) files are kept.
+        """
+        self.jobs_dir = Path(jobs_dir)
+        self.held = dict[str, int]() # job id -> the descriptor of its locked file
+        self._lock = threading.Lock()
+
+    def claim(self, job_id:str) -> bool:
+        """Claim the job for this process, unless another process did, a job stays claimed until it's released."""
+        with self._lock:
+            if job_id in self.held:
+                return True
+            self.jobs_dir.mkdir(parents=True, exist_ok=True)
+            fd = os.open(self.jobs_dir / f"{job_id}.lock", os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                return False
+            self.held[job_id] = fd
+            return True
+
+    def release(self, job_id:str):
+        with self._lock:
+            fd = self.held.pop(job_id, None)
+        if fd is not None:
+            os.close(fd)
+
+    def is_claimed(self, job_id:str) -> bool:
+        """Whether any process (this one included) claimed the job."""
+        if job_id in self.held:
+            return True
+        if not self.claim(job_id):
+            return True
+        self.release(job_id)
+        return False
+
+    def request_cancel(self, job_id:str):
+        """Ask the process that runs the job to cancel it, at its next check of `cancel_requested`."""
+        self.jobs_dir.mkdir(parents=True, exist_ok=True)
+        (self.jobs_dir / f"{job_id}.cancel").touch()
+
+    def cancel_requested(self, job_id:str) -> bool:
+        return (self.jobs_dir / f"{job_id}.cancel").exists()
+
+    def clear_cancel(self, job_id:str):
+        (self.jobs_dir / f"{job_id}.cancel").unlink(missing_ok=True)
@@ -1,61 +1,379 @@
+import os
+import time
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from pathlib import Path
 from pydantic import BaseModel
-from typing import Any
+from typing import Any, Iterator, Optional
 from services.internal.registry import Models, ModelCard
+from services.internal.metrics import METRICS
+from services.internal.footprint import estimate_footprint
+from services.internal.placement import Placement, plan_placement
+from services.internal import artifacts
 import logging
 
 # TODO: add quantization support e.g. https://huggingface.co/stabilityai/stable-diffusion-3.5-large-turbo
 
 logger = logging.getLogger(__name__)
 
+class ExecutionProfile(BaseModel):
+    name: str
+    device_map: Optional[str] = "auto"
+    torch_dtype: Optional[str] = "auto" # "bfloat16" is used only when supported by the CPU, otherwise "float32"
+    autocast_dtype: Optional[str] = None # Same as torch_dtype
+    attn_implementation: Optional[str] = None
+    inference_mode: bool = False
+    prepack_weights: bool = False # Requires intel_extension_for_pytorch, otherwise ignored
+
+EXECUTION_PROFILES = {
+    "default": ExecutionProfile(name="default"),
+    "cpu": ExecutionProfile(
+        name="cpu",
+        device_map="cpu",
+        torch_dtype="bfloat16",
+        autocast_dtype="bfloat16",
+        attn_implementation="sdpa",
+        inference_mode=True,
+        prepack_weights=True),
+}
+
+# Execution profile by model id, models that are not listed use SERVICES_EXECUTION_PROFILE
+MODEL_EXECUTION_PROFILES = {
+}
+
+def execution_profile(model_id:str) -> ExecutionProfile:
+    return EXECUTION_PROFILES[MODEL_EXECUTION_PROFILES.get(model_id, os.getenv("SERVICES_EXECUTION_PROFILE", "default"))]
+
+def cpu_supports_bf16() -> bool:
+    import torch
+    return torch.backends.mkldnn.is_available() and torch.ops.mkldnn._is_mkldnn_bf16_supported()
+
+def resolve_dtype(dtype:Optional[str]) -> Any:
+    import torch
+    if dtype is None or dtype == "auto":
+        return dtype
+    if dtype == "bfloat16" and not cpu_supports_bf16():
+        return torch.float32
+    return getattr(torch, dtype)
+
+def plan_model_placement(registry:Models, model_id:str) -> Placement:
+    """Estimate the model's footprint, and decide where it's loaded (raises ModelTooLargeError if it doesn't fit)."""
+    profile = execution_profile(model_id)
+    dtype = resolve_dtype(profile.torch_dtype)
+    model_info = registry.models[model_id]
+    footprint = model_info.footprint or estimate_footprint(model_info.location)
+    return plan_placement(model_id, footprint, profile.device_map, dtype if dtype in (None, "auto") else str(dtype).removeprefix("torch."))
+
+# Embedding models backend, by model id, models that are not listed use SERVICES_EMBEDDINGS_BACKEND:
+# "auto" - an exported ONNX graph when one is cached with the model, otherwise eager PyTorch
+# "onnx" - the graph optimized by onnxruntime (O3), exported once if missing
+# "onnx-int8" - the graph dynamically quantized to int8, exported once if missing
+# "torch" - always eager PyTorch
+MODEL_EMBEDDINGS_BACKENDS = {
+}
+ONNX_OPTIMIZATION_LEVEL = "O3"
+# Relative to the model location, under .cache so that the exports aren't mistaken for the model's own files (by the watcher or the footprint)
+ONNX_EXPORTS_DIR = Path(".cache") / "services" / "exports"
+
+def embeddings_backend(model_id:str) -> str:
+    return MODEL_EMBEDDINGS_BACKENDS.get(model_id, os.getenv("SERVICES_EMBEDDINGS_BACKEND", "auto"))
+
+def onnx_quantization_config() -> str:
+    """The dynamic quantization config that matches the CPU's instruction set."""
+    import platform
+    import torch
+    if platform.machine().lower() in ("arm64", "aarch64"):
+        return "arm64"
+    return "avx512_vnni" if torch.backends.cpu.get_cpu_capability().startswith("AVX512") else "avx2"
+
+def onnx_artifacts(location:Path) -> dict[str, Path]:
+    """The exported graph of each ONNX backend, whether it exists or not, in order of preference when the backend is "auto"."""
+    return {
+        "onnx-int8": Path(location) / ONNX_EXPORTS_DIR / "onnx" / f"model_qint8_{onnx_quantization_config()}.onnx",
+        "onnx": Path(location) / ONNX_EXPORTS_DIR / "onnx" / f"model_{ONNX_OPTIMIZATION_LEVEL}.onnx",
+    }
+
+def export_onnx(location:Path, backend:str) -> Path:
+    """Export a SentenceTransformer to an optimized (and optionally int8 quantized) ONNX graph, saved under the model's ONNX_EXPORTS_DIR."""
+    from sentence_transformers import SentenceTransformer, export_dynamic_quantized_onnx_model, export_optimized_onnx_model
+    # Converted to ONNX in memory, the exports below save only the resulting graph, so the model files are left intact
+    model = SentenceTransformer(str(location), backend="onnx", device="cpu", local_files_only=True, trust_remote_code=True)
+    # The graph is saved in the "onnx" sub-directory of the given path
+    exports = Path(location) / ONNX_EXPORTS_DIR
+    exports.mkdir(parents=True, exist_ok=True)
+    if backend == "onnx-int8":
+        export_dynamic_quantized_onnx_model(model, onnx_quantization_config(), str(exports))
+    else:
+        export_optimized_onnx_model(model, ONNX_OPTIMIZATION_LEVEL, str(exports))
+    return onnx_artifacts(location)[backend]
+
+# Weight files are read in ranges of this size, in parallel, so that the memory mapped load hits the page cache
+SHARD_READ_CHUNK_SIZE = 64 * 1024 * 1024
+SHARD_READ_WORKERS = int(os.getenv("SERVICES_SHARD_READ_WORKERS", str(min(8, os.cpu_count() or 1))))
+SHARD_READ_BUFFER_SIZE = 4 * 1024 * 1024
+
+def _read_range(path:Path, offset:int, length:int) -> int:
+    # Read (and discard) the pages, a WILLNEED hint returns before they're read, and is ignored by some filesystems
+    buffer = bytearray(min(length, SHARD_READ_BUFFER_SIZE))
+    remaining = length
+    with open(path, "rb", buffering=0) as f:
+        f.seek(offset)
+        while remaining > 0:
+            read = f.readinto(memoryview(buffer)[:min(remaining, len(buffer))])
+            if not read:
+                break
+            remaining -= read
+    return length - remaining
+
+def read_ahead_weights(location:Path) -> int:
+    """Warm the OS page cache with the safetensors shards of a model, reading ranges of all the shards in parallel.
+
+    Returns:
+        int: The number of bytes read.
+    """
+    ranges = list[tuple[Path, int, int]]()
+    for shard in sorted(Path(location).glob("*.safetensors")):
+        size = shard.stat().st_size
+        ranges.extend((shard, offset, min(SHARD_READ_CHUNK_SIZE, size - offset)) for offset in range(0, size, SHARD_READ_CHUNK_SIZE))
+    if not ranges:
+        return 0
+
+    with ThreadPoolExecutor(max_workers=min(SHARD_READ_WORKERS, len(ranges)), thread_name_prefix="read_ahead") as executor:
+        return sum(executor.map(lambda r: _read_range(*r), ranges))
+
 class LoadedModel(BaseModel, ABC):
     model_id: str
     entry_point_model:Any = None
     pre_processor_model:Any = None
     post_processor_model:Any = None
+    execution_profile:ExecutionProfile = EXECUTION_PROFILES["default"]
+    hibernated:bool = False
+    device:Any = None # The device the weights are woken up to
  
 class Loader(ABC):
     def __init__(self, registry:Models, **generation_kwargs):
         self.cache_root = registry.cache_root
         self.registry = registry
         self.generation_kwargs = generation_kwargs
+        self.load_timings = dict[str, float]()
+
+    @contextmanager
+    def timed(self, phase:str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.load_timings[phase] = self.load_timings.get(phase, 0.0) + time.perf_counter() - start
+
+    def plan_device_map(self, auto_class, config, model_id:str) -> Any:
+        import torch
+        profile = execution_profile(model_id)
+        placement = plan_model_placement(self.registry, model_id)
+        logger.info("Placing %s on %s (~%.1fGiB)", model_id, placement.strategy, placement.required_bytes / 1024 ** 3)
+        if placement.strategy == "cpu":
+            return "cpu" if profile.device_map == "auto" else profile.device_map
+
+        from accelerate import init_empty_weights, infer_auto_device_map
+        dtype = resolve_dtype(profile.torch_dtype)
+        if dtype == "auto":
+            dtype = getattr(config, "torch_dtype", None) or torch.float32
+        with init_empty_weights():
+            empty_model = auto_class.from_config(config, torch_dtype=dtype)
+        return infer_auto_device_map(
+            empty_model, 
+            max_memory=placement.max_memory,
+            no_split_module_classes=empty_model._no_split_modules, 
+            dtype=dtype)
+
+    def load_pretrained(self, auto_class, model_id:str):
+        """
+        Load the model from memory mapped safetensors shards (which are read ahead in parallel), timing each phase.
+        Models that are placed on a single device are loaded from their artifact (see `artifacts`) when there's one,
+        otherwise the artifact is written after loading them.
+        """
+        import torch
+        from transformers import AutoConfig
+        model_info = self.registry.models[model_id]
+        location = model_info.location
+        profile = execution_profile(model_id)
+
+        with self.timed("config"):
+            config = AutoConfig.from_pretrained(location, local_files_only=True, cache_dir=str(self.cache_root))
 
+        with self.timed("device_placement"):
+            device_map = self.plan_device_map(auto_class, config, model_id)
+
+        device = artifacts.single_device(device_map)
+        options = None
+        requested_dtype = resolve_dtype(profile.torch_dtype)
+        stored_dtype = getattr(config, "torch_dtype", None)
+        dtype = (stored_dtype or torch.float32) if requested_dtype in (None, "auto") else requested_dtype
+        # Weights that are loaded as they are stored would be written byte for byte, an artifact only duplicates them on disk
+        identical = requested_dtype == "auto" or (requested_dtype is not None and requested_dtype == stored_dtype)
+        if artifacts.ARTIFACT_CACHE_ENABLED and device is not None and model_info.revision and not identical:
+            options = artifacts.artifact_options(auto_class, dtype, profile.attn_implementation)
+            manifest = artifacts.find_artifact(location, artifacts.artifact_key(model_info.revision, options))
+            if manifest is not None:
+                try:
+                    with self.timed("weights"):
+                        model = artifacts.read_artifact(auto_class, config, location, manifest, device, dtype, **self.profile_kwargs(profile))
+                    logger.info("Loaded %s from the artifact %s", model_id, manifest.key)
+                    with self.timed("prepack"):
+                        return self.prepack(model, profile)
+                except Exception as ex:
+                    logger.warning("Failed to load %s from the artifact %s, loading it from the model files: %s", model_id, manifest.key, ex)
+
+        with self.timed("read_ahead"):
+            read_ahead = read_ahead_weights(location)
+        with self.timed("weights"):
+            model = auto_class.from_pretrained(
+                location,
+                config=config,
+                torch_dtype=resolve_dtype(profile.torch_dtype),
+                device_map=device_map,
+                use_safetensors=True if read_ahead else None,
+                local_files_only=True,
+                cache_dir=str(self.cache_root),
+                **self.profile_kwargs(profile)
+            )
+            model.eval()
+
+        if options is not None:
+            with self.timed("artifact"):
+                try:
+                    manifest = artifacts.write_artifact(model, model_id, location, model_info.revision, options)
+                    logger.info("Wrote the artifact %s of %s (%.1fGiB)", manifest.key, model_id, manifest.weights_bytes / 1024 ** 3)
+                except Exception as ex:
+                    logger.warning("Failed to write the artifact of %s: %s", model_id, ex)
+
+        with self.timed("prepack"):
+            return self.prepack(model, profile)
 
     def load_transformer_causalLM(self, model_id:str):
         from transformers import AutoModelForCausalLM 
-        return AutoModelForCausalLM.from_pretrained(
-            self.registry.models[model_id].location,
-            torch_dtype="auto",
-            device_map="auto",
-            local_files_only=True,
-            cache_dir=str(self.cache_root)
-        )
+        return self.load_pretrained(AutoModelForCausalLM, model_id)
+
+    @staticmethod
+    def profile_kwargs(profile:ExecutionProfile) -> dict:
+        kwargs = {}
+        if profile.attn_implementation:
+            kwargs["attn_implementation"] = profile.attn_implementation
+        return kwargs
+
+    @staticmethod
+    def prepack(model, profile:ExecutionProfile):
+        if not profile.prepack_weights:
+            return model
+        try:
+            import intel_extension_for_pytorch as ipex
+        except ImportError:
+            logger.info("intel_extension_for_pytorch is not installed, linear weights are not pre-packed")
+            return model
+        # Re-lays out the linear weights to the oneDNN blocked format, once, instead of on every matmul
+        return ipex.optimize(model, dtype=resolve_dtype(profile.autocast_dtype or profile.torch_dtype), inplace=True)
+
+    @contextmanager
+    def execution_context(self, loaded:LoadedModel) -> Iterator[None]:
+        """Enter the execution profile's inference mode, autocast and attention backends around a forward pass/generation."""
+        import torch
+        profile = loaded.execution_profile
+        with ExitStack() as stack:
+            if profile.inference_mode:
+                stack.enter_context(torch.inference_mode())
+            autocast_dtype = resolve_dtype(profile.autocast_dtype)
+            if autocast_dtype == torch.bfloat16:
+                stack.enter_context(torch.autocast("cpu", dtype=autocast_dtype))
+            if profile.attn_implementation == "sdpa":
+                from torch.nn.attention import sdpa_kernel, SDPBackend
+                # In order of preference, the first one that supports the inputs is used
+                stack.enter_context(sdpa_kernel([SDPBackend.FLASH_ATTENTION, SDPBackend.EFFICIENT_ATTENTION, SDPBackend.MATH], set_priority=True))
+            yield
     
     def load_transformer_tokenizer(self, model_id:str):
         from transformers import AutoTokenizer 
-        return AutoTokenizer.from_pretrained(
-            self.registry.models[model_id].location,
-            local_files_only=True,
-            cache_dir=str(self.cache_root)
-        )
+        with self.timed("tokenizer"):
+            return AutoTokenizer.from_pretrained(
+                self.registry.models[model_id].location,
+                local_files_only=True,
+                cache_dir=str(self.cache_root)
+            )
     
     def load_transformer_processor(self, model_id:str):
         from transformers import AutoProcessor
-        return AutoProcessor.from_pretrained(
-            self.registry.models[model_id].location,
-            local_files_only=True,
-            cache_dir=str(self.cache_root)
-        )
+        with self.timed("tokenizer"):
+            return AutoProcessor.from_pretrained(
+                self.registry.models[model_id].location,
+                local_files_only=True,
+                cache_dir=str(self.cache_root)
+            )
     
     def load_sentence_transformer(self, model_id:str):
         from sentence_transformers import SentenceTransformer 
-        return SentenceTransformer(
-            str(self.registry.models[model_id].location), 
-            device="cpu",
-            local_files_only=True, 
-            cache_folder=str(self.cache_root),
-            trust_remote_code=True,
-        )
+        location = self.registry.models[model_id].location
+        backend_kwargs = self.onnx_backend_kwargs(model_id)
+        if not backend_kwargs:
+            with self.timed("read_ahead"):
+                read_ahead_weights(location)
+        with self.timed("weights"):
+            return SentenceTransformer(
+                str(location), 
+                device="cpu",
+                local_files_only=True, 
+                cache_folder=str(self.cache_root),
+                trust_remote_code=True,
+                **backend_kwargs
+            )
+
+    def load_cross_encoder(self, model_id:str, max_length:Optional[int] = None):
+        from sentence_transformers import CrossEncoder
+        location = self.registry.models[model_id].location
+        with self.timed("read_ahead"):
+            read_ahead_weights(location)
+        with self.timed("weights"):
+            return CrossEncoder(
+                str(location),
+                max_length=max_length,
+                device="cpu",
+                local_files_only=True,
+                cache_folder=str(self.cache_root),
+                trust_remote_code=True
+            )
+
+    def onnx_backend_kwargs(self, model_id:str) -> dict:
+        """Select the exported ONNX graph of the model's embeddings backend, exporting it first if needed (empty for eager PyTorch)."""
+        backend = embeddings_backend(model_id)
+        if backend == "torch":
+            return {}
+        try:
+            import onnxruntime # noqa: F401
+        except ImportError:
+            if backend != "auto":
+                logger.warning("onnxruntime is not installed (pip install services[onnx]), %s runs in eager PyTorch", model_id)
+            return {}
+
+        location = self.registry.models[model_id].location
+        artifacts = onnx_artifacts(location)
+        if backend == "auto":
+            artifact = next((path for path in artifacts.values() if path.exists()), None)
+            if artifact is None:
+                return {}
+        else:
+            artifact = artifacts[backend]
+            if not artifact.exists():
+                with self.timed("export"):
+                    logger.info("Exporting %s to %s", model_id, artifact)
+                    try:
+                        artifact = export_onnx(location, backend)
+                    except Exception as ex:
+                        logger.exception("Failed to export %s to ONNX, it runs in eager PyTorch: %s", model_id, ex)
+                        return {}
+
+        logger.info("Loading %s from %s", model_id, artifact)
+        return {
+            "backend": "onnx",
+            "model_kwargs": {"file_name": str(artifact.relative_to(location)), "provider": "CPUExecutionProvider"},
+        }
     
     def load_model(self, model_id: str):
         from transformers import AutoModel
@@ -67,15 +385,7 @@ class Loader(ABC):
     
     def load_image_to_text_model(self, model_id: str):
         from transformers import AutoModelForImageTextToText
-
-        model = AutoModelForImageTextToText.from_pretrained(
-            self.registry.models[model_id].location,
-            torch_dtype="auto", 
-            device_map="auto", 
-            local_files_only=True,
-            cache_dir=str(self.cache_root))
-        model.eval()
-        return model
+        return self.load_pretrained(AutoModelForImageTextToText, model_id)
    
     def unload(self, model:LoadedModel):
         import gc
@@ -91,8 +401,63 @@ class Loader(ABC):
         torch.cuda.empty_cache()
         self.log_usage_metrics()
 
-    def log_usage_metrics(self):
+    @staticmethod
+    def model_bytes(model:LoadedModel) -> int:
+        module = model.entry_point_model
+        if module is None or not hasattr(module, "parameters"):
+            return 0
+        return sum(t.numel() * t.element_size() for t in [*module.parameters(), *module.buffers()])
+
+    def hibernate(self, model:LoadedModel) -> bool:
+        """Move the weights to (pinned) host memory, keeping the tokenizer/processor objects, so that `wake` is only a device copy.
+
+        Returns:
+            bool: False if the model can't hibernate (e.g. it's dispatched across devices), and should be unloaded instead.
+        """
+        import gc
+        import torch
+
+        if model.hibernated:
+            return True
+        devices = {t.device for t in model.entry_point_model.parameters()}
+        if len(devices) != 1 or next(iter(devices)).type == "meta":
+            logger.info("%s is spread across %s, it can't hibernate", model.model_id, devices)
+            return False
+
+        model.device = next(iter(devices))
+        if model.device.type != "cpu":
+            model.entry_point_model.to("cpu")
+            if torch.cuda.is_available():
+                # Pinned memory makes the wake up copy asynchronous, and twice as fast
+                for tensor in [*model.entry_point_model.parameters(), *model.entry_point_model.buffers()]:
+                    tensor.data = tensor.data.pin_memory()
+            gc.collect()
+            torch.cuda.empty_cache()
+        model.hibernated = True
+        logger.info("Hibernated %s from %s", model.model_id, model.device)
+        return True
+
+    def wake(self, model:LoadedModel):
         import torch
+
+        if not model.hibernated:
+            return
+        if model.device.type != "cpu":
+            start = time.perf_counter()
+            model.entry_point_model.to(model.device, non_blocking=True)
+            if model.device.type == "cuda":
+                torch.cuda.synchronize(model.device)
+            logger.info("Woke %s up to %s in %.2fs", model.model_id, model.device, time.perf_counter() - start)
+        model.hibernated = False
+
+    def log_usage_metrics(self, model_id:str = None):
+        import torch
+        if model_id is not None and self.load_timings:
+            logger.info("Loaded %s in %.2fs: %s", model_id, sum(self.load_timings.values()), 
+                        ", ".join(f"{phase}={seconds:.2f}s" for phase, seconds in self.load_timings.items()))
+            for phase, seconds in self.load_timings.items():
+                METRICS.observe("model_load_seconds", seconds, buckets=(0.1, 0.5, 1, 2, 5, 10, 30, 60, 120), model=model_id, phase=phase)
+            self.load_timings.clear()
         if torch.cuda.is_available() and torch.cuda.is_initialized():
             logger.debug(torch.cuda.memory_summary())
         else:
@@ -118,11 +483,11 @@ class AutoModelForCausalLMLoader(Loader):
         self.return_tensors = return_tensors
 
     def load(self, model_info:ModelCard) -> LoadedModel:
-        loaded = LoadedModel(model_id=model_info.model_id)
+        loaded = LoadedModel(model_id=model_info.model_id, execution_profile=execution_profile(model_info.model_id))
         loaded.entry_point_model = self.load_transformer_causalLM(model_info.model_id)
         loaded.pre_processor_model = self.load_transformer_tokenizer(model_info.model_id)
         loaded.post_processor_model = loaded.pre_processor_model
-        self.log_usage_metrics()
+        self.log_usage_metrics(model_info.model_id)
         return loaded
 
 class SentenceTransformerLoader(Loader):
@@ -136,6 +501,23 @@ class SentenceTransformerLoader(Loader):
         loaded.entry_point_model = self.load_sentence_transformer(model_info.model_id)
         loaded.pre_processor_model = loaded.entry_point_model.tokenizer
         loaded.post_processor_model = loaded.pre_processor_model
+        self.log_usage_metrics(model_info.model_id)
+        return loaded
+
+class CrossEncoderLoader(Loader):
+    def __init__(self, 
+                 registry:Models, 
+                 max_length:Optional[int] = None,
+                 **generation_kwargs):
+        super().__init__(registry, **generation_kwargs)
+        self.max_length = max_length # The (query, passage) pairs are truncated to it
+
+    def load(self, model_info:ModelCard)-> LoadedModel:
+        loaded = LoadedModel(model_id=model_info.model_id)
+        loaded.entry_point_model = self.load_cross_encoder(model_info.model_id, self.max_length)
+        loaded.pre_processor_model = loaded.entry_point_model.tokenizer
+        loaded.post_processor_model = loaded.pre_processor_model
+        self.log_usage_metrics(model_info.model_id)
         return loaded
 
 class ImageTextToTextModelLoader(Loader):
@@ -148,12 +530,12 @@ class ImageTextToTextModelLoader(Loader):
         self.return_tensors = return_tensors
 
     def load(self, model_info:ModelCard)-> LoadedModel:
-        loaded = LoadedModel(model_id=model_info.model_id)
+        loaded = LoadedModel(model_id=model_info.model_id, execution_profile=execution_profile(model_info.model_id))
         loaded.entry_point_model = self.load_image_to_text_model(model_info.model_id)
         loaded.pre_processor_model = self.load_transformer_processor(model_info.model_id)
         loaded.post_processor_model = loaded.pre_processor_model
 
-        self.log_usage_metrics()
+        self.log_usage_metrics(model_info.model_id)
         return loaded
     
 class NotImplemented(Loader):
@@ -177,5 +559,7 @@ SUPPORTED = {
     "sentence-transformers/all-MiniLM-L6-v2":SentenceTransformerLoader,
     "ibm-granite/granite-embedding-278m-multilingual":SentenceTransformerLoader,
 
+    "cross-encoder/ms-marco-MiniLM-L6-v2":CrossEncoderLoader,
+
     "nanonets/Nanonets-OCR-s": ImageTextToTextModelLoader,
 }
\ No newline at end of file
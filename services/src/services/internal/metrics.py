@@ -0,0 +1,119 @@
+import bisect
+import multiprocessing
+import os
+import threading
+from pydantic import BaseModel, Field
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+class Histogram(BaseModel):
+    buckets: tuple[float, ...] = DEFAULT_BUCKETS
+    counts: list[int] = Field(default_factory=list)
+    count: int = 0
+    sum: float = 0.0
+    min: float = None
+    max: float = None
+
+    def observe(self, value:float):
+        if not self.counts:
+            # The last count is for the values above the last bucket
+            self.counts = [0] * (len(self.buckets) + 1)
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+class Metrics:
+    def __init__(self):
+        """
+        In-process counters, gauges and histograms, keyed by name and optional labels e.g. `name{model=...}`.
+        """
+        self._lock = threading.Lock()
+        self.counters = dict[str, float]()
+        self.gauges = dict[str, float]()
+        self.histograms = dict[str, Histogram]()
+
+    @staticmethod
+    def key(name:str, **labels) -> str:
+        if not labels:
+            return name
+        return name + "{" + ",".join(f"{k}={v}" for k, v in sorted(labels.items())) + "}"
+
+    def increment(self, name:str, value:float = 1, **labels):
+        key = self.key(name, **labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name:str, value:float, **labels):
+        with self._lock:
+            self.gauges[self.key(name, **labels)] = value
+
+    def observe(self, name:str, value:float, buckets:tuple[float, ...] = DEFAULT_BUCKETS, **labels):
+        key = self.key(name, **labels)
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(buckets=buckets)
+            self.histograms[key].observe(value)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+                "histograms": {k: v.model_dump() for k, v in self.histograms.items()},
+            }
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+
+class RequestCounters:
+    def __init__(self, workers:int = 1):
+        """
+        The in-flight and total requests of each worker process, in shared memory.
+        Created before the workers are forked, so that any of them reports the load of all.
+        Each worker writes only its own slot (from its event loop), so no lock is shared between them,
+        and a snapshot may be a request behind.
+
+        Args:
+            workers(int): The number of worker processes.
+        """
+        self.in_flight = multiprocessing.RawArray("q", workers)
+        self.total = multiprocessing.RawArray("q", workers)
+        self.pids = multiprocessing.RawArray("q", workers)
+        self.worker = 0 # The index of the current process
+        self.pids[0] = os.getpid()
+
+    def attach(self, worker:int):
+        """Make the current (forked) process count as the given worker."""
+        self.worker = worker
+        self.pids[worker] = os.getpid()
+        self.in_flight[worker] = 0
+
+    def started(self):
+        self.in_flight[self.worker] += 1
+        self.total[self.worker] += 1
+
+    def finished(self):
+        self.in_flight[self.worker] -= 1
+
+    def snapshot(self) -> dict:
+        workers = [
+            {"worker": i, "pid": self.pids[i], "in_flight": self.in_flight[i], "total": self.total[i]}
+            for i in range(len(self.total))
+        ]
+        return {
+            "in_flight": sum(worker["in_flight"] for worker in workers),
+            "total": sum(worker["total"] for worker in workers),
+            "workers": workers,
+        }
+
+METRICS = Metrics()
+# Replaced by the multi-worker server before forking, see services.serve
+REQUEST_COUNTERS = RequestCounters()
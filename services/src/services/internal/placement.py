@@ -0,0 +1,73 @@
+import os
+from pydantic import BaseModel
+from typing import Literal, Optional
+from services.internal.footprint import ModelFootprint
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Tokens of KV cache that are reserved on top of the weights, when checking whether a model fits
+KV_CACHE_ALLOWANCE_TOKENS = int(os.getenv("SERVICES_KV_CACHE_ALLOWANCE_TOKENS", "8192"))
+# The fraction of the free memory that is used for placement, the rest is left for activations and fragmentation
+MEMORY_HEADROOM = float(os.getenv("SERVICES_MEMORY_HEADROOM", "0.9"))
+
+GiB = 1024 ** 3
+
+class ModelTooLargeError(MemoryError):
+    pass
+
+class Placement(BaseModel):
+    strategy: Literal["device", "offload", "cpu"]
+    """`device` - fully on the accelerator(s), `offload` - partially offloaded to the CPU RAM, `cpu` - fully on the CPU."""
+
+    required_bytes: int
+    """The estimated weights and KV allowance size."""
+
+    max_memory: Optional[dict[int | str, int]] = None
+    """The accelerate max_memory map, by device index and "cpu"."""
+
+def available_memory() -> tuple[dict[int, int], int]:
+    """Get the free memory of each accelerator, and the available CPU RAM, in bytes."""
+    import psutil
+    import torch
+    devices = dict[int, int]()
+    if torch.cuda.is_available():
+        for i in range(torch.cuda.device_count()):
+            free, _ = torch.cuda.mem_get_info(i)
+            devices[i] = free
+    return devices, psutil.virtual_memory().available
+
+def required_memory(footprint:ModelFootprint, dtype:Optional[str]) -> int:
+    return footprint.weights_bytes_as(dtype) + (footprint.kv_bytes_per_token or 0) * KV_CACHE_ALLOWANCE_TOKENS
+
+def plan_placement(model_id:str, footprint:ModelFootprint, device_map:Optional[str], dtype:Optional[str]) -> Placement:
+    """
+    Decide where the model goes, before it's loaded.
+
+    Args:
+        model_id(str): The model id (for error reporting).
+        footprint(ModelFootprint): The model's estimated footprint.
+        device_map(str): The execution profile's device map, only "auto" may use the accelerators.
+        dtype(str): The dtype the weights are loaded as, "auto" to keep the stored dtype.
+
+    Raises:
+        ModelTooLargeError: If the model doesn't fit the free memory, even when offloaded.
+    """
+    required = required_memory(footprint, dtype)
+    devices, ram = available_memory()
+    usable_ram = int(ram * MEMORY_HEADROOM)
+
+    if device_map == "auto" and devices:
+        usable_vram = {i: int(free * MEMORY_HEADROOM) for i, free in devices.items()}
+        if required <= sum(usable_vram.values()):
+            return Placement(strategy="device", required_bytes=required, max_memory=usable_vram)
+        available = sum(usable_vram.values()) + usable_ram
+        if required <= available:
+            return Placement(strategy="offload", required_bytes=required, max_memory={**usable_vram, "cpu": usable_ram})
+    else:
+        available = usable_ram
+        if required <= available:
+            return Placement(strategy="cpu", required_bytes=required)
+
+    raise ModelTooLargeError(
+        f"{model_id} requires ~{required / GiB:.1f}GiB (weights and KV cache allowance), but only {available / GiB:.1f}GiB are free")
@@ -0,0 +1,328 @@
+import os
+import threading
+from collections import Counter, OrderedDict
+from typing import Literal, Optional
+from services.internal.registry import Models
+from services.internal.loader import SUPPORTED, plan_model_placement
+from services.internal.placement import ModelTooLargeError
+from services.internal.inference import BaseInference
+from services.internal.metrics import METRICS
+import logging
+
+logger = logging.getLogger(__name__)
+
+ModelState = Literal["pending", "loading", "ready", "failed", "hibernated", "unloaded"]
+
+# Host RAM that evicted models may keep their weights in (so that they come back with a device copy instead of a reload), 0 disables hibernation
+HIBERNATION_BUDGET_BYTES = int(float(os.getenv("SERVICES_HIBERNATION_BUDGET_GB", "0")) * 1024 ** 3)
+
+class InferencePool:
+    def __init__(self, registry:Models, inference_type:type[BaseInference], capacity:int = 1, hibernation_budget:int = None):
+        """
+        Keeps up to `capacity` models resident, each served by its own inference, evicting the least recently used one.
+
+        Args:
+            registry(Models): The model registry.
+            inference_type(type[BaseInference]): The inference used to serve the models of this pool.
+            capacity(int): The number of resident models. Models which are in use are never evicted,
+                            so the capacity may be exceeded temporarily.
+            hibernation_budget(int): The bytes of host RAM that evicted models may hibernate in, defaults to `SERVICES_HIBERNATION_BUDGET_GB`.
+        """
+        self.registry = registry
+        self.inference_type = inference_type
+        self.capacity = capacity
+        self.inferences = OrderedDict[str, BaseInference]() # base model id -> inference, in least recently used order
+        self.in_use = dict[str, int]()
+        self.states = dict[str, ModelState]()
+        self.hibernation_budget = HIBERNATION_BUDGET_BYTES if hibernation_budget is None else hibernation_budget
+        self.hibernated = OrderedDict[str, tuple[BaseInference, int]]() # base model id -> (inference, host bytes), in hibernation order
+        self.loading = dict[str, threading.Event]() # base model id -> set once the model is loaded (or woken up), or failed to
+        self.prefetched = set[str]() # base model ids that were loaded ahead of their requests, and weren't requested yet
+        self.prefetch_stats = Counter[str]()
+        self.stale = set[str]() # base model ids whose files changed while in use, which are unloaded once released
+        # Held only to update the state of the pool, the models are loaded outside of it
+        self._lock = threading.RLock()
+        POOLS.append(self)
+
+    def accepts(self, model_id:str) -> bool:
+        loader = SUPPORTED.get(self.registry.base_model_of(model_id))
+        return loader is not None and issubclass(loader, self.inference_type.LOADERS)
+
+    def is_resident(self, model_id:str) -> bool:
+        return self.registry.base_model_of(model_id) in self.inferences
+
+    def acquire(self, model_id:str) -> BaseInference:
+        """
+        Get an inference that serves the model, loading it if needed. The caller must `release` it once done.
+        Blocks while the model is loaded, so async callers run it in a thread.
+        """
+        if not self.accepts(model_id):
+            raise NotImplementedError("model_id: %s is not supported yet", model_id)
+
+        base_model_id = self.registry.base_model_of(model_id)
+        while True:
+            with self._lock:
+                loading = self.loading.get(base_model_id)
+                if loading is None:
+                    inference = self.inferences.get(base_model_id)
+                    if inference is not None:
+                        self.inferences.move_to_end(base_model_id)
+                        self._use(base_model_id)
+                    else:
+                        hibernated = self._reserve(base_model_id, model_id)
+                    break
+            # Waits for the model that is being loaded (e.g. prefetched) by another thread, instead of loading it twice
+            loading.wait()
+
+        if inference is None:
+            inference = self._load(base_model_id, model_id, hibernated, use=True)
+        else:
+            try:
+                # Attaches the adapter, when the model is an adapter of the resident base model
+                inference.serve(model_id)
+            except Exception:
+                self.release(inference)
+                raise
+
+        with self._lock:
+            if base_model_id in self.prefetched:
+                self.prefetched.discard(base_model_id)
+                self._count_prefetch("hits")
+            self.states[model_id] = "ready"
+        return inference
+
+    def _use(self, base_model_id:str):
+        self.in_use[base_model_id] = self.in_use.get(base_model_id, 0) + 1
+
+    def _reserve(self, base_model_id:str, model_id:str) -> Optional[BaseInference]:
+        """
+        Mark the model as loading (under the lock), making room for it.
+
+        Returns:
+            BaseInference: The inference of the model if it's hibernated, which is woken up instead of loaded.
+        """
+        # Taken out first, so that making room doesn't unload it to stay within the hibernation budget
+        inference, _ = self.hibernated.pop(base_model_id, (None, 0))
+        self._make_room()
+        self.loading[base_model_id] = threading.Event()
+        self.states[model_id] = "loading"
+        return inference
+
+    def _load(self, base_model_id:str, model_id:str, inference:Optional[BaseInference], use:bool) -> BaseInference:
+        """Load (or wake up) a reserved model, without holding the pool, then make it resident (and in use)."""
+        try:
+            make_memory_for(self.registry, base_model_id)
+            if inference is not None:
+                inference.wake()
+                METRICS.increment("pool_wakeups", pool=self.inference_type.__name__)
+            else:
+                inference = self.inference_type(self.registry)
+            inference.serve(model_id)
+        except Exception:
+            if inference is not None:
+                inference.reset()
+            with self._lock:
+                self.states[model_id] = "failed"
+                self.loading.pop(base_model_id).set()
+            raise
+
+        with self._lock:
+            self.inferences[base_model_id] = inference
+            if use:
+                self._use(base_model_id)
+            self.states[model_id] = "ready"
+            self.loading.pop(base_model_id).set()
+            METRICS.set("pool_resident_models", len(self.inferences), pool=self.inference_type.__name__)
+            METRICS.set("pool_hibernated_models", len(self.hibernated), pool=self.inference_type.__name__)
+        return inference
+
+    def prefetch(self, model_id:str) -> bool:
+        """
+        Load a model ahead of its request, without holding the pool while loading it.
+        Only idle models are evicted for it (models in use and models being loaded are not), so with a capacity of 1
+        nothing is prefetched into the pool while its model is generating, the capacity must leave a spare slot.
+
+        Returns:
+            bool: Whether the model was loaded (or woken up).
+        """
+        if not self.accepts(model_id):
+            return False
+
+        base_model_id = self.registry.base_model_of(model_id)
+        with self._lock:
+            if base_model_id in self.inferences or base_model_id in self.loading:
+                return False
+            # The room that is left once every idle model is evicted
+            busy = sum(1 for resident in self.inferences if resident in self.in_use) + len(self.loading)
+            if busy >= self.capacity:
+                return False
+            hibernated = self._reserve(base_model_id, model_id)
+
+        try:
+            self._load(base_model_id, model_id, hibernated, use=False)
+        except Exception as ex:
+            logger.warning("Failed to prefetch %s: %s", model_id, ex)
+            return False
+        with self._lock:
+            self.prefetched.add(base_model_id)
+            self._count_prefetch("loads")
+        return True
+
+    def _count_prefetch(self, outcome:str):
+        self.prefetch_stats[outcome] += 1
+        METRICS.increment(f"prefetch_{outcome}", pool=self.inference_type.__name__)
+        if self.prefetch_stats["loads"]:
+            METRICS.set("prefetch_hit_rate", self.prefetch_stats["hits"] / self.prefetch_stats["loads"], pool=self.inference_type.__name__)
+
+    def release(self, inference:BaseInference):
+        with self._lock:
+            model_id = inference.model_id
+            if model_id in self.in_use:
+                self.in_use[model_id] -= 1
+                if self.in_use[model_id] <= 0:
+                    del self.in_use[model_id]
+                    if model_id in self.stale:
+                        self.stale.discard(model_id)
+                        self.evict(model_id, hibernate=False)
+
+    def invalidate(self, model_id:str) -> bool:
+        """
+        Unload a model whose files changed (or were removed), including from hibernation.
+        A model in use is unloaded once it's released, so that the next request loads the new files.
+        """
+        base_model_id = self.registry.base_model_of(model_id)
+        with self._lock:
+            dropped = self.drop_hibernated(base_model_id)
+            if base_model_id in self.in_use:
+                logger.info("%s changed while in use, it's unloaded once released", base_model_id)
+                self.stale.add(base_model_id)
+                return True
+            return self.evict(base_model_id, hibernate=False) or dropped
+
+    def _make_room(self):
+        # The models that are being loaded take their room too
+        while len(self.inferences) + len(self.loading) >= self.capacity:
+            idle = [model_id for model_id in self.inferences.keys() if model_id not in self.in_use]
+            if not idle:
+                logger.warning("All %d resident models are in use, exceeding the pool capacity", len(self.inferences))
+                return
+            self.evict(idle[0])
+
+    def evict(self, model_id:str, hibernate:bool = True) -> bool:
+        """
+        Free the device memory of a resident model.
+
+        Args:
+            model_id(str): The model (or adapter) id.
+            hibernate(bool): Keep the weights in host RAM if they fit the hibernation budget, otherwise the model is unloaded.
+        """
+        base_model_id = self.registry.base_model_of(model_id)
+        with self._lock:
+            inference = self.inferences.pop(base_model_id, None)
+            if inference is None:
+                return False
+            if base_model_id in self.prefetched:
+                self.prefetched.discard(base_model_id)
+                self._count_prefetch("wasted")
+            if hibernate and self._hibernate(base_model_id, inference):
+                self._set_state(base_model_id, "hibernated")
+            else:
+                logger.info("Evicting %s", base_model_id)
+                inference.reset()
+                self._set_state(base_model_id, "unloaded")
+            METRICS.set("pool_resident_models", len(self.inferences), pool=self.inference_type.__name__)
+            return True
+
+    def _hibernate(self, base_model_id:str, inference:BaseInference) -> bool:
+        if self.hibernation_budget <= 0:
+            return False
+        size = inference.loader.model_bytes(inference.loaded) if inference.loaded is not None else 0
+        if size > self.hibernation_budget or not inference.hibernate():
+            return False
+        self.hibernated[base_model_id] = (inference, size)
+        # Over the budget, the longest hibernating models are unloaded
+        while sum(size for _, size in self.hibernated.values()) > self.hibernation_budget:
+            self.drop_hibernated(next(iter(self.hibernated.keys())))
+        METRICS.set("pool_hibernated_models", len(self.hibernated), pool=self.inference_type.__name__)
+        return True
+
+    def drop_hibernated(self, model_id:str) -> bool:
+        """Unload a hibernated model, releasing its host RAM."""
+        base_model_id = self.registry.base_model_of(model_id)
+        with self._lock:
+            inference, _ = self.hibernated.pop(base_model_id, (None, 0))
+            if inference is None:
+                return False
+            logger.info("Unloading hibernated %s", base_model_id)
+            inference.reset()
+            self._set_state(base_model_id, "unloaded")
+            METRICS.set("pool_hibernated_models", len(self.hibernated), pool=self.inference_type.__name__)
+            return True
+
+    def _set_state(self, base_model_id:str, state:ModelState):
+        for state_model_id in list(self.states.keys()):
+            if self.registry.base_model_of(state_model_id) == base_model_id:
+                self.states[state_model_id] = state
+
+    def clear(self):
+        with self._lock:
+            for model_id in list(self.inferences.keys()):
+                self.evict(model_id, hibernate=False)
+            for model_id in list(self.hibernated.keys()):
+                self.drop_hibernated(model_id)
+
+# All the pools of the process, for preloading and readiness reporting
+POOLS = list[InferencePool]()
+
+def make_memory_for(registry:Models, model_id:str):
+    """
+    Unload hibernated models, then evict idle models from all the pools (each pool's least recently used first),
+    until the model fits the free memory.
+    """
+    while True:
+        try:
+            plan_model_placement(registry, model_id)
+            return
+        except ModelTooLargeError:
+            hibernated = [(pool, resident) for pool in POOLS for resident in pool.hibernated.keys()]
+            if hibernated:
+                pool, resident = hibernated[0]
+                logger.info("Unloading hibernated %s to make memory for %s", resident, model_id)
+                pool.drop_hibernated(resident)
+                continue
+            idle = [(pool, resident) for pool in POOLS for resident in pool.inferences.keys() if resident not in pool.in_use]
+            if not idle:
+                # Nothing left to evict, the load fails fast with the placement error
+                raise
+            pool, resident = idle[0]
+            logger.info("Evicting %s to make memory for %s", resident, model_id)
+            pool.evict(resident, hibernate=False)
+
+def pool_for(model_id:str) -> InferencePool:
+    for pool in POOLS:
+        if pool.accepts(model_id):
+            return pool
+    raise NotImplementedError("model_id: %s is not supported yet", model_id)
+
+def preload(model_ids:list[str]):
+    """Load the models into their pools, one after the other, recording failures as the model's state."""
+    pools = dict[str, InferencePool]()
+    for model_id in model_ids:
+        try:
+            pools[model_id] = pool_for(model_id)
+            pools[model_id].states[model_id] = "pending"
+        except NotImplementedError:
+            logger.error("Cannot preload %s, it is not supported", model_id)
+
+    for model_id, pool in pools.items():
+        try:
+            pool.release(pool.acquire(model_id))
+            logger.info("Preloaded %s", model_id)
+        except Exception as ex:
+            logger.exception("Failed to preload %s: %s", model_id, ex)
+
+def model_states() -> dict[str, ModelState]:
+    states = dict[str, ModelState]()
+    for pool in POOLS:
+        states.update(pool.states)
+    return states
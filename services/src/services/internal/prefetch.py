@@ -0,0 +1,114 @@
+import os
+import json
+import time
+import threading
+from pathlib import Path
+from typing import Optional
+from services.internal.pool import pool_for
+from services.internal.metrics import METRICS
+import logging
+
+logger = logging.getLogger(__name__)
+
+PREFETCH_ENABLED = os.getenv("SERVICES_PREFETCH", "True").lower() == "true"
+# The minimal share of the transitions out of a model, that the next model must have to be prefetched
+PREFETCH_MIN_PROBABILITY = float(os.getenv("SERVICES_PREFETCH_MIN_PROBABILITY", "0.5"))
+# The minimal number of transitions out of a model, before any prediction is made
+PREFETCH_MIN_OBSERVATIONS = int(os.getenv("SERVICES_PREFETCH_MIN_OBSERVATIONS", "3"))
+# The transitions table is persisted at most once in this number of seconds (and on shutdown)
+PREFETCH_SAVE_INTERVAL = 60
+
+class Prefetcher:
+    def __init__(self,
+                 path:Optional[Path] = None,
+                 min_probability:float = PREFETCH_MIN_PROBABILITY,
+                 min_observations:int = PREFETCH_MIN_OBSERVATIONS):
+        """
+        Learns which model is requested after which (a first order Markov chain), and loads the likely next model
+        into its pool while the current one is still generating.
+        The next model is loaded only if its pool has room besides the models in use, see `InferencePool.prefetch`:
+        a model that follows another one of the same pool is prefetched only with a pool size (e.g. SERVICES_CHAT_POOL_SIZE) of 2 or more.
+
+        Args:
+            path(Path): The JSON file the transitions are persisted in, None to keep them in memory only.
+            min_probability(float): See `PREFETCH_MIN_PROBABILITY`.
+            min_observations(int): See `PREFETCH_MIN_OBSERVATIONS`.
+        """
+        self.path = Path(path) if path else None
+        self.min_probability = min_probability
+        self.min_observations = min_observations
+        self.transitions = dict[str, dict[str, int]]() # model id -> next model id -> count
+        self.previous = dict[str, str]() # sequence -> the last requested model id
+        self.saved_at = time.monotonic()
+        self._lock = threading.Lock()
+        self.load()
+
+    def observe(self, model_id:str, sequence:str = "default") -> Optional[str]:
+        """
+        Record a request, following the previous request of the same sequence (e.g. client).
+
+        Returns:
+            str: The model that is likely to be requested next, if any.
+        """
+        with self._lock:
+            previous = self.previous.get(sequence)
+            self.previous[sequence] = model_id
+            if previous is not None:
+                following = self.transitions.setdefault(previous, dict[str, int]())
+                following[model_id] = following.get(model_id, 0) + 1
+        if self.path is not None and time.monotonic() - self.saved_at > PREFETCH_SAVE_INTERVAL:
+            self.save()
+        return self.predict(model_id)
+
+    def predict(self, model_id:str) -> Optional[str]:
+        with self._lock:
+            following = dict(self.transitions.get(model_id, {}))
+        total = sum(following.values())
+        if total < self.min_observations:
+            return None
+        next_model_id, count = max(following.items(), key=lambda item: item[1])
+        if next_model_id == model_id or count / total < self.min_probability:
+            return None
+        return next_model_id
+
+    def prefetch_after(self, model_id:str, sequence:str = "default") -> Optional[threading.Thread]:
+        """Record the request, and prefetch the likely next model in the background."""
+        next_model_id = self.observe(model_id, sequence)
+        if next_model_id is None or not PREFETCH_ENABLED:
+            return None
+        thread = threading.Thread(target=self._prefetch, args=(next_model_id,), name=f"prefetch {next_model_id}", daemon=True)
+        thread.start()
+        return thread
+
+    def _prefetch(self, model_id:str):
+        try:
+            if pool_for(model_id).prefetch(model_id):
+                logger.info("Prefetched %s", model_id)
+        except NotImplementedError:
+            logger.debug("Not prefetching %s, it is not supported", model_id)
+        except Exception as ex:
+            logger.exception("Failed to prefetch %s: %s", model_id, ex)
+            METRICS.increment("prefetch_failures")
+
+    def load(self):
+        if self.path is None or not self.path.exists():
+            return
+        try:
+            with self.path.open() as f:
+                self.transitions = json.load(f)
+        except (OSError, ValueError) as ex:
+            logger.warning("Ignoring the prefetch transitions %s: %s", self.path, ex)
+
+    def save(self):
+        if self.path is None:
+            return
+        with self._lock:
+            transitions = json.dumps(self.transitions, indent=2)
+            self.saved_at = time.monotonic()
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            staging = self.path.with_suffix(".tmp")
+            staging.write_text(transitions)
+            staging.replace(self.path)
+        except OSError as ex:
+            logger.warning("Failed to save the prefetch transitions %s: %s", self.path, ex)
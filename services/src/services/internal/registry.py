@@ -1,7 +1,15 @@
 import os
+import json
+import time
+import uuid
+import hashlib
+import threading
+from collections import deque
 from pathlib import Path
 from pydantic import BaseModel
-from typing import Optional
+from typing import Literal, Optional
+from services.internal.metrics import METRICS
+from services.internal.footprint import ModelFootprint, estimate_footprint
 import logging
 
 logger = logging.getLogger(__name__)
@@ -25,6 +33,16 @@ class ModelCard(BaseModel):
     metrics: Optional[set[str]] = None
     base_model: Optional[set[str]] = None
 
+    # The hub commit the files were downloaded from, or a fingerprint of the files for models that weren't downloaded from the hub
+    revision: Optional[str] = None
+
+    # The sizes a scheduler needs (parameters, dtype, context length, KV cache per token...), read from config.json and
+    # the safetensors headers when the model is scanned, without loading the weights
+    footprint: Optional[ModelFootprint] = None
+
+    # When set, this entry is a (LoRA) adapter which is served on top of the resident base model with this id
+    adapter_of: Optional[str] = None
+
     # TODO: consider https://github.com/huggingface/hub-docs/blob/main/modelcard.md?plain=1
     # TODO: prepopulate during import, and persist as part of the storage system
 
@@ -32,6 +50,8 @@ REASONING_MODELS = { # True - can start/stop reasoning using /think or /no_think
     "Qwen/Qwen3-4B":True,
     "deepseek-ai/DeepSeek-R1-Distill-Llama-8B":False,
 }
+ADAPTERS = { # Adapter model id -> base model id, overrides base_model_name_or_path of adapter_config.json (e.g. when it points to a local path)
+}
 UNSUPPORTED_MODELS = [
     "ByteDance-Seed/BAGEL-7B-MoT",
     "mistralai/Mixtral-8x7B-v0.1", # Too slow
@@ -39,8 +59,69 @@ UNSUPPORTED_MODELS = [
     "ByteDance-Seed/Seed-Coder-8B-Instruct", # Too slow
 ]
 
+# Bumped whenever the ModelCard inspection changes, so that older indexes are rescanned
+REGISTRY_INDEX_VERSION = 2
+
+class RegistryIndexEntry(BaseModel):
+    fingerprint: str
+    card: Optional[ModelCard] = None
+    """None for directories that aren't auto-configurable models."""
+
+class RegistryIndex(BaseModel):
+    version: int = REGISTRY_INDEX_VERSION
+    settings: str = ""
+    """A fingerprint of the module's settings (e.g. REASONING_MODELS) that the cards depend on."""
+
+    providers: dict[str, tuple[str, list[str]]] = {}
+    """Provider directory -> (fingerprint, model directories)."""
+
+    models: dict[str, RegistryIndexEntry] = {}
+
+class RegistryChanges(BaseModel):
+    added: set[str] = set()
+    changed: set[str] = set()
+    removed: set[str] = set()
+
+    def __bool__(self) -> bool:
+        return bool(self.added or self.changed or self.removed)
+
+# The number of model changes kept for the change feed, older versions must fetch the whole registry again
+REGISTRY_CHANGELOG_SIZE = int(os.getenv("SERVICES_REGISTRY_CHANGELOG_SIZE", "1024"))
+
+class RegistryChange(BaseModel):
+    version: int
+    model_id: str
+    change: Literal["added", "changed", "removed"]
+
+class RegistryChangeFeed(BaseModel):
+    epoch: str
+    """Identifies the registry instance, versions of different epochs (e.g. before a restart) aren't comparable."""
+
+    version: int
+    reset: bool = False
+    """True when the changes since the requested version are no longer known, so the whole registry must be fetched again."""
+
+    changes: list[RegistryChange] = []
+
+def fingerprint(dir:Path) -> str:
+    # Adding, removing or renaming an entry of the directory changes its mtime, replacing it changes its inode
+    stat = dir.stat()
+    return f"{stat.st_ino}:{stat.st_mtime_ns}"
+
+def settings_fingerprint() -> str:
+    return hashlib.sha256(json.dumps([REASONING_MODELS, ADAPTERS, UNSUPPORTED_MODELS], sort_keys=True).encode()).hexdigest()[:16]
+
 class Models:
-    def __init__(self, cache_location=os.getenv("HF_HOME")):
+    def __init__(self, cache_location=os.getenv("HF_HOME"), index_path:Optional[Path] = None, use_index:bool = True):
+        """
+        The models of the cache, inspected once and kept in an index, so that only the directories that changed since
+        are inspected again.
+
+        Args:
+            cache_location(str): The HF_HOME directory, whose hub directory holds the models as <provider>/<model>.
+            index_path(Path): Where the index is persisted, defaults to SERVICES_REGISTRY_INDEX or <cache_location>/services/registry_index.json.
+            use_index(bool): False to inspect all the models, without reading or writing the index.
+        """
         self.models = dict[str,ModelCard]()
         root = cache_location
         if root:
@@ -50,19 +131,158 @@ class Models:
             logger.warning("Using convention for cache_location: %s", root)
         self.cache_root = root / "hub"
         assert self.cache_root.exists() and self.cache_root.is_dir(), self.cache_root
+        self.index_path = Path(index_path or os.getenv("SERVICES_REGISTRY_INDEX", str(root / "services" / "registry_index.json")))
+        self.use_index = use_index
+        self.index = RegistryIndex(settings=settings_fingerprint())
+        self.inspected = 0
+        self._lock = threading.RLock()
+        # Bumped by every change of the models, clients pass it back (as an ETag or since) to skip unchanged snapshots
+        self.epoch = uuid.uuid4().hex[:8]
+        self.version = 0
+        self.changelog = deque[RegistryChange](maxlen=REGISTRY_CHANGELOG_SIZE)
+        self.providers = dict[str, list[str]]() # provider -> model names, rebuilt along with the models
+
+        start = time.perf_counter()
         self.update_cached()
+        elapsed = time.perf_counter() - start
+        METRICS.set("registry_scan_seconds", elapsed)
+        logger.info("Registered %d models in %.3fs, %d directories were inspected", len(self.models), elapsed, self.inspected)
+
+    def load_index(self) -> RegistryIndex:
+        if not self.use_index or not self.index_path.exists():
+            return RegistryIndex(settings=settings_fingerprint())
+        try:
+            index = RegistryIndex.model_validate_json(self.index_path.read_text())
+        except (OSError, ValueError) as ex:
+            logger.warning("Ignoring the registry index %s: %s", self.index_path, ex)
+            return RegistryIndex(settings=settings_fingerprint())
+        if index.version != REGISTRY_INDEX_VERSION or index.settings != settings_fingerprint():
+            logger.info("The registry index %s is outdated, all the models are inspected", self.index_path)
+            return RegistryIndex(settings=settings_fingerprint())
+        return index
+
+    def save_index(self):
+        if not self.use_index:
+            return
+        try:
+            self.index_path.parent.mkdir(parents=True, exist_ok=True)
+            staging = self.index_path.with_suffix(f".{os.getpid()}.tmp")
+            staging.write_text(self.index.model_dump_json())
+            staging.replace(self.index_path)
+        except OSError as ex:
+            logger.warning("Failed to save the registry index %s: %s", self.index_path, ex)
+
+    def refresh(self, model_ids:set[str] = frozenset()) -> RegistryChanges:
+        """
+        Rescan the cache, inspecting only the directories whose fingerprint changed since the last scan.
 
-    def update_cached(self):
+        Args:
+            model_ids(set[str]): Models to inspect again regardless of their fingerprint e.g. when their files were modified in place.
+        """
+        return self.update_cached(self.index, model_ids)
+
+    def follow_index(self) -> RegistryChanges:
+        """Adopt the index that another process saved (see `RegistryWatcher`), without scanning the cache."""
+        if not self.use_index:
+            return self.refresh()
+        with self._lock:
+            index = self.load_index()
+            models = {model_id: entry.card for model_id, entry in index.models.items() if entry.card is not None}
+            changes = RegistryChanges(
+                added=models.keys() - self.models.keys(),
+                changed={model_id for model_id in models.keys() & self.models.keys() if models[model_id] != self.models[model_id]},
+                removed=self.models.keys() - models.keys())
+            self.index = index
+            self.models = models
+            self.publish(changes)
+            return changes
+
+    def update_cached(self, previous:Optional[RegistryIndex] = None, model_ids:set[str] = frozenset()) -> RegistryChanges:
+        with self._lock:
+            return self._update_cached(self.load_index() if previous is None else previous, model_ids)
+
+    def _update_cached(self, previous:RegistryIndex, model_ids:set[str]) -> RegistryChanges:
+        self.index = RegistryIndex(settings=settings_fingerprint())
+        models = dict[str, ModelCard]()
+        changes = RegistryChanges()
         for dir in (self.cache_root).iterdir():
-            if dir.name.startswith("models--") or dir.name.startswith("datasets--") or dir.name == ".locks":
+            if dir.name.startswith("models--") or dir.name.startswith("datasets--") or dir.name.startswith(".") or not dir.is_dir():
                 continue # HF vanilla, which is not really supported by this module
             else:
-                for sub_dir in dir.iterdir():
-                    if sub_dir.is_dir():
-                        model_id = f"{dir.name}/{sub_dir.name}"
-                        if model_id not in UNSUPPORTED_MODELS:
-                            if not self.ensure_model_info(model_id, sub_dir):
-                                logger.warning("Non auto-configurable model: %s/%s", dir.name, sub_dir.name)
+                provider_fingerprint = fingerprint(dir)
+                cached = previous.providers.get(dir.name)
+                if cached is not None and cached[0] == provider_fingerprint:
+                    # No model was added or removed, so the directory isn't listed
+                    names = cached[1]
+                else:
+                    names = sorted(sub_dir.name for sub_dir in dir.iterdir() if sub_dir.is_dir())
+                self.index.providers[dir.name] = (provider_fingerprint, names)
+
+                for name in names:
+                    sub_dir = dir / name
+                    model_id = f"{dir.name}/{name}"
+                    if model_id in UNSUPPORTED_MODELS:
+                        continue
+                    try:
+                        model_fingerprint = fingerprint(sub_dir)
+                    except FileNotFoundError:
+                        continue
+                    entry = previous.models.get(model_id)
+                    if entry is None or entry.fingerprint != model_fingerprint or model_id in model_ids:
+                        self.inspected += 1
+                        card = self.inspect_model(model_id, sub_dir)
+                        if card is None:
+                            logger.warning("Non auto-configurable model: %s/%s", dir.name, name)
+                        elif model_id in self.models and self.models[model_id] != card:
+                            changes.changed.add(model_id)
+                        entry = RegistryIndexEntry(fingerprint=model_fingerprint, card=card)
+                    self.index.models[model_id] = entry
+                    if entry.card is not None:
+                        models[model_id] = entry.card
+
+        changes.added = models.keys() - self.models.keys()
+        changes.removed = self.models.keys() - models.keys()
+        changes.changed -= changes.removed
+        # Replaced at once, so that concurrent readers see either the previous or the new models
+        self.models = models
+        self.publish(changes)
+        if self.index != previous:
+            self.save_index()
+        return changes
+
+    def publish(self, changes:RegistryChanges):
+        """Bump the version, record the changes for the change feed and rebuild the provider index."""
+        with self._lock:
+            if not changes and self.version > 0:
+                return
+            self.version += 1
+            for change, model_ids in (("added", changes.added), ("changed", changes.changed), ("removed", changes.removed)):
+                for model_id in sorted(model_ids):
+                    self.changelog.append(RegistryChange(version=self.version, model_id=model_id, change=change))
+            providers = dict[str, list[str]]()
+            for model_id in self.models.keys():
+                provider, _, name = model_id.partition("/")
+                providers.setdefault(provider, []).append(name)
+            self.providers = providers
+            METRICS.set("registry_version", self.version)
+
+    @property
+    def etag(self) -> str:
+        return f'"{self.epoch}-{self.version}"'
+
+    def changes_since(self, version:int, epoch:Optional[str] = None) -> RegistryChangeFeed:
+        """The model changes after the given version, or a reset when they were dropped from the changelog (or the epoch differs)."""
+        with self._lock:
+            feed = RegistryChangeFeed(epoch=self.epoch, version=self.version)
+            if version == self.version and epoch in (None, self.epoch):
+                return feed
+            # The oldest version may have been partially dropped from the changelog
+            oldest = self.changelog[0].version if self.changelog else self.version + 1
+            if version > self.version or version < oldest or epoch not in (None, self.epoch):
+                feed.reset = True
+                return feed
+            feed.changes = [change for change in self.changelog if change.version > version]
+            return feed
 
     def ensure_mode_info_from_cache(self, dir:Path) -> bool:
         parts = dir.name.split("--")
@@ -73,26 +293,82 @@ class Models:
     
     def ensure_model_info(self, model_id:str, dir:Path) -> bool:
         if model_id not in self.models:
-            for root, dirs, files in dir.walk(True, follow_symlinks=True):
-                supports_reasoning = model_id in REASONING_MODELS
-                supports_reasoning_onoff = supports_reasoning and REASONING_MODELS[model_id]
-                if "config.json" or "model_index.json" in files:
-                    self.models[model_id] = ModelCard(
-                        model_id=model_id, 
-                        created=int(os.stat(dir).st_birthtime),
-                        location=root, 
-                        supports_reasoning=supports_reasoning,
-                        supports_reasoning_onoff=supports_reasoning_onoff)
-                    return True
-            
-            return False
+            card = self.inspect_model(model_id, dir)
+            if card is None:
+                return False
+            self.models[model_id] = card
         return True
+
+    def inspect_model(self, model_id:str, dir:Path) -> Optional[ModelCard]:
+        for root, dirs, files in dir.walk(True, follow_symlinks=True):
+            # Caches e.g. the hub client's download metadata and the load artifacts
+            dirs[:] = [d for d in dirs if not d.startswith(".")]
+            supports_reasoning = model_id in REASONING_MODELS
+            supports_reasoning_onoff = supports_reasoning and REASONING_MODELS[model_id]
+            if "adapter_config.json" in files:
+                return ModelCard(
+                    model_id=model_id, 
+                    created=int(os.stat(dir).st_birthtime),
+                    location=root, 
+                    revision=self.read_revision(root),
+                    footprint=self.read_footprint(root),
+                    adapter_of=self.read_adapter_base_model(model_id, root / "adapter_config.json"))
+            if "config.json" in files or "model_index.json" in files:
+                return ModelCard(
+                    model_id=model_id, 
+                    created=int(os.stat(dir).st_birthtime),
+                    location=root, 
+                    revision=self.read_revision(root),
+                    footprint=self.read_footprint(root),
+                    supports_reasoning=supports_reasoning,
+                    supports_reasoning_onoff=supports_reasoning_onoff)
+        return None
     
+    @staticmethod
+    def read_footprint(location:Path) -> Optional[ModelFootprint]:
+        try:
+            return estimate_footprint(location)
+        except (OSError, ValueError) as ex:
+            logger.warning("Failed to estimate the footprint of %s: %s", location, ex)
+            return None
+
+    @staticmethod
+    def read_revision(location:Path) -> str:
+        # snapshot_download(local_dir=...) keeps the commit hash as the first line of each file's metadata
+        for metadata in sorted((location / ".cache" / "huggingface" / "download").glob("*.metadata")):
+            with metadata.open() as f:
+                commit_hash = f.readline().strip()
+            if commit_hash:
+                return commit_hash
+        digest = hashlib.sha256()
+        for path in sorted(location.iterdir()):
+            if path.is_file():
+                stat = path.stat()
+                digest.update(f"{path.name}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+        return "local-" + digest.hexdigest()[:16]
+
+    def read_adapter_base_model(self, model_id:str, adapter_config:Path) -> str:
+        if model_id in ADAPTERS:
+            return ADAPTERS[model_id]
+        with adapter_config.open() as f:
+            return json.load(f)["base_model_name_or_path"]
+
+    def base_model_of(self, model_id:str) -> str:
+        model_info = self.models.get(model_id)
+        if model_info is not None and model_info.adapter_of:
+            return model_info.adapter_of
+        return model_id
+
     def import_model(self, model_id:str, **kwargs) -> ModelCard:
         from huggingface_hub import snapshot_download
 
         downloaded = snapshot_download(repo_id=model_id, local_dir=str(self.cache_root / model_id), **kwargs)
 
-        assert self.ensure_model_info(model_id, Path(downloaded))
+        with self._lock:
+            existed = model_id in self.models
+            assert self.ensure_model_info(model_id, Path(downloaded))
+            self.index.models[model_id] = RegistryIndexEntry(fingerprint=fingerprint(Path(downloaded)), card=self.models[model_id])
+            self.save_index()
+            self.publish(RegistryChanges(changed={model_id}) if existed else RegistryChanges(added={model_id}))
         
         return self.models[model_id]
@@ -0,0 +1,38 @@
+import os
+import numpy as np
+from pydantic import BaseModel
+from typing import Iterator, Optional
+
+# The padded tokens that a batch of (query, passage) pairs may take, the batches of short pairs are larger than those of long ones
+RERANK_BATCH_TOKENS = int(os.getenv("SERVICES_RERANK_BATCH_TOKENS", "16384"))
+# The pairs of a batch, however short they are
+RERANK_MAX_BATCH_SIZE = int(os.getenv("SERVICES_RERANK_MAX_BATCH_SIZE", "128"))
+
+class RerankResult(BaseModel):
+    index: int
+    """The index of the passage in the request."""
+
+    relevance_score: float
+    document: Optional[str] = None
+
+def dynamic_batches(lengths:list[int], max_tokens:int = RERANK_BATCH_TOKENS, max_batch_size:int = RERANK_MAX_BATCH_SIZE) -> Iterator[list[int]]:
+    """
+    Group the indexes of the pairs into batches of similar lengths, sorted by length so that little of each batch is padding,
+    each one growing while its size times its longest pair fits in `max_tokens` (a longer pair is a batch of its own).
+    """
+    batch = list[int]()
+    for i in np.argsort(lengths, kind="stable").tolist():
+        if batch and ((len(batch) + 1) * lengths[i] > max_tokens or len(batch) == max_batch_size):
+            yield batch
+            batch = []
+        batch.append(i)
+    if batch:
+        yield batch
+
+def top_n(scores:np.ndarray, n:Optional[int] = None) -> list[int]:
+    """The indexes of the n highest scores (all of them when n is None), in decreasing order."""
+    n = len(scores) if n is None else min(n, len(scores))
+    if n <= 0:
+        return []
+    indexes = np.argpartition(-scores, n - 1)[:n] if n < len(scores) else np.arange(len(scores))
+    return indexes[np.argsort(-scores[indexes], kind="stable")].tolist()
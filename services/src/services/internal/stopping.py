@@ -0,0 +1,115 @@
+import math
+import torch
+from contextlib import contextmanager, nullcontext
+from pydantic import BaseModel
+from transformers import StoppingCriteria
+from typing import ContextManager, Iterable, Iterator
+import logging
+
+logger = logging.getLogger(__name__)
+
+class RunawayGenerationConfig(BaseModel):
+    max_period: int = 64
+    """The longest repeated n-gram (in tokens) that is looked for."""
+
+    min_repeats: int = 4
+    """The number of back to back repetitions of an n-gram that is considered a loop."""
+
+    min_repeated_tokens: int = 64
+    """The minimal length of the repeated tail, so that short legit repetitions (e.g. "-----") are not aborted."""
+
+    entropy_threshold: float = None
+    """Next token entropy (in nats) below which the generation is considered stalled, None to disable."""
+
+    entropy_patience: int = 256
+    """The number of consecutive stalled tokens after which the generation is aborted."""
+
+class EntropyMonitor:
+    def __init__(self, threshold:float):
+        """
+        Counts the consecutive low entropy steps of each sequence, from the raw next token logits of the model's output layer
+        (before the temperature, top-k and top-p warpers truncate the distribution).
+        """
+        self.threshold = threshold
+        self.stalled_steps:torch.Tensor = None
+
+    def observe(self, logits:torch.FloatTensor):
+        log_probs = torch.log_softmax(logits.float(), dim=-1)
+        entropy = -(log_probs.exp() * log_probs).nan_to_num().sum(dim=-1)
+        stalled = entropy < self.threshold
+        if self.stalled_steps is None:
+            self.stalled_steps = torch.zeros_like(stalled, dtype=torch.long)
+        self.stalled_steps = torch.where(stalled, self.stalled_steps + 1, 0)
+
+    @contextmanager
+    def watching(self, model) -> Iterator[None]:
+        """Observe the logits of the model's output layer, at the last position, during the generation."""
+        handle = model.get_output_embeddings().register_forward_hook(lambda module, inputs, logits: self.observe(logits[:, -1, :]))
+        try:
+            yield
+        finally:
+            handle.remove()
+
+class RunawayGenerationCriteria(StoppingCriteria):
+    def __init__(self, prompt_length:int, config:RunawayGenerationConfig, eos_token_ids:Iterable[int] = ()):
+        """
+        Stops sequences that degenerated into a loop of repeated n-grams, or stalled in a low entropy state.
+
+        Args:
+            prompt_length(int): The number of (padded) prompt tokens, which are not checked for repetitions.
+            config(RunawayGenerationConfig): The detection thresholds.
+            eos_token_ids(Iterable[int]): The EOS (and pad) tokens, the sequences that generated one are finished and
+                their padded tail isn't a loop.
+        """
+        self.prompt_length = prompt_length
+        self.config = config
+        self.eos_token_ids = torch.tensor(sorted(set(eos_token_ids)), dtype=torch.long)
+        self.entropy_monitor = EntropyMonitor(config.entropy_threshold) if config.entropy_threshold is not None else None
+        self.triggered = set[int]()
+        self.generated_tokens = 0
+        self.periods = torch.arange(1, config.max_period + 1)
+        # The length of the repeated tail that is a loop, by period
+        self.required = torch.tensor([period * self._repeats(period) for period in range(1, config.max_period + 1)])
+        # The longest tail that needs to be inspected
+        self.window = int(self.required.max())
+
+    def watching(self, model) -> ContextManager:
+        return self.entropy_monitor.watching(model) if self.entropy_monitor is not None else nullcontext()
+
+    def _repeats(self, period:int) -> int:
+        return max(self.config.min_repeats, math.ceil(self.config.min_repeated_tokens / period))
+
+    def _is_looping(self, generated:torch.LongTensor) -> torch.BoolTensor:
+        """
+        Whether the tail of each sequence repeats with any period, i.e. token[t] == token[t - period] over the last
+        `required - period` tokens, checking all the periods at once on the device.
+        """
+        batch, length = generated.shape
+        window = generated[:, -self.window:]
+        if window.shape[1] < self.window:
+            window = torch.cat([window.new_full((batch, self.window - window.shape[1]), -1), window], dim=1)
+        padded = torch.cat([window.new_full((batch, self.config.max_period), -2), window], dim=1)
+        # shifted[:, period - 1, t] == window[:, t - period]
+        shifted = padded.unfold(1, self.window, 1)[:, :self.config.max_period].flip(1)
+        # The number of trailing tokens that match the token a period before them
+        matching = (window[:, None, :] == shifted).flip(-1).long().cumprod(dim=-1).sum(dim=-1)
+        required = self.required.to(generated.device)
+        return ((matching >= required - self.periods.to(generated.device)) & (length >= required)).any(dim=1)
+
+    def __call__(self, input_ids:torch.LongTensor, scores:torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        self.generated_tokens = input_ids.shape[1] - self.prompt_length
+        generated = input_ids[:, self.prompt_length:]
+        is_done = self._is_looping(generated)
+        if self.entropy_monitor is not None and self.entropy_monitor.stalled_steps is not None:
+            is_done |= self.entropy_monitor.stalled_steps.to(is_done.device) >= self.config.entropy_patience
+        if len(self.eos_token_ids):
+            # Finished already, and padded until the longest sequence of the batch finishes
+            is_done &= ~torch.isin(generated, self.eos_token_ids.to(generated.device)).any(dim=1)
+        if self.triggered:
+            is_done[list(self.triggered)] = True
+        if is_done.any():
+            for i in is_done.nonzero().flatten().tolist():
+                if i not in self.triggered:
+                    logger.warning("Aborting runaway generation of sequence %d after %d tokens", i, self.generated_tokens)
+                    self.triggered.add(i)
+        return is_done
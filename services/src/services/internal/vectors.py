@@ -0,0 +1,359 @@
+import os
+import re
+import json
+import fcntl
+import shutil
+import threading
+import numpy as np
+from contextlib import contextmanager
+from pathlib import Path
+from pydantic import BaseModel
+from typing import Any, Literal, Optional
+from services.internal.metrics import METRICS
+import logging
+
+logger = logging.getLogger(__name__)
+
+Metric = Literal["cosine", "dot", "euclidean"]
+
+# The rows of a collection are scored against the queries this many at a time, bounding the memory of the scores
+QUERY_BLOCK_ROWS = int(os.getenv("SERVICES_VECTORS_QUERY_BLOCK_ROWS", "65536"))
+INITIAL_CAPACITY = 1024
+# The log of rows is rewritten with a line per row once it has this many stale lines
+COMPACT_LOG_LINES = int(os.getenv("SERVICES_VECTORS_COMPACT_LOG_LINES", "100000"))
+INFO_FILE = "collection.json"
+LOG_FILE = "rows.jsonl"
+VECTORS_FILE = "vectors.f32"
+LOCK_FILE = "lock"
+COLLECTION_NAME = re.compile(r"^[A-Za-z0-9_.-]{1,128}$")
+
+class CollectionInfo(BaseModel):
+    name: str
+    model: str
+    """The embeddings model the texts are encoded with."""
+
+    dimensions: int
+    metric: Metric = "cosine"
+    count: int = 0
+
+class Match(BaseModel):
+    id: str
+    score: float
+    """Higher is more similar, the euclidean score is the negated distance."""
+
+    metadata: Optional[dict[str, Any]] = None
+
+def top_k(scores:np.ndarray, k:int) -> tuple[np.ndarray, np.ndarray]:
+    """The indexes and scores of the k highest scores of each row, in decreasing order."""
+    k = min(k, scores.shape[1])
+    if k < scores.shape[1]:
+        indexes = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        indexes = np.broadcast_to(np.arange(scores.shape[1]), scores.shape).copy()
+    selected = np.take_along_axis(scores, indexes, axis=1)
+    order = np.argsort(-selected, axis=1, kind="stable")
+    return np.take_along_axis(indexes, order, axis=1), np.take_along_axis(selected, order, axis=1)
+
+class VectorCollection:
+    def __init__(self, directory:Path, info:CollectionInfo):
+        """
+        A named set of vectors, stored as a contiguous float32 matrix that is memory-mapped and grown by doubling,
+        with an append-only log of the ids and metadata of its rows.
+        The worker processes share the files, the writes are serialized by a lock on the collection, and each process
+        replays the lines that the others logged (see `refresh`).
+
+        Args:
+            directory(Path): Where the collection is persisted.
+            info(CollectionInfo): The settings of the collection.
+        """
+        self.directory = Path(directory)
+        self.info = info
+        self.ids = list[str]()
+        self.metadata = list[Optional[dict[str, Any]]]()
+        self.rows = dict[str, int]() # id -> row
+        self.norms = np.zeros(0, dtype=np.float32) # The squared norms of the rows, for cosine and euclidean
+        self.vectors:Optional[np.memmap] = None
+        self.logged = 0 # The bytes of the log that were replayed
+        self.log_lines = 0
+        self.log_inode:Optional[int] = None
+        self._lock = threading.RLock()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        if not (self.directory / INFO_FILE).exists():
+            staging = self.directory / f"{INFO_FILE}.tmp"
+            staging.write_text(self.info.model_dump_json(indent=2))
+            staging.replace(self.directory / INFO_FILE)
+        self.refresh()
+
+    @property
+    def count(self) -> int:
+        return len(self.ids)
+
+    @contextmanager
+    def _locked(self, exclusive:bool):
+        with (self.directory / LOCK_FILE).open("a") as f:
+            # Released once the file is closed
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            yield
+
+    def refresh(self):
+        """Replay the lines that were logged since they were last read, by this or another process."""
+        with self._lock, self._locked(exclusive=False):
+            self._read_tail()
+
+    def _read_tail(self):
+        path = self.directory / LOG_FILE
+        tail = b""
+        if path.exists():
+            with path.open("rb") as f:
+                inode = os.fstat(f.fileno()).st_ino
+                if inode != self.log_inode:
+                    # Compacted (or failed to be written) meanwhile, replayed from the start
+                    self.ids, self.metadata, self.rows = [], [], {}
+                    self.norms = np.zeros(0, dtype=np.float32)
+                    self.logged, self.log_lines, self.log_inode = 0, 0, inode
+                f.seek(self.logged)
+                tail = f.read()
+        # A line without its newline (interrupted write) is ignored, and truncated by the next write
+        tail = tail[:tail.rfind(b"\n") + 1]
+        touched = set[int]()
+        for line in tail.splitlines():
+            self._replay(json.loads(line), touched)
+        self.logged += len(tail)
+        self.log_lines += tail.count(b"\n")
+        self._map(max(INITIAL_CAPACITY, self.count))
+        self._update_norms(touched)
+
+    def _replay(self, entry:dict[str, Any], touched:set[int]) -> dict[str, Any]:
+        """Apply a line of the log: either a row that holds an id (and its metadata), or the count of rows that are kept."""
+        if "count" in entry:
+            for row in range(entry["count"], self.count):
+                if self.rows.get(self.ids[row]) == row:
+                    del self.rows[self.ids[row]]
+            del self.ids[entry["count"]:]
+            del self.metadata[entry["count"]:]
+            return entry
+        row = entry["row"]
+        if row == self.count:
+            self.ids.append(entry["id"])
+            self.metadata.append(entry.get("metadata"))
+        else:
+            if self.rows.get(self.ids[row]) == row:
+                del self.rows[self.ids[row]]
+            self.ids[row] = entry["id"]
+            self.metadata[row] = entry.get("metadata")
+        self.rows[entry["id"]] = row
+        touched.add(row)
+        return entry
+
+    def _log(self, entries:list[dict[str, Any]], touched:set[int]):
+        """Append the lines that were replayed already, under the exclusive lock."""
+        if not entries:
+            return
+        data = b"".join(json.dumps(entry).encode() + b"\n" for entry in entries)
+        try:
+            with (self.directory / LOG_FILE).open("ab") as f:
+                # Truncated to the complete lines, dropping the line of an interrupted write
+                f.truncate(self.logged)
+                f.write(data)
+                inode = os.fstat(f.fileno()).st_ino
+        except OSError:
+            # Replayed from the log on the next read, which drops the lines that weren't written
+            self.log_inode = None
+            raise
+        if self.log_inode is None and self.logged == 0:
+            self.log_inode = inode
+        self.logged += len(data)
+        self.log_lines += len(entries)
+        self._update_norms(touched)
+        if self.log_lines - self.count >= COMPACT_LOG_LINES:
+            self._compact()
+
+    def _compact(self):
+        """Rewrite the log with a line per row, the other processes replay it from the start."""
+        staging = self.directory / f"{LOG_FILE}.tmp"
+        data = b"".join(
+            json.dumps({"row": row, "id": id, "metadata": metadata}).encode() + b"\n"
+            for row, (id, metadata) in enumerate(zip(self.ids, self.metadata)))
+        staging.write_bytes(data)
+        staging.replace(self.directory / LOG_FILE)
+        self.log_inode = (self.directory / LOG_FILE).stat().st_ino
+        self.logged = len(data)
+        self.log_lines = self.count
+
+    def _map(self, capacity:int):
+        """Map the vectors, growing the file to the capacity, or to the rows that another process grew it to."""
+        path = self.directory / VECTORS_FILE
+        row_bytes = self.info.dimensions * 4
+        with path.open("ab") as f:
+            if f.tell() < capacity * row_bytes:
+                f.truncate(capacity * row_bytes)
+        capacity = path.stat().st_size // row_bytes
+        if self.vectors is None or self.vectors.shape[0] != capacity:
+            # The mapping is shared, the rows written through the previous one aren't lost
+            self.vectors = np.memmap(path, dtype=np.float32, mode="r+", shape=(capacity, self.info.dimensions))
+
+    def _update_norms(self, touched:set[int]):
+        if len(self.norms) != self.count:
+            norms = np.zeros(self.count, dtype=np.float32)
+            kept = min(len(self.norms), self.count)
+            norms[:kept] = self.norms[:kept]
+            self.norms = norms
+        rows = np.array(sorted(row for row in touched if row < self.count), dtype=np.int64)
+        if len(rows):
+            self.norms[rows] = np.einsum("ij,ij->i", self.vectors[rows], self.vectors[rows])
+        self.info.count = self.count
+
+    def upsert(self, ids:list[str], vectors:np.ndarray, metadata:Optional[list[Optional[dict[str, Any]]]] = None):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if vectors.shape != (len(ids), self.info.dimensions):
+            raise ValueError(f"Expected {len(ids)} vectors of {self.info.dimensions} dimensions, got {vectors.shape}")
+        metadata = metadata or [None] * len(ids)
+        with self._lock, self._locked(exclusive=True):
+            # Including the rows of the other processes
+            self._read_tail()
+            new = sum(id not in self.rows for id in set(ids))
+            if self.count + new > self.vectors.shape[0]:
+                self._map(max(self.vectors.shape[0] * 2, self.count + new))
+            entries = list[dict[str, Any]]()
+            touched = set[int]()
+            for id, vector, item_metadata in zip(ids, vectors, metadata):
+                row = self.rows.get(id, self.count)
+                # The vectors are written before the lines that log them
+                self.vectors[row] = vector
+                entries.append(self._replay({"row": row, "id": id, "metadata": item_metadata}, touched))
+            self._log(entries, touched)
+
+    def delete(self, ids:list[str]) -> int:
+        """Delete the rows, moving the last rows into their place so that the matrix stays contiguous."""
+        with self._lock, self._locked(exclusive=True):
+            self._read_tail()
+            entries = list[dict[str, Any]]()
+            touched = set[int]()
+            for id in ids:
+                row = self.rows.get(id)
+                if row is None:
+                    continue
+                last = self.count - 1
+                if row != last:
+                    self.vectors[row] = self.vectors[last]
+                    entries.append(self._replay({"row": row, "id": self.ids[last], "metadata": self.metadata[last]}, touched))
+                entries.append(self._replay({"count": last}, touched))
+            self._log(entries, touched)
+            return sum("count" in entry for entry in entries)
+
+    def query(self, queries:np.ndarray, k:int = 10, block_rows:int = QUERY_BLOCK_ROWS) -> list[list[Match]]:
+        """The k most similar rows of each query, scoring all the queries at once, one block of rows at a time."""
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        if queries.shape[1] != self.info.dimensions:
+            raise ValueError(f"Expected queries of {self.info.dimensions} dimensions, got {queries.shape[1]}")
+        metric = self.info.metric
+        query_norms = np.einsum("ij,ij->i", queries, queries)
+        with self._lock, self._locked(exclusive=False):
+            self._read_tail()
+            count = self.count
+            best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+            best_scores = np.zeros((len(queries), 0), dtype=np.float32)
+            for start in range(0, count, block_rows):
+                block = self.vectors[start:min(start + block_rows, count)]
+                scores = queries @ block.T
+                norms = self.norms[start:start + len(block)]
+                if metric == "cosine":
+                    scores /= np.sqrt(np.outer(query_norms, norms)).clip(min=1e-12)
+                elif metric == "euclidean":
+                    scores = -np.sqrt((query_norms[:, None] + norms[None, :] - 2 * scores).clip(min=0))
+                rows, block_scores = top_k(scores, k)
+                # Merged with the best rows of the previous blocks
+                best_rows = np.concatenate([best_rows, rows + start], axis=1)
+                best_scores = np.concatenate([best_scores, block_scores], axis=1)
+                selected, best_scores = top_k(best_scores, k)
+                best_rows = np.take_along_axis(best_rows, selected, axis=1)
+            METRICS.observe("vectors_query_batch", len(queries), collection=self.info.name)
+            return [
+                [Match(id=self.ids[row], score=float(score), metadata=self.metadata[row]) for row, score in zip(rows, scores)]
+                for rows, scores in zip(best_rows, best_scores)]
+
+class VectorCollections:
+    def __init__(self, root:Path):
+        """
+        The vector collections, persisted as one directory each under root, which the worker processes share: a
+        collection that another process created (or deleted) is found on disk (see `get` and `load`).
+        """
+        self.root = Path(root)
+        self.collections = dict[str, VectorCollection]()
+        self._lock = threading.Lock()
+        self.load()
+
+    @contextmanager
+    def _locked(self):
+        # Serializes the creations and deletions of the processes
+        self.root.mkdir(parents=True, exist_ok=True)
+        with (self.root / LOCK_FILE).open("a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    def _open(self, name:str) -> Optional[VectorCollection]:
+        path = self.root / name / INFO_FILE
+        if not COLLECTION_NAME.match(name) or not path.exists():
+            return None
+        try:
+            info = CollectionInfo.model_validate_json(path.read_text())
+            collection = self.collections[info.name] = VectorCollection(path.parent, info)
+            return collection
+        except (OSError, ValueError) as ex:
+            logger.warning("Ignoring the vector collection %s: %s", path.parent, ex)
+            return None
+
+    def load(self) -> dict[str, VectorCollection]:
+        """The collections, including those that the other processes created meanwhile, less those they deleted."""
+        with self._lock:
+            for name in [name for name, collection in self.collections.items() if not (collection.directory / INFO_FILE).exists()]:
+                del self.collections[name]
+            if self.root.exists():
+                for path in sorted(self.root.glob(f"*/{INFO_FILE}")):
+                    if path.parent.name not in self.collections:
+                        self._open(path.parent.name)
+            return dict(self.collections)
+
+    def get(self, name:str) -> VectorCollection:
+        """The collection, raises KeyError if there is no such collection."""
+        with self._lock:
+            collection = self.collections.get(name)
+            if collection is not None and not (collection.directory / INFO_FILE).exists():
+                # Deleted by another process
+                del self.collections[name]
+                collection = None
+            if collection is None:
+                collection = self._open(name)
+            if collection is None:
+                raise KeyError(name)
+            return collection
+
+    def create(self, info:CollectionInfo) -> VectorCollection:
+        if not COLLECTION_NAME.match(info.name):
+            raise ValueError(f"Invalid collection name: {info.name}")
+        with self._lock, self._locked():
+            existing = self.collections.get(info.name) or self._open(info.name)
+            if existing is not None and (existing.directory / INFO_FILE).exists():
+                if (existing.info.model, existing.info.dimensions, existing.info.metric) != (info.model, info.dimensions, info.metric):
+                    raise FileExistsError(f"The collection {info.name} exists with other settings")
+                return existing
+            collection = self.collections[info.name] = VectorCollection(self.root / info.name, info.model_copy(update={"count": 0}))
+            return collection
+
+    def delete(self, name:str) -> bool:
+        if not COLLECTION_NAME.match(name):
+            return False
+        with self._lock, self._locked():
+            collection = self.collections.pop(name, None)
+            directory = self.root / name
+            if not (directory / INFO_FILE).exists():
+                return False
+            with (directory / LOCK_FILE).open("a") as f:
+                # After the writes in progress, of this or another process
+                fcntl.flock(f, fcntl.LOCK_EX)
+                (directory / INFO_FILE).unlink()
+                if collection is not None:
+                    with collection._lock:
+                        collection.vectors = None
+                shutil.rmtree(directory, ignore_errors=True)
+            return True
@@ -0,0 +1,151 @@
+import os
+import threading
+from pathlib import Path
+from typing import Callable, Optional
+from services.internal.registry import Models, RegistryChanges
+from services.internal.blobs import BLOB_STAGING_SUFFIX
+from services.internal.pool import POOLS
+from services.internal.metrics import METRICS
+import logging
+
+logger = logging.getLogger(__name__)
+
+REGISTRY_WATCH_ENABLED = os.getenv("SERVICES_REGISTRY_WATCH", "True").lower() == "true"
+# Changes are applied once the cache was quiet for this long, so that a model that is being copied is inspected once
+REGISTRY_WATCH_DEBOUNCE_SECONDS = float(os.getenv("SERVICES_REGISTRY_WATCH_DEBOUNCE_SECONDS", "2"))
+# The rescan interval, when inotify (through watchfiles) isn't available
+REGISTRY_POLL_SECONDS = float(os.getenv("SERVICES_REGISTRY_POLL_SECONDS", "30"))
+
+def invalidate_pools(changes:RegistryChanges):
+    for model_id in changes.changed | changes.removed:
+        for pool in POOLS:
+            if pool.invalidate(model_id):
+                logger.info("Unloaded %s from %s, its files changed", model_id, pool.inference_type.__name__)
+
+class RegistryWatcher:
+    def __init__(self,
+                 registry:Models,
+                 on_change:Callable[[RegistryChanges], None] = invalidate_pools,
+                 debounce:float = REGISTRY_WATCH_DEBOUNCE_SECONDS,
+                 poll_interval:float = REGISTRY_POLL_SECONDS,
+                 use_inotify:bool = True,
+                 follow:bool = False):
+        """
+        Keeps the registry up to date with the models that are added to, modified in, or removed from the cache.
+        With several worker processes, one of them watches the cache and the others follow the index it saves.
+
+        Args:
+            registry(Models): The registry to refresh.
+            on_change(Callable): Called with the changes of every refresh that changed anything, by default the changed
+                                 and removed models are unloaded from the pools.
+            debounce(float): See `REGISTRY_WATCH_DEBOUNCE_SECONDS`.
+            poll_interval(float): See `REGISTRY_POLL_SECONDS`.
+            use_inotify(bool): False to poll even when watchfiles is installed.
+            follow(bool): Adopt the registry index whenever another process saves it, instead of watching the cache.
+        """
+        self.registry = registry
+        self.on_change = on_change
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.use_inotify = use_inotify
+        self.follow = follow
+        self._index_saved_at:Optional[int] = None
+        self._stop = threading.Event()
+        self._thread:Optional[threading.Thread] = None
+
+    def model_id_of(self, path:Path) -> Optional[str]:
+        """The model whose files the path belongs to, None for paths that aren't model files (e.g. the hub client's caches)."""
+        try:
+            parts = Path(path).relative_to(self.registry.cache_root).parts
+        except ValueError:
+            return None
+        if len(parts) < 2 or any(part.startswith(".") for part in parts) or parts[0].startswith(("models--", "datasets--")):
+            return None
+        if parts[-1].endswith(BLOB_STAGING_SUFFIX):
+            # Linked aside by the deduplication, and renamed over the model file (whose content doesn't change)
+            return None
+        return f"{parts[0]}/{parts[1]}"
+
+    def apply(self, model_ids:set[str] = frozenset()) -> RegistryChanges:
+        """Refresh the registry, inspecting the given models again, and notify about the changes."""
+        changes = self.registry.refresh(model_ids)
+        if changes:
+            logger.info("Registry changes, added: %s, changed: %s, removed: %s", changes.added, changes.changed, changes.removed)
+            METRICS.increment("registry_refreshes")
+            self.on_change(changes)
+        return changes
+
+    def start(self):
+        self._stop.clear()
+        # Before the thread starts, so that an index saved meanwhile isn't missed
+        self._index_saved_at = self._index_mtime()
+        self._thread = threading.Thread(target=self._run, name="registry watcher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=max(self.poll_interval, 5))
+            self._thread = None
+
+    def _run(self):
+        try:
+            if self.follow:
+                self._follow()
+                return
+            if self.use_inotify:
+                try:
+                    import watchfiles
+                except ImportError:
+                    logger.info("watchfiles is not installed, the registry is polled every %.0fs", self.poll_interval)
+                else:
+                    self._watch(watchfiles)
+                    return
+            self._poll()
+        except Exception as ex:
+            logger.exception("The registry watcher stopped: %s", ex)
+
+    def _watch(self, watchfiles):
+        logger.info("Watching %s", self.registry.cache_root)
+        for events in watchfiles.watch(
+                self.registry.cache_root,
+                debounce=int(self.debounce * 1000),
+                stop_event=self._stop,
+                rust_timeout=int(self.poll_interval * 1000),
+                yield_on_timeout=False):
+            model_ids = {model_id for _, path in events if (model_id := self.model_id_of(path)) is not None}
+            if model_ids:
+                self._apply_safely(model_ids)
+
+    def _follow(self):
+        # A stat of the index per debounce interval, the cache itself is scanned by the watching process only
+        saved_at = self._index_saved_at
+        while not self._stop.wait(self.debounce):
+            mtime = self._index_mtime()
+            if mtime == saved_at:
+                continue
+            saved_at = mtime
+            try:
+                changes = self.registry.follow_index()
+                if changes:
+                    logger.info("Registry changes, added: %s, changed: %s, removed: %s", changes.added, changes.changed, changes.removed)
+                    self.on_change(changes)
+            except Exception as ex:
+                logger.exception("Failed to follow the registry index: %s", ex)
+
+    def _index_mtime(self) -> Optional[int]:
+        try:
+            return self.registry.index_path.stat().st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _poll(self):
+        # The directory fingerprints detect added, removed and replaced models, but not files that are modified in place
+        while not self._stop.wait(self.poll_interval):
+            self._apply_safely()
+
+    def _apply_safely(self, model_ids:set[str] = frozenset()):
+        try:
+            self.apply(model_ids)
+        except Exception as ex:
+            logger.exception("Failed to refresh the registry: %s", ex)
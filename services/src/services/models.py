@@ -1,15 +1,13 @@
-from fastapi import status, APIRouter, HTTPException
+from fastapi import status, APIRouter, HTTPException, Request, Response
 from pydantic import BaseModel
 from typing import Literal, List
-from services.internal.registry import Models
+from services.registry import REGISTRY, not_modified
 import logging
 
 logger = logging.getLogger(__name__)
 
 models_router = APIRouter()
 
-REGISTRY = Models()
-
 class Model(BaseModel):
     id: str
     """The model identifier, which can be referenced in the API endpoints."""
@@ -36,11 +34,14 @@ class ModelsResponse(BaseModel):
     status_code=status.HTTP_200_OK,
     response_model=ModelsResponse
 )
-def get_models() -> ModelsResponse:
-    response = ModelsResponse(data=list[Model](), object="list")
+def get_models(request:Request, response:Response) -> ModelsResponse:
+    cached = not_modified(request, response)
+    if cached is not None:
+        return cached
+    models = ModelsResponse(data=list[Model](), object="list")
     for k,v in REGISTRY.models.items():
-        response.data.append(Model(id=k, created=v.created, object="model", owned_by="me"))
-    return response
+        models.data.append(Model(id=k, created=v.created, object="model", owned_by="me"))
+    return models
 
 
 @models_router.get(
@@ -48,11 +49,14 @@ def get_models() -> ModelsResponse:
     status_code=status.HTTP_200_OK,
     response_model=Model
 )
-def get_model(provider:str, model:str=None) -> Model:
+def get_model(provider:str, request:Request, response:Response, model:str=None) -> Model:
     model_id = "/".join([provider, model])
     if model_id not in REGISTRY.models:
         raise HTTPException(status_code=404, detail=f"No such model.")
-    
+
+    cached = not_modified(request, response)
+    if cached is not None:
+        return cached
     return Model(
         id=model_id, 
         created=REGISTRY.models[model_id].created, 
@@ -1,19 +1,37 @@
 # TODO: move towards https://github.com/xregistry/spec
-from fastapi import status, APIRouter, HTTPException
+from fastapi import status, APIRouter, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from typing import List, Optional
-from services.internal.registry import ModelCard, Models
+from services.internal.registry import ModelCard, Models, RegistryChangeFeed
+from services.internal.imports import ImportJobs, ImportJob, HuggingFaceHub
+from services.internal.blobs import BlobStore, StorageReport, BLOBS_DIR, BLOB_STORE_ENABLED
 import logging
 
 logger = logging.getLogger(__name__)
 
 registry_router = APIRouter()
 
+# The one registry of the process, shared by all the routers
 REGISTRY = Models()
+BLOBS = BlobStore(REGISTRY.cache_root / BLOBS_DIR)
+IMPORTS = ImportJobs(REGISTRY, HuggingFaceHub(), blobs=BLOBS if BLOB_STORE_ENABLED else None)
 
 class ImportModel(BaseModel):
     model_id:str
     token:Optional[str] = None
+    revision:Optional[str] = None
+
+class ResumeImport(BaseModel):
+    token:Optional[str] = None
+
+def not_modified(request:Request, response:Response) -> Optional[Response]:
+    """Tag the response with the registry version, and short-circuit with a 304 when the client already has it."""
+    etag = REGISTRY.etag
+    response.headers["ETag"] = etag
+    if etag in (tag.strip() for tag in request.headers.get("if-none-match", "").split(",")):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    return None
 
 
 @registry_router.get(
@@ -21,48 +39,117 @@ class ImportModel(BaseModel):
     status_code=status.HTTP_200_OK,
     response_model=List[str]
 )
-def get_models() -> List[str]:
-    return list(REGISTRY.models.keys())
+def get_models(request:Request, response:Response) -> List[str]:
+    return not_modified(request, response) or list(REGISTRY.models.keys())
 
+# Declared before the provider/model routes, which would match it otherwise
 @registry_router.get(
-    "/{provider_id}",
+    "/changes",
     status_code=status.HTTP_200_OK,
-    response_model=List[str]
+    response_model=RegistryChangeFeed
+)
+def get_changes(since:int, epoch:Optional[str] = None) -> RegistryChangeFeed:
+    """The models that were added, changed or removed after the `since` version (of the `epoch`), see `Models.changes_since`."""
+    return REGISTRY.changes_since(since, epoch)
+
+@registry_router.get(
+    "/storage",
+    status_code=status.HTTP_200_OK,
+    response_model=StorageReport
+)
+def get_storage() -> StorageReport:
+    """The disk space of the models, and the space that linking their identical files to a single blob would reclaim."""
+    return BLOBS.scan(REGISTRY.cache_root / model_id for model_id in list(REGISTRY.models.keys()))
+
+# Declared before the provider/model routes, which would match them otherwise
+@registry_router.get(
+    "/imports",
+    status_code=status.HTTP_200_OK,
+    response_model=List[ImportJob]
+)
+def get_imports() -> List[ImportJob]:
+    # Including the jobs that the other worker processes run
+    IMPORTS.load()
+    return sorted(IMPORTS.jobs.values(), key=lambda job: job.created)
+
+def _import_job(job_id:str) -> ImportJob:
+    try:
+        return IMPORTS.get(job_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="No such import job.")
+
+@registry_router.get(
+    "/imports/{job_id}",
+    status_code=status.HTTP_200_OK,
+    response_model=ImportJob
 )
-def get_provider_models(provider_id:str) -> List[str]:
-    provider_id = provider_id.rstrip("/")
+def get_import(job_id:str) -> ImportJob:
+    return _import_job(job_id)
 
-    response = list()
-    for model_id in REGISTRY.models.keys():
-        if model_id.startswith(provider_id + "/"):
-            response.append(model_id[len(provider_id)+1:])
+@registry_router.get(
+    "/imports/{job_id}/events",
+    status_code=status.HTTP_200_OK,
+)
+async def get_import_events(job_id:str, interval:float = 1.0):
+    _import_job(job_id)
+
+    async def events():
+        async for job in IMPORTS.events(job_id, interval):
+            yield job.model_dump_json() + "\n"
+
+    return StreamingResponse(events(), media_type="application/x-ndjson")
+
+@registry_router.post(
+    "/imports/{job_id}/resume",
+    status_code=status.HTTP_202_ACCEPTED,
+    response_model=ImportJob
+)
+def resume_import(job_id:str, request:Optional[ResumeImport] = None) -> ImportJob:
+    _import_job(job_id)
+    try:
+        return IMPORTS.resume(job_id, token=request.token if request else None)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+@registry_router.delete(
+    "/imports/{job_id}",
+    status_code=status.HTTP_200_OK,
+    response_model=ImportJob
+)
+def cancel_import(job_id:str) -> ImportJob:
+    _import_job(job_id)
+    return IMPORTS.cancel(job_id)
 
-    if not response:
+@registry_router.get(
+    "/{provider_id}",
+    status_code=status.HTTP_200_OK,
+    response_model=List[str]
+)
+def get_provider_models(provider_id:str, request:Request, response:Response) -> List[str]:
+    names = REGISTRY.providers.get(provider_id.rstrip("/"))
+    if not names:
         raise HTTPException(status_code=404, detail="No such provider.")
 
-    return response
+    return not_modified(request, response) or list(names)
 
 @registry_router.get(
     "/{provider_id}/{model_name}",
     status_code=status.HTTP_200_OK,
     response_model=ModelCard
 )
-def get_model(provider_id:str, model_name:str) -> ModelCard:
+def get_model(provider_id:str, model_name:str, request:Request, response:Response) -> ModelCard:
     model_id = f"{provider_id}/{model_name}"
     if model_id not in REGISTRY.models:
         raise HTTPException(status_code=404, detail=f"No such model.")
 
-    return REGISTRY.models[model_id]
+    return not_modified(request, response) or REGISTRY.models[model_id]
 
 
 @registry_router.post(
     "/",
-    status_code=status.HTTP_200_OK,
-    response_model=ModelCard
+    status_code=status.HTTP_202_ACCEPTED,
+    response_model=ImportJob
 )
-def import_model(request:ImportModel) -> ModelCard:
-    # TODO: add support for long running operations
-    if not REGISTRY.import_model(request.model_id, token=request.token):
-        logger.warning("Failed to import a model: %s", request.model_id)
-        
-    return REGISTRY.models[request.model_id]
\ No newline at end of file
+def import_model(request:ImportModel) -> ImportJob:
+    """Start importing a model in the background, its progress is polled from /imports/{job_id} (or streamed from its /events)."""
+    return IMPORTS.submit(request.model_id, revision=request.revision, token=request.token)
\ No newline at end of file
@@ -0,0 +1,62 @@
+import os
+import asyncio
+from fastapi import status, APIRouter, HTTPException
+from pydantic import BaseModel
+from typing import List, Optional
+from services.internal.inference import RerankInference
+from services.internal.pool import InferencePool
+from services.internal.rerank import RerankResult, top_n
+from services.registry import REGISTRY
+
+rerank_router = APIRouter()
+
+POOL = InferencePool(REGISTRY, RerankInference, capacity=int(os.getenv("SERVICES_RERANK_POOL_SIZE", "1")))
+
+class RerankRequest(BaseModel):
+    model: str
+    query: str
+    documents: List[str]
+    top_n: Optional[int] = None
+    """The number of most relevant documents that are returned, defaults to all of them."""
+
+    return_documents: bool = True
+
+class RerankUsage(BaseModel):
+    total_tokens: int
+
+class RerankResponse(BaseModel):
+    model: str
+    results: List[RerankResult]
+    """The most relevant documents first."""
+
+    usage: RerankUsage
+
+def rank(model_id:str, query:str, documents:list[str]):
+    inference = POOL.acquire(model_id)
+    try:
+        return inference.rank(query, documents)
+    finally:
+        POOL.release(inference)
+
+@rerank_router.post(
+    "/",
+    status_code=status.HTTP_200_OK,
+    response_model=RerankResponse
+)
+async def rerank(request:RerankRequest) -> RerankResponse:
+    """Score the relevance of the documents to the query with a cross-encoder, and return the top_n most relevant ones."""
+    try:
+        scores, tokens = await asyncio.to_thread(rank, request.model, request.query, request.documents)
+    except ValueError as e:
+        raise HTTPException(400, detail=str(e))
+    except NotImplementedError as e:
+        raise HTTPException(404, detail=str(e))
+    except MemoryError as e:
+        raise HTTPException(507, detail=str(e))
+
+    return RerankResponse(
+        model=request.model,
+        results=[
+            RerankResult(index=i, relevance_score=float(scores[i]), document=request.documents[i] if request.return_documents else None)
+            for i in top_n(scores, request.top_n)],
+        usage=RerankUsage(total_tokens=tokens))
@@ -0,0 +1,128 @@
+"""Serve the API from several worker processes, that share a single copy of the models' weights.
+
+The master process loads SERVICES_PRELOAD_MODELS once, then forks the workers. The weights are never written to
+during inference, so their pages stay shared copy-on-write between the workers. Models which are loaded later, on
+demand, are private to the worker that loaded them. The weights must be on the CPU (e.g. SERVICES_EXECUTION_PROFILE=cpu),
+since a CUDA context can't be used across a fork. The app-wide background work (watching the cache, deduplicating the
+model files, resuming the interrupted jobs, saving the prefetch transitions) is run by the first worker only.
+
+Usage:
+    python -m services.serve --workers 4 --host 0.0.0.0 --port 80
+"""
+import argparse
+import gc
+import os
+import signal
+import socket
+import time
+from services.internal import metrics
+import logging
+
+logger = logging.getLogger(__name__)
+
+def bind(host:str, port:int) -> socket.socket:
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+def fork_worker(worker:int, sock:socket.socket, threads:int, log_level:str) -> int:
+    pid = os.fork()
+    if pid:
+        return pid
+
+    exit_code = 0
+    try:
+        import torch
+        import uvicorn
+        from services import app as app_module
+        from services.app import app
+        metrics.REQUEST_COUNTERS.attach(worker)
+        # The app-wide background work (e.g. watching the cache, resuming the jobs) is run by the first worker only,
+        # the others set up their own pools and routes
+        app_module.primary_worker = worker == 0
+        # The cores are split between the workers, instead of every worker's intra-op pool competing for all of them
+        torch.set_num_threads(threads)
+        uvicorn.Server(uvicorn.Config(app, log_level=log_level, lifespan="on")).run(sockets=[sock])
+    except BaseException as ex:
+        logger.exception("Worker %d failed: %s", worker, ex)
+        exit_code = 1
+    finally:
+        os._exit(exit_code)
+
+def serve(host:str, port:int, workers:int, threads:int = None, log_level:str = "info"):
+    """
+    Preload the models, then fork the workers and restart the ones that die, until SIGINT/SIGTERM.
+
+    Args:
+        host(str): The interface to listen on.
+        port(int): The port to listen on.
+        workers(int): The number of worker processes.
+        threads(int): The torch threads of each worker, defaults to the CPU count divided by the workers.
+    """
+    # Before the app is imported, so that the counters are in shared memory
+    metrics.REQUEST_COUNTERS = metrics.RequestCounters(workers)
+
+    import torch
+    from services.app import preload_models
+    from services.internal.pool import preload
+
+    start = time.perf_counter()
+    preload(preload_models)
+    logger.info("Preloaded %s in %.2fs", preload_models, time.perf_counter() - start)
+    if torch.cuda.is_available() and torch.cuda.is_initialized():
+        raise RuntimeError("CUDA was initialized by the preloads, and can't be shared with forked workers, use SERVICES_EXECUTION_PROFILE=cpu")
+
+    sock = bind(host, port)
+    # Objects that survived so far are moved out of the collector's generations,
+    # so that collections in the workers don't write to (and copy) their pages
+    gc.collect()
+    gc.freeze()
+
+    threads = threads or max(1, (os.cpu_count() or 1) // workers)
+    pids = {fork_worker(worker, sock, threads, log_level): worker for worker in range(workers)}
+    logger.info("Serving on %s:%d with %d workers (%d threads each)", host, port, workers, threads)
+
+    stopping = False
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in pids:
+            signal_worker(pid, signal.SIGTERM)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    while pids:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        worker = pids.pop(pid, None)
+        if worker is None or stopping:
+            continue
+        logger.warning("Worker %d (pid %d) exited with %d, restarting it", worker, pid, os.waitstatus_to_exitcode(status))
+        pids[fork_worker(worker, sock, threads, log_level)] = worker
+    sock.close()
+
+def signal_worker(pid:int, signum:int):
+    try:
+        os.kill(pid, signum)
+    except ProcessLookupError:
+        pass
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=80)
+    parser.add_argument("--workers", type=int, default=int(os.getenv("SERVICES_WORKERS", "2")))
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--log-level", default="info")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level.upper())
+    serve(args.host, args.port, args.workers, args.threads, args.log_level)
+
+if __name__ == "__main__":
+    main()
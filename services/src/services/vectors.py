@@ -0,0 +1,169 @@
+import os
+import asyncio
+import numpy as np
+from fastapi import status, APIRouter, HTTPException
+from pydantic import BaseModel, Field
+from typing import Any, List, Optional
+from services.internal.vectors import VectorCollections, VectorCollection, CollectionInfo, Match, Metric
+from services.embeddings import embed
+from services.registry import REGISTRY
+import logging
+
+logger = logging.getLogger(__name__)
+
+vectors_router = APIRouter()
+
+COLLECTIONS = VectorCollections(os.getenv("SERVICES_VECTORS_DIR", str(REGISTRY.cache_root.parent / "services" / "vectors")))
+
+class CreateCollection(BaseModel):
+    model: str
+    dimensions: Optional[int] = None
+    """Truncates the embeddings (e.g. of Matryoshka models), defaults to the model's dimensions."""
+
+    metric: Metric = "cosine"
+
+class VectorItem(BaseModel):
+    id: str
+    text: Optional[str] = None
+    """Embedded server-side with the model of the collection, unless the vector is given."""
+
+    vector: Optional[List[float]] = None
+    metadata: Optional[dict[str, Any]] = None
+
+class UpsertVectors(BaseModel):
+    items: List[VectorItem]
+
+class DeleteVectors(BaseModel):
+    ids: List[str]
+
+class QueryVectors(BaseModel):
+    queries: Optional[List[str]] = None
+    vectors: Optional[List[List[float]]] = None
+    k: int = Field(default=10, gt=0)
+
+class QueryResponse(BaseModel):
+    matches: List[List[Match]]
+    """The matches of each query (texts first, then vectors), the most similar first."""
+
+def _collection(name:str) -> VectorCollection:
+    try:
+        return COLLECTIONS.get(name)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="No such collection.")
+
+async def _embed(collection:VectorCollection, texts:list[str]) -> np.ndarray:
+    # Truncated to the dimensions of the collection
+    rows = await embed(collection.info.model, texts, collection.info.dimensions)
+    return np.stack(rows).astype(np.float32)
+
+async def _embed_probe(model_id:str) -> np.ndarray:
+    # The dimensions of the model, from the embedding of a probe text
+    return np.stack(await embed(model_id, [" "]))
+
+@vectors_router.get(
+    "/",
+    status_code=status.HTTP_200_OK,
+    response_model=List[CollectionInfo]
+)
+def get_collections() -> List[CollectionInfo]:
+    collections = list(COLLECTIONS.load().values())
+    for collection in collections:
+        # The counts of the rows that the other worker processes wrote
+        collection.refresh()
+    return [collection.info for collection in collections]
+
+@vectors_router.put(
+    "/{name}",
+    status_code=status.HTTP_200_OK,
+    response_model=CollectionInfo
+)
+async def create_collection(name:str, request:CreateCollection) -> CollectionInfo:
+    dimensions = request.dimensions
+    try:
+        if dimensions is None:
+            dimensions = (await _embed_probe(request.model)).shape[-1]
+        info = CollectionInfo(name=name, model=request.model, dimensions=dimensions, metric=request.metric)
+        return (await asyncio.to_thread(COLLECTIONS.create, info)).info
+    except FileExistsError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except NotImplementedError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+@vectors_router.get(
+    "/{name}",
+    status_code=status.HTTP_200_OK,
+    response_model=CollectionInfo
+)
+def get_collection(name:str) -> CollectionInfo:
+    collection = _collection(name)
+    collection.refresh()
+    return collection.info
+
+@vectors_router.delete(
+    "/{name}",
+    status_code=status.HTTP_200_OK,
+)
+def delete_collection(name:str):
+    if not COLLECTIONS.delete(name):
+        raise HTTPException(status_code=404, detail="No such collection.")
+    return {"deleted": name}
+
+@vectors_router.post(
+    "/{name}/upsert",
+    status_code=status.HTTP_200_OK,
+    response_model=CollectionInfo
+)
+async def upsert_vectors(name:str, request:UpsertVectors) -> CollectionInfo:
+    collection = _collection(name)
+    vectors = np.zeros((len(request.items), collection.info.dimensions), dtype=np.float32)
+    texts = [i for i, item in enumerate(request.items) if item.vector is None]
+    try:
+        for i, item in enumerate(request.items):
+            if item.vector is not None:
+                vectors[i] = item.vector
+            elif item.text is None:
+                raise ValueError(f"The item {item.id} has neither a text nor a vector")
+        if texts:
+            vectors[texts] = await _embed(collection, [request.items[i].text for i in texts])
+        # Off the event loop, the rows are written (and the other processes' rows read) under the collection's lock
+        await asyncio.to_thread(collection.upsert, [item.id for item in request.items], vectors, [item.metadata for item in request.items])
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except NotImplementedError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return collection.info
+
+@vectors_router.post(
+    "/{name}/delete",
+    status_code=status.HTTP_200_OK,
+    response_model=CollectionInfo
+)
+def delete_vectors(name:str, request:DeleteVectors) -> CollectionInfo:
+    collection = _collection(name)
+    collection.delete(request.ids)
+    return collection.info
+
+@vectors_router.post(
+    "/{name}/query",
+    status_code=status.HTTP_200_OK,
+    response_model=QueryResponse
+)
+async def query_vectors(name:str, request:QueryVectors) -> QueryResponse:
+    """Search the k most similar items of many queries at once, the texts are embedded with the model of the collection."""
+    collection = _collection(name)
+    queries = list[np.ndarray]()
+    try:
+        if request.queries:
+            queries.append(await _embed(collection, request.queries))
+        if request.vectors:
+            queries.append(np.asarray(request.vectors, dtype=np.float32))
+        if not queries:
+            return QueryResponse(matches=[])
+        # Off the event loop, the matrix product of a large collection takes a while
+        return QueryResponse(matches=await asyncio.to_thread(collection.query, np.concatenate(queries), request.k))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except NotImplementedError as e:
+        raise HTTPException(status_code=404, detail=str(e))
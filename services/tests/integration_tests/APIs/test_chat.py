@@ -84,3 +84,11 @@ def test_create_completion_multiple(client):
     assert response.json()["id"] is not None
     assert response.json()["created"] is not None
     assert response.json()["object"] == "chat.completion"
+
+def test_create_completion_stream_deadline_exceeded_while_queued(client):
+    from services.chat import ChatCompletionRequest, Message
+
+    # Acquiring the model takes longer than the timeout, so the request is refused before the stream starts
+    request = ChatCompletionRequest(model="meta-llama/Llama-3.2-1B-Instruct", messages=[Message(role="user", content="Hi")], stream=True, timeout=1e-6)
+    response = client.post("/chat/completions", json=request.model_dump())
+    assert response.status_code == 408
@@ -1,6 +1,8 @@
+import io
 import pytest
 from unittest import mock
 import os
+import numpy as np
 from pathlib import Path
 from fastapi.testclient import TestClient
 
@@ -30,6 +32,12 @@ def test_create_embeddings_not_supported(client):
     response = client.post("/embeddings", json=request.model_dump())
     assert response.status_code == 404
 
+def test_estimate_tokens():
+    from services.embeddings import estimate_tokens
+
+    assert estimate_tokens(["Hi", "Hello world", ""]) == 1 + 3 + 0
+    assert estimate_tokens(["a" * 1000, "Hi"], max_length=128) == 128 + 1
+
 def test_create_embeddings_single(client):
     from services.embeddings import CreateEmbeddingsRequest
 
@@ -55,8 +63,8 @@ def test_create_embeddings_single_base64(client):
        "model": "sentence-transformers/all-MiniLM-L6-v2",
        "object": "list",
        "usage": {
-           "prompt_tokens": 2,
-           "total_tokens": 386,
+           "prompt_tokens": 3,
+           "total_tokens": 3,
        },
     }
 
@@ -85,3 +93,35 @@ def test_create_embeddings_multiple_base64(client):
     assert response.json()["data"][0]["embedding"] != response.json()["data"][1]["embedding"]
     assert response.json()["model"] == "sentence-transformers/all-MiniLM-L6-v2"
 
+
+def test_create_embeddings_npy(client):
+    from services.embeddings import CreateEmbeddingsRequest
+
+    request = CreateEmbeddingsRequest(model="sentence-transformers/all-MiniLM-L6-v2", input=["Hi", "Bye"], precision="int8")
+    response = client.post("/embeddings", json=request.model_dump(), headers={"Accept": "application/x-npy"})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-npy"
+    embeddings = np.load(io.BytesIO(response.content))
+    assert embeddings.shape == (2, 384)
+    assert embeddings.dtype == np.int8
+
+def test_embed_documents(client):
+    import json
+
+    documents = [{"id": "short", "text": "Hi"}, {"id": "long", "text": " ".join(["word"] * 1000)}]
+    body = "\n".join(json.dumps(document) for document in documents)
+
+    response = client.post("/embeddings/documents", params={"model": "sentence-transformers/all-MiniLM-L6-v2", "pooling": "none"}, content=body)
+    assert response.status_code == 200
+    chunks = [json.loads(line) for line in response.text.splitlines()]
+    assert [chunk["id"] for chunk in chunks if chunk["id"] == "short"] == ["short"]
+    assert len([chunk for chunk in chunks if chunk["id"] == "long"]) > 1
+
+    response = client.post("/embeddings/documents", params={"model": "sentence-transformers/all-MiniLM-L6-v2"}, content=body)
+    pooled = [json.loads(line) for line in response.text.splitlines()]
+    assert [document["id"] for document in pooled] == ["short", "long"]
+    assert len(pooled[1]["embedding"]) == 384
+
+def test_embed_documents_not_supported(client):
+    response = client.post("/embeddings/documents", params={"model": "cross-encoder/ms-marco-MiniLM-L6-v2"}, content='{"id": "a", "text": "Hi"}')
+    assert response.status_code == 404
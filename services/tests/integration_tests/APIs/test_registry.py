@@ -88,11 +88,35 @@ def test_get_model(client):
     assert ModelCard.model_validate(response.json()) == REGISTRY.models[model_id]
 
 def test_import_model(client):
-    from services.registry import REGISTRY, ImportModel, ModelCard
+    from services.registry import REGISTRY, ImportModel, ImportJob
 
     model_id = list(REGISTRY.models.keys())[0]
     request = ImportModel(model_id=model_id, token=os.getenv("HF_TOKEN"))
     response = client.post("/registry", json=request.model_dump())
     
+    assert response.status_code == 202
+    job = ImportJob.model_validate(response.json())
+    assert job.model_id == model_id
+
+    response = client.get(f"/registry/imports/{job.id}/events", params={"interval": 0.1})
     assert response.status_code == 200
-    assert ModelCard.model_validate(response.json()) == REGISTRY.models[model_id]
+    jobs = [ImportJob.model_validate_json(line) for line in response.text.splitlines() if line]
+    assert jobs[-1].state == "succeeded", jobs[-1].error
+    assert jobs[-1].progress.downloaded_files == jobs[-1].progress.total_files
+    assert model_id in REGISTRY.models
+
+def test_get_import_no_job(client):
+    response = client.get("/registry/imports/TESTTEST")
+    assert response.status_code == 404
+    assert response.json() == {"detail": "No such import job."}
+
+def test_list_models_not_modified(client):
+    response = client.get("/registry/")
+    etag = response.headers["ETag"]
+
+    response = client.get("/registry/", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+    response = client.get("/registry/changes", params={"since": 0})
+    assert response.status_code == 200
+    assert etag == f'"{response.json()["epoch"]}-{response.json()["version"]}"'
@@ -0,0 +1,50 @@
+import pytest
+from unittest import mock
+import os
+from pathlib import Path
+from fastapi.testclient import TestClient
+
+@pytest.fixture()
+def model_cache():
+    return Path(__file__).parent.parent.parent.parent.parent / "models"
+
+@pytest.fixture()
+def setenvvar(monkeypatch, model_cache):
+    with mock.patch.dict(os.environ, clear=False):
+        envvars = {
+            "HF_HOME": str(model_cache),
+        }
+        for k, v in envvars.items():
+            monkeypatch.setenv(k, v)
+        yield # This is the magical bit which restore the environment after
+
+@pytest.fixture()
+def client(setenvvar):
+    from services.app import app
+    yield TestClient(app)
+
+def test_rerank_not_supported(client):
+    from services.rerank import RerankRequest
+
+    request = RerankRequest(model="sentence-transformers/all-MiniLM-L6-v2", query="Hi", documents=["Hello"])
+    response = client.post("/rerank", json=request.model_dump())
+    assert response.status_code == 404
+
+def test_rerank_top_n(client):
+    from services.rerank import RerankRequest, RerankResponse
+
+    documents = [
+        "Bananas are rich in potassium.",
+        "Berlin is the capital and largest city of Germany.",
+        "Munich is the capital of Bavaria.",
+    ]
+    request = RerankRequest(model="cross-encoder/ms-marco-MiniLM-L6-v2", query="What is the capital of Germany?", documents=documents, top_n=2)
+    response = client.post("/rerank", json=request.model_dump())
+    assert response.status_code == 200
+
+    result = RerankResponse.model_validate(response.json())
+    assert [r.index for r in result.results][0] == 1
+    assert len(result.results) == 2
+    assert result.results[0].relevance_score >= result.results[1].relevance_score
+    assert result.results[0].document == documents[1]
+    assert result.usage.total_tokens > 0
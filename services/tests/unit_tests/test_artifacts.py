@@ -0,0 +1,47 @@
+import torch
+from transformers import AutoModelForCausalLM, LlamaConfig
+from services.internal import artifacts
+
+def tiny_llama_config():
+    return LlamaConfig(
+        vocab_size=128,
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        tie_word_embeddings=True)
+
+def test_artifact_round_trip(tmp_path):
+    config = tiny_llama_config()
+    model = AutoModelForCausalLM.from_config(config, torch_dtype=torch.bfloat16).eval()
+    options = artifacts.artifact_options(AutoModelForCausalLM, torch.bfloat16, None)
+
+    manifest = artifacts.write_artifact(model, "my-org/tiny", tmp_path, "abc123", options)
+
+    assert artifacts.find_artifact(tmp_path, artifacts.artifact_key("abc123", options)) == manifest
+    assert artifacts.find_artifact(tmp_path, artifacts.artifact_key("def456", options)) is None
+    loaded = artifacts.read_artifact(AutoModelForCausalLM, config, tmp_path, manifest, "cpu", torch.bfloat16)
+    assert loaded.lm_head.weight is loaded.model.embed_tokens.weight
+    input_ids = torch.tensor([[1, 2, 3, 4]])
+    with torch.no_grad():
+        assert torch.equal(model(input_ids).logits, loaded(input_ids).logits)
+
+def test_single_device():
+    assert artifacts.single_device("cpu") == "cpu"
+    assert artifacts.single_device("auto") is None
+    assert artifacts.single_device({"model": 0, "lm_head": 0}) == "cuda:0"
+    assert artifacts.single_device({"model": 0, "lm_head": "cpu"}) is None
+
+def test_write_artifact_prunes_the_other_artifacts(tmp_path):
+    model = AutoModelForCausalLM.from_config(tiny_llama_config(), torch_dtype=torch.bfloat16).eval()
+    options = artifacts.artifact_options(AutoModelForCausalLM, torch.bfloat16, None)
+    previous = artifacts.write_artifact(model, "my-org/tiny", tmp_path, "abc123", options)
+    writing = artifacts.artifact_dir(tmp_path, "abc123").with_name("def456.42.tmp")
+    writing.mkdir()
+
+    manifest = artifacts.write_artifact(model, "my-org/tiny", tmp_path, "def456", options)
+
+    assert artifacts.find_artifact(tmp_path, previous.key) is None
+    assert artifacts.find_artifact(tmp_path, manifest.key) == manifest
+    assert writing.exists()
@@ -0,0 +1,52 @@
+import asyncio
+import pytest
+from services.internal.batcher import EmbeddingsBatcher
+
+class FakeEncoder:
+    def __init__(self):
+        self.batches = []
+
+    def __call__(self, model_id:str, sentences:list[str], dimensions:int = None) -> list:
+        if "bad" in sentences:
+            raise ValueError("bad input")
+        self.batches.append((model_id, list(sentences), dimensions))
+        return [f"{model_id}:{sentence}" for sentence in sentences]
+
+@pytest.mark.asyncio(loop_scope="function")
+async def test_concurrent_requests_are_encoded_together():
+    encoder = FakeEncoder()
+    under_test = EmbeddingsBatcher(encoder, max_batch_size=8, max_wait=0.05)
+
+    results = await asyncio.gather(
+        under_test.encode("my-org/model", ["a"]),
+        under_test.encode("my-org/model", ["b", "c"]),
+        under_test.encode("my-org/model", ["d"], dimensions=32),
+        under_test.encode("my-org/other", ["e"]))
+
+    assert results == [["my-org/model:a"], ["my-org/model:b", "my-org/model:c"], ["my-org/model:d"], ["my-org/other:e"]]
+    assert sorted(encoder.batches) == [("my-org/model", ["a", "b", "c"], None), ("my-org/model", ["d"], 32), ("my-org/other", ["e"], None)]
+
+@pytest.mark.asyncio(loop_scope="function")
+async def test_full_batches_are_flushed_without_waiting():
+    encoder = FakeEncoder()
+    under_test = EmbeddingsBatcher(encoder, max_batch_size=2, max_wait=10)
+
+    results = await asyncio.wait_for(asyncio.gather(
+        under_test.encode("my-org/model", ["a"]),
+        under_test.encode("my-org/model", ["b"]),
+        under_test.encode("my-org/model", ["c", "d", "e"])), timeout=1)
+
+    assert results == [["my-org/model:a"], ["my-org/model:b"], ["my-org/model:c", "my-org/model:d", "my-org/model:e"]]
+    assert len(encoder.batches) == 2
+
+@pytest.mark.asyncio(loop_scope="function")
+async def test_bad_input_fails_only_its_request():
+    under_test = EmbeddingsBatcher(FakeEncoder(), max_batch_size=8, max_wait=0.05)
+
+    results = await asyncio.gather(
+        under_test.encode("my-org/model", ["a"]),
+        under_test.encode("my-org/model", ["bad"]),
+        return_exceptions=True)
+
+    assert results[0] == ["my-org/model:a"]
+    assert isinstance(results[1], ValueError)
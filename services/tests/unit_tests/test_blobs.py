@@ -0,0 +1,69 @@
+import os
+from services.internal.blobs import BlobStore
+from services.internal.registry import Models
+
+def add_model(root, model_id:str, weights:bytes, mtime_ns:int = 1_700_000_000 * 10 ** 9):
+    model_dir = root / "hub" / model_id
+    model_dir.mkdir(parents=True)
+    (model_dir / "config.json").write_text("{}")
+    (model_dir / "tokenizer.json").write_text('{"vocab": ["a", "b", "c"]}')
+    (model_dir / "model.safetensors").write_bytes(weights)
+    for path in model_dir.iterdir():
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+    return model_dir
+
+def test_scan_reports_identical_copies(tmp_path):
+    model_a = add_model(tmp_path, "my-org/model-a", b"a" * 64)
+    model_b = add_model(tmp_path, "my-org/model-b", b"b" * 64)
+    under_test = BlobStore(tmp_path / "hub" / ".blobs")
+
+    report = under_test.scan([model_a, model_b])
+
+    assert report.reclaimable_bytes == (model_a / "config.json").stat().st_size + (model_a / "tokenizer.json").stat().st_size
+    assert {len(duplicate.paths) for duplicate in report.duplicates} == {2}
+    assert not any("model.safetensors" in path for duplicate in report.duplicates for path in duplicate.paths)
+
+def test_dedupe_links_identical_files_to_a_blob(tmp_path):
+    model_a = add_model(tmp_path, "my-org/model-a", b"a" * 64)
+    model_b = add_model(tmp_path, "my-org/model-b", b"b" * 64)
+    mtime = model_b.stat().st_mtime_ns
+    revisions = [Models.read_revision(model_a), Models.read_revision(model_b)]
+    under_test = BlobStore(tmp_path / "hub" / ".blobs")
+
+    report = under_test.scan([model_a, model_b])
+    assert under_test.dedupe(report) == report.reclaimable_bytes
+
+    assert (model_a / "tokenizer.json").stat().st_ino == (model_b / "tokenizer.json").stat().st_ino
+    assert (model_a / "model.safetensors").read_bytes() != (model_b / "model.safetensors").read_bytes()
+    # Only the files that have copies are linked to a blob
+    assert (model_a / "model.safetensors").stat().st_nlink == 1
+    assert len(list(under_test.root.glob("*/*"))) == 2
+    assert model_b.stat().st_mtime_ns == mtime
+    assert [Models.read_revision(model_a), Models.read_revision(model_b)] == revisions
+    assert under_test.scan([model_a, model_b]).reclaimable_bytes == 0
+
+    for path in model_b.iterdir():
+        path.unlink()
+    assert under_test.collect_garbage() == 0
+    for path in model_a.iterdir():
+        path.unlink()
+    assert under_test.collect_garbage() == report.reclaimable_bytes
+    assert not list(under_test.root.glob("*/*"))
+
+def test_dedupe_keeps_the_revisions_that_depend_on_modification_times(tmp_path):
+    model_a = add_model(tmp_path, "my-org/model-a", b"a" * 64)
+    model_b = add_model(tmp_path, "my-org/model-b", b"b" * 64, mtime_ns=1_800_000_000 * 10 ** 9)
+    model_c = add_model(tmp_path, "my-org/model-c", b"c" * 64, mtime_ns=1_900_000_000 * 10 ** 9)
+    # Downloaded from the hub, whose revision is the commit hash
+    metadata = model_c / ".cache" / "huggingface" / "download"
+    metadata.mkdir(parents=True)
+    (metadata / "config.json.metadata").write_text("0123abcd\n")
+    revisions = [Models.read_revision(model) for model in (model_a, model_b, model_c)]
+    under_test = BlobStore(tmp_path / "hub" / ".blobs")
+
+    under_test.dedupe(under_test.scan([model_a, model_b, model_c]))
+
+    assert [Models.read_revision(model) for model in (model_a, model_b, model_c)] == revisions
+    # A local model whose files' times differ isn't linked, the hub model is
+    assert (model_b / "tokenizer.json").stat().st_nlink == 1
+    assert (model_c / "tokenizer.json").stat().st_ino == (model_a / "tokenizer.json").stat().st_ino
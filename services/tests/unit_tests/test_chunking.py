@@ -0,0 +1,68 @@
+import re
+import asyncio
+import numpy as np
+from services.internal.chunking import Document, DocumentPooler, InvalidDocument, max_seq_length, max_window, token_windows, read_documents
+
+class WordTokenizer:
+    model_max_length = 6
+
+    def __call__(self, text:str, add_special_tokens:bool = True, return_offsets_mapping:bool = False) -> dict:
+        return {"offset_mapping": [match.span() for match in re.finditer(r"\S+", text)]}
+
+    def num_special_tokens_to_add(self) -> int:
+        return 2
+
+def test_token_windows_overlap():
+    document = Document(id="doc", text="one two three four five six seven")
+
+    chunks = token_windows(WordTokenizer(), document, window=3, overlap=1)
+
+    assert [document.text[chunk.start:chunk.end] for chunk in chunks] == ["one two three", "three four five", "five six seven"]
+    assert [chunk.tokens for chunk in chunks] == [3, 3, 3]
+    assert [chunk.index for chunk in chunks] == [0, 1, 2]
+
+def test_read_documents_across_reads():
+    async def reads():
+        for data in [b'{"id": "a", "text": "x"}\n{"id": "b",', b' "text": "y"}\n', b'{"id": "c", "text": "z"}']:
+            yield data
+
+    async def read():
+        return [document.id async for document in read_documents(reads())]
+
+    assert asyncio.run(read()) == ["a", "b", "c"]
+
+def test_read_documents_reports_malformed_lines():
+    async def reads():
+        yield b'{"id": "a", "text": "x"}\n{"id": "b", "text"\n\n{"id": "c"}\n{"id": "d", "text": "z"}'
+
+    async def read():
+        return [document async for document in read_documents(reads())]
+
+    a, b, c, d = asyncio.run(read())
+    assert (a.id, d.id) == ("a", "d")
+    assert isinstance(b, InvalidDocument) and b.line == 2 and b.id is None
+    assert isinstance(c, InvalidDocument) and c.line == 4 and c.id == "c"
+
+def test_max_window_of_the_model():
+    assert max_window(WordTokenizer()) == 4
+    assert max_window(WordTokenizer(), max_length=5) == 3
+
+def test_pooler_weights_chunks_by_tokens():
+    document = Document(id="doc", text="one two three four")
+    chunks = token_windows(WordTokenizer(), document, window=3, overlap=0)
+    under_test = DocumentPooler()
+    under_test.expect("doc", len(chunks))
+
+    assert under_test.add(chunks[0], np.array([1.0, 0.0])) is None
+    document_id, count, tokens, pooled = under_test.add(chunks[1], np.array([0.0, 1.0]))
+
+    assert (document_id, count, tokens) == ("doc", 2, 4)
+    assert np.allclose(pooled, [0.75, 0.25])
+    assert not under_test.sums and not under_test.remaining
+
+def test_max_seq_length_of_the_sentence_transformer(tmp_path):
+    assert max_seq_length(tmp_path) is None
+
+    (tmp_path / "sentence_bert_config.json").write_text('{"max_seq_length": 256, "do_lower_case": false}')
+
+    assert max_seq_length(tmp_path) == 256
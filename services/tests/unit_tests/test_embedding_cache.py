@@ -0,0 +1,41 @@
+import numpy as np
+from services.internal.embedding_cache import EmbeddingCache
+
+def test_memory_tier_evicts_least_recently_used():
+    under_test = EmbeddingCache(memory_bytes=2 * 4 * 4)
+    under_test.put("my-org/model", "rev", None, ["a", "b"], np.ones((2, 4)))
+    assert under_test.get("my-org/model", "rev", None, ["a"])[0] is not None
+
+    under_test.put("my-org/model", "rev", None, ["c"], np.zeros((1, 4)))
+
+    cached = under_test.get("my-org/model", "rev", None, ["a", "b", "c"])
+    assert [row is not None for row in cached] == [True, False, True]
+    assert under_test.memory_used == 2 * 4 * 4
+
+def test_disk_tier_persists_embeddings(tmp_path):
+    embeddings = np.arange(12, dtype=np.float32).reshape(3, 4)
+    EmbeddingCache(tmp_path).put("my-org/model", "rev", None, ["a", "b", "café"], embeddings)
+
+    under_test = EmbeddingCache(tmp_path)
+    # Decomposed, normalized to the same key
+    cached = under_test.get("my-org/model", "rev", None, ["b", "cafe\u0301", "d"])
+
+    assert np.array_equal(cached[0], embeddings[1])
+    assert np.array_equal(cached[1], embeddings[2])
+    assert cached[2] is None
+    assert under_test.get("my-org/model", "another-rev", None, ["b"]) == [None]
+    assert under_test.get("my-org/model", "rev", 2, ["b"]) == [None]
+    assert under_test.hits == 2 and under_test.misses == 3
+
+def test_disk_tier_is_shared_between_worker_processes(tmp_path):
+    # Each worker process has its own instance over the same directory
+    workers = [EmbeddingCache(tmp_path, memory_bytes=0) for _ in range(2)]
+    workers[0].put("my-org/model", "rev", None, ["a"], np.zeros((1, 4)))
+    workers[1].put("my-org/model", "rev", None, ["b", "a"], np.ones((2, 4)))
+    workers[0].put("my-org/model", "rev", None, ["c"], np.full((1, 4), 2))
+
+    for worker in workers:
+        cached = worker.get("my-org/model", "rev", None, ["a", "b", "c"])
+        assert [row[0] for row in cached] == [0, 1, 2]
+    # Neither worker truncated the rows of the other, and no row was appended twice
+    assert EmbeddingCache(tmp_path).shard("my-org/model", "rev", None).rows == 3
@@ -0,0 +1,18 @@
+import json
+import base64
+import numpy as np
+from services.internal.embedding_formats import quantize, to_base64, dumps
+
+def test_quantize():
+    embeddings = np.array([[0.5, -1.0, 0.25, 0.0, 0.1, -0.1, 0.2, 0.3, 0.9], [0.0] * 9], dtype=np.float32)
+
+    assert quantize(embeddings, "float16").dtype == np.float16
+    assert quantize(embeddings, "int8").tolist()[0][:4] == [64, -127, 32, 0]
+    assert quantize(embeddings, "int8").tolist()[1] == [0] * 9
+    assert quantize(embeddings, "binary").tolist() == [[0b10101011, 0b10000000], [0, 0]]
+
+def test_base64_and_json_match_the_floats():
+    embeddings = np.array([[0.5, -1.0, 0.25]], dtype=np.float32)
+
+    assert np.frombuffer(base64.b64decode(to_base64(embeddings[0])), dtype=np.float32).tolist() == [0.5, -1.0, 0.25]
+    assert json.loads(dumps({"data": [{"embedding": row} for row in embeddings]})) == {"data": [{"embedding": [0.5, -1.0, 0.25]}]}
@@ -0,0 +1,79 @@
+import os
+import json
+import time
+import pytest
+import numpy as np
+from pathlib import Path
+from services.internal.registry import Models
+from services.internal.embedding_jobs import EmbeddingJobs, core_sets, read_inputs, count_inputs
+
+MODELS_CACHE = Path(__file__).parent.parent.parent.parent / "models"
+
+def test_read_inputs_skips_the_written_rows(tmp_path):
+    path = tmp_path / "input.jsonl"
+    path.write_text('"a"\n\n{"text": "b"}\n"c"\n')
+
+    assert count_inputs(path) == 3
+    assert list(read_inputs(path)) == ["a", "b", "c"]
+    assert list(read_inputs(path, skip=2)) == ["c"]
+
+@pytest.mark.skipif(not hasattr(os, "sched_getaffinity"), reason="No CPU affinity")
+def test_core_sets_are_disjoint():
+    sets = core_sets(2)
+
+    assert sorted(core for cores in sets for core in cores) == sorted(os.sched_getaffinity(0))
+    assert len(sets) == min(2, len(os.sched_getaffinity(0)))
+
+def test_embedding_job_writes_rows_in_order(tmp_path):
+    under_test = EmbeddingJobs(Models(MODELS_CACHE), jobs_dir=tmp_path)
+    inputs = [f"sentence {i}" for i in range(10)]
+    path = under_test.new_input()
+    path.write_text("\n".join(json.dumps(text) for text in inputs))
+
+    job = under_test.submit("sentence-transformers/all-MiniLM-L6-v2", path, processes=2)
+    deadline = time.monotonic() + 300
+    while not under_test.jobs[job.id].finished and time.monotonic() < deadline:
+        time.sleep(0.5)
+    under_test.stop()
+
+    job = under_test.jobs[job.id]
+    assert job.state == "succeeded", job.error
+    assert job.progress.done == job.progress.total == len(inputs)
+    embeddings = np.load(job.output)
+    assert embeddings.shape == (len(inputs), 384)
+    assert not np.allclose(embeddings[0], embeddings[1])
+
+def test_jobs_are_shared_between_worker_processes(tmp_path):
+    from services.internal.embedding_jobs import EmbeddingJob
+    (tmp_path / "cache" / "hub").mkdir(parents=True)
+    (tmp_path / "jobs").mkdir()
+    running = EmbeddingJob(id="running", model="my-org/my-model", input="input.jsonl", output="running.npy", state="running")
+    (tmp_path / "jobs" / "running.job.json").write_text(running.model_dump_json())
+    # Each worker process has its own instance over the same jobs directory
+    workers = [EmbeddingJobs(Models(str(tmp_path / "cache")), jobs_dir=tmp_path / "jobs") for _ in range(2)]
+    assert workers[0].claims.claim("running")
+    try:
+        assert workers[1].resume_interrupted() == []
+        assert workers[1].get("running").state == "running"
+
+        workers[1].cancel("running")
+        assert workers[0]._should_stop("running")
+    finally:
+        workers[0].claims.release("running")
+    assert workers[1].get("running").error == "Interrupted"
+    with pytest.raises(KeyError):
+        workers[1].get("missing")
+
+def test_jobs_that_are_not_queued_release_their_claim(tmp_path):
+    from services.internal.embedding_jobs import EmbeddingJob
+    (tmp_path / "cache" / "hub").mkdir(parents=True)
+    workers = [EmbeddingJobs(Models(str(tmp_path / "cache")), jobs_dir=tmp_path / "jobs") for _ in range(2)]
+    job = EmbeddingJob(id="done", model="my-org/my-model", input="input.jsonl", output="done.npy", state="succeeded")
+    workers[0].jobs[job.id] = job
+    assert workers[0].claims.claim(job.id)
+
+    workers[0]._run(job.id)
+
+    assert workers[0].jobs[job.id].state == "succeeded"
+    assert workers[1].claims.claim(job.id)
+    workers[1].claims.release(job.id)
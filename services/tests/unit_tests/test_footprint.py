@@ -0,0 +1,48 @@
+import json
+import struct
+from services.internal.footprint import estimate_footprint
+
+def write_safetensors(path, tensors:dict):
+    header = dict()
+    offset = 0
+    for name, (dtype, shape, element_bytes) in tensors.items():
+        size = element_bytes
+        for dim in shape:
+            size *= dim
+        header[name] = {"dtype": dtype, "shape": shape, "data_offsets": [offset, offset + size]}
+        offset += size
+    header["__metadata__"] = {"format": "pt"}
+    encoded = json.dumps(header).encode()
+    path.write_bytes(struct.pack("<Q", len(encoded)) + encoded + b"\0" * offset)
+
+def test_estimate_footprint_from_headers_and_config(tmp_path):
+    write_safetensors(tmp_path / "model-00001-of-00002.safetensors", {"embed": ("BF16", [100, 8], 2)})
+    write_safetensors(tmp_path / "model-00002-of-00002.safetensors", {"layer.0": ("BF16", [8, 8], 2), "norm": ("F32", [8], 4)})
+    (tmp_path / "config.json").write_text(json.dumps({
+        "num_hidden_layers": 2,
+        "num_attention_heads": 4,
+        "num_key_value_heads": 2,
+        "hidden_size": 8,
+        "max_position_embeddings": 1024,
+        "torch_dtype": "bfloat16",
+    }))
+
+    footprint = estimate_footprint(tmp_path)
+
+    assert footprint.parameters == 800 + 64 + 8
+    assert footprint.weights_bytes == 1600 + 128 + 32
+    assert footprint.dtype == "bfloat16"
+    assert footprint.context_length == 1024
+    assert footprint.num_layers == 2
+    # keys and values * layers * kv heads * head dim * bf16
+    assert footprint.kv_bytes_per_token == 2 * 2 * 2 * 2 * 2
+    assert footprint.weights_bytes_as("float32") == 872 * 4
+    assert footprint.disk_bytes > footprint.weights_bytes
+
+def test_estimate_footprint_skips_corrupt_headers(tmp_path):
+    (tmp_path / "model.safetensors").write_bytes(b"\1" * 10_000)
+
+    footprint = estimate_footprint(tmp_path)
+
+    assert footprint.parameters is None
+    assert footprint.disk_bytes == 10_000
@@ -0,0 +1,140 @@
+import time
+import pytest
+from services.internal.registry import Models
+from services.internal.imports import ImportJobs, ImportJob, LocalDirectoryHub
+
+def wait_until_finished(job:ImportJob, timeout:float = 10) -> ImportJob:
+    start = time.monotonic()
+    while not job.finished and time.monotonic() - start < timeout:
+        time.sleep(0.01)
+    return job
+
+@pytest.fixture
+def hub(tmp_path):
+    model_dir = tmp_path / "remote" / "my-org" / "my-model"
+    model_dir.mkdir(parents=True)
+    (model_dir / "config.json").write_text("{}")
+    (model_dir / "model.safetensors").write_bytes(b"\1" * 10_000)
+    return LocalDirectoryHub(tmp_path / "remote", chunk_size=100)
+
+@pytest.fixture
+def registry(tmp_path):
+    (tmp_path / "cache" / "hub").mkdir(parents=True)
+    return Models(str(tmp_path / "cache"))
+
+@pytest.fixture
+def under_test(registry, hub, tmp_path):
+    jobs = ImportJobs(registry, hub, jobs_dir=tmp_path / "jobs")
+    yield jobs
+    jobs.stop()
+
+def test_import_reports_progress_and_registers_the_model(under_test:ImportJobs, registry:Models):
+    job = wait_until_finished(under_test.submit("my-org/my-model"))
+
+    assert job.state == "succeeded", job.error
+    assert job.progress.model_dump() == {"total_files": 2, "downloaded_files": 2, "total_bytes": 10_002, "downloaded_bytes": 10_002}
+    assert "my-org/my-model" in registry.models
+    assert (registry.cache_root / "my-org" / "my-model" / "model.safetensors").stat().st_size == 10_000
+
+def test_import_is_cancellable_and_resumable(under_test:ImportJobs, registry:Models, hub:LocalDirectoryHub, tmp_path):
+    download = hub.download
+    def cancel_midway(model_id, file, revision, local_dir, token, on_bytes, should_stop):
+        [running] = [job for job in under_test.jobs.values() if job.model_id == model_id]
+        def on_bytes_then_cancel(count):
+            on_bytes(count)
+            if file.path == "model.safetensors" and running.progress.downloaded_bytes > 5_000:
+                under_test.cancel(running.id)
+        download(model_id, file, revision, local_dir, token, on_bytes_then_cancel, should_stop)
+    hub.download = cancel_midway
+
+    job = under_test.submit("my-org/my-model")
+    wait_until_finished(job)
+    assert job.state == "cancelled"
+    assert "my-org/my-model" not in registry.models
+
+    hub.download = download
+    job = wait_until_finished(under_test.resume(job.id))
+    assert job.state == "succeeded", job.error
+    assert (registry.cache_root / "my-org" / "my-model" / "model.safetensors").read_bytes() == b"\1" * 10_000
+    assert not (registry.cache_root / ".imports" / "my-org" / "my-model").exists()
+
+def test_interrupted_jobs_are_resumed(registry:Models, hub:LocalDirectoryHub, tmp_path):
+    (tmp_path / "jobs").mkdir()
+    interrupted = ImportJob(id="interrupted", model_id="my-org/my-model", state="running")
+    (tmp_path / "jobs" / "interrupted.json").write_text(interrupted.model_dump_json())
+    under_test = ImportJobs(registry, hub, jobs_dir=tmp_path / "jobs")
+    try:
+        assert under_test.jobs["interrupted"].error == "Interrupted"
+
+        [job] = under_test.resume_interrupted()
+        assert wait_until_finished(job).state == "succeeded", job.error
+    finally:
+        under_test.stop()
+
+def test_jobs_are_shared_between_worker_processes(registry:Models, hub:LocalDirectoryHub, tmp_path):
+    (tmp_path / "jobs").mkdir()
+    interrupted = ImportJob(id="interrupted", model_id="my-org/my-model", state="running")
+    (tmp_path / "jobs" / "interrupted.json").write_text(interrupted.model_dump_json())
+    # Each worker process has its own instance over the same jobs directory
+    workers = [ImportJobs(registry, hub, jobs_dir=tmp_path / "jobs") for _ in range(2)]
+    try:
+        assert workers[0].claims.claim("interrupted") # As if the first worker resumed it, and it's still running
+
+        assert workers[1].resume_interrupted() == []
+        assert workers[1].get("interrupted").state == "running"
+
+        workers[0].claims.release("interrupted")
+        [job] = workers[1].resume_interrupted()
+        assert wait_until_finished(job).state == "succeeded", job.error
+        assert workers[0].get(job.id).state == "succeeded"
+        with pytest.raises(KeyError):
+            workers[0].get("missing")
+    finally:
+        for worker in workers:
+            worker.stop()
+
+def test_import_links_the_copies_of_other_models_files(registry:Models, hub:LocalDirectoryHub, tmp_path):
+    from services.internal.blobs import BlobStore
+    other = registry.cache_root / "my-org" / "other-model"
+    other.mkdir(parents=True)
+    (other / "config.json").write_text("{}")
+    (other / "model.safetensors").write_bytes(b"\2" * 10_000)
+    # Downloaded with the hub's metadata, so the revisions don't depend on the modification times the links change
+    for model_dir in (other, hub.root / "my-org" / "my-model"):
+        metadata = model_dir / ".cache" / "huggingface" / "download"
+        metadata.mkdir(parents=True)
+        (metadata / "config.json.metadata").write_text("abc123\n")
+    registry.refresh()
+    under_test = ImportJobs(registry, hub, jobs_dir=tmp_path / "jobs", blobs=BlobStore(registry.cache_root / ".blobs"))
+    try:
+        job = wait_until_finished(under_test.submit("my-org/my-model"))
+        assert job.state == "succeeded", job.error
+    finally:
+        under_test.stop()
+
+    imported = registry.cache_root / "my-org" / "my-model"
+    assert (imported / "config.json").stat().st_ino == (other / "config.json").stat().st_ino
+    assert (imported / "model.safetensors").stat().st_nlink == 1
+
+def test_hugging_face_downloads_report_their_bytes_and_are_cancellable(monkeypatch, tmp_path):
+    import huggingface_hub
+    from services.internal.imports import HuggingFaceHub, HubFile, ImportCancelled
+
+    def hf_hub_download(model_id, filename, revision, local_dir, token, tqdm_class):
+        # Resumed after 100 bytes, as the hub client does it
+        with tqdm_class(desc=filename, total=1000, initial=100, unit="B") as progress:
+            for _ in range(9):
+                progress.update(100)
+        return str(tmp_path / filename)
+
+    monkeypatch.setattr(huggingface_hub, "hf_hub_download", hf_hub_download)
+    reported = []
+    HuggingFaceHub().download("my-org/my-model", HubFile(path="model.safetensors", size=1000), "main", tmp_path, None,
+                              reported.append, lambda: False)
+    assert reported == [100] + [100] * 9
+
+    reported.clear()
+    with pytest.raises(ImportCancelled):
+        HuggingFaceHub().download("my-org/my-model", HubFile(path="model.safetensors", size=1000), "main", tmp_path, None,
+                                  reported.append, lambda: sum(reported) >= 300)
+    assert sum(reported) == 300
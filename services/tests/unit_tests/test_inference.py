@@ -1,15 +1,24 @@
+import sys
+import time
+import types
+import threading
 import pytest
+from contextlib import contextmanager
 from pathlib import Path
 from services.internal.registry import Models
 from services.internal.loader import (
     SUPPORTED, 
     SentenceTransformerLoader,
+    CrossEncoderLoader,
     AutoModelForCausalLMLoader,
     ImageTextToTextModelLoader
 )
 from services.internal.inference import (
+    BASE_ADAPTER,
     TransformerInference, 
     EmbeddingsInference, 
+    RerankInference,
+    AdapterManager,
     Dialog, 
     Message, 
     MultiModalMessage)
@@ -77,6 +86,25 @@ def test_inference_sentence_transformers_as_embeddings(registry:Models, model_id
     assert similarity[1][1] == -0.0
     assert similarity[2][2] == -0.0
 
+@pytest.mark.parametrize("model_id", [id for id, type in SUPPORTED.items() if type == CrossEncoderLoader])
+def test_inference_cross_encoder_as_rerank(registry:Models, model_id):
+    under_test = RerankInference(registry)
+    passages = [
+        "Bananas are rich in potassium.",
+        "Berlin is the capital and largest city of Germany.",
+        "The city has a population of about 3.8 million. " * 40,
+    ]
+
+    under_test.serve(model_id)
+    # A budget of a few short pairs, so that the long pair is scored in a batch of its own
+    scores, tokens = under_test.rank("What is the capital of Germany?", passages, max_batch_tokens=64)
+    logger.info(scores)
+
+    assert scores.shape == (len(passages),)
+    assert scores.argmax() == 1
+    assert tokens > 0
+    assert under_test.rank("What is the capital of Germany?", [])[1] == 0
+
 @pytest.mark.asyncio(loop_scope="function")
 @pytest.mark.parametrize("model_id", [id for id, type in SUPPORTED.items() if type == ImageTextToTextModelLoader])
 async def test_inference_image_text_as_chat(registry:Models, model_id):
@@ -134,3 +162,175 @@ async def test_inference_causalLM_as_chat(registry:Models, model_id):
         assert "|>" not in dialog.latest_response.content
         assert dialog.thinking_response is None
         assert len(dialog.history) == 3
+
+class FakePeftModel:
+    def __init__(self, base, name):
+        self.base = base
+        self.loaded = [name]
+
+    @classmethod
+    def from_pretrained(cls, base, location, adapter_name, is_trainable):
+        return cls(base, adapter_name)
+
+    def eval(self):
+        pass
+
+    def load_adapter(self, location, adapter_name, is_trainable):
+        self.loaded.append(adapter_name)
+
+    def delete_adapter(self, name):
+        self.loaded.remove(name)
+
+class FakeAdapterRegistry:
+    def __init__(self, *model_ids):
+        self.models = {model_id: types.SimpleNamespace(location=f"/models/{model_id}") for model_id in model_ids}
+
+@pytest.fixture
+def adapters(monkeypatch):
+    monkeypatch.setitem(sys.modules, "peft", types.SimpleNamespace(PeftModel=FakePeftModel))
+    loaded = types.SimpleNamespace(model_id="my-org/base", entry_point_model="base weights")
+    return AdapterManager(FakeAdapterRegistry("my-org/lora-a", "my-org/lora-b", "my-org/lora-c"), loaded, max_adapters=2)
+
+def test_adapters_attach_evicts_least_recently_used(adapters:AdapterManager):
+    name_a = adapters.attach("my-org/lora-a")
+    adapters.attach("my-org/lora-b")
+    assert adapters.attach("my-org/lora-a") == name_a # Attached already, and now the most recently used
+
+    adapters.attach("my-org/lora-c")
+
+    assert list(adapters.adapters.keys()) == ["my-org/lora-a", "my-org/lora-c"]
+    assert adapters.peft_model.loaded == [name_a, adapters.adapter_name("my-org/lora-c")]
+    assert adapters.peft_model.base == "base weights"
+
+    adapters.clear()
+    assert adapters.adapters == {} and adapters.peft_model is None
+
+def test_adapters_activate(adapters:AdapterManager):
+    with adapters.activate("my-org/base") as (model, adapter_name):
+        assert model == "base weights" and adapter_name is None # No adapter was attached
+
+    with adapters.activate("my-org/lora-b") as (model, adapter_name):
+        assert model is adapters.peft_model and adapter_name == adapters.adapter_name("my-org/lora-b")
+
+    with adapters.activate("my-org/base") as (model, adapter_name):
+        assert model is adapters.peft_model and adapter_name == BASE_ADAPTER
+    assert sum(adapters.in_use.values()) == 0
+
+def test_adapters_activate_concurrently(adapters:AdapterManager):
+    adapters.attach("my-org/lora-a")
+    active = list[str]()
+
+    def generate():
+        with adapters.activate("my-org/lora-b") as (_, adapter_name):
+            active.append(adapter_name)
+
+    with adapters.activate("my-org/lora-a") as (model, adapter_name):
+        thread = threading.Thread(target=generate)
+        thread.start()
+        # No adapter is switched on the shared model, so the other generation doesn't wait for this one
+        thread.join(timeout=5)
+        assert not thread.is_alive() and adapter_name == adapters.adapter_name("my-org/lora-a")
+    assert active == [adapters.adapter_name("my-org/lora-b")]
+
+def test_adapters_evict_only_unused(adapters:AdapterManager):
+    adapters.attach("my-org/lora-a")
+    adapters.attach("my-org/lora-b")
+
+    with adapters.activate("my-org/lora-a"):
+        adapters.attach("my-org/lora-c")
+
+    assert list(adapters.adapters.keys()) == ["my-org/lora-a", "my-org/lora-c"]
+
+def test_adapters_wrap_the_base_model_after_its_generations(adapters:AdapterManager):
+    attached = threading.Event()
+
+    def attach():
+        adapters.attach("my-org/lora-a")
+        attached.set()
+
+    with adapters.activate("my-org/base") as (model, _):
+        thread = threading.Thread(target=attach)
+        thread.start()
+        # The base model isn't wrapped under a running generation
+        assert not attached.wait(timeout=0.2) and adapters.peft_model is None
+    thread.join()
+    assert attached.is_set() and adapters.peft_model.base == "base weights"
+
+class FakeGenerationModel:
+    def __init__(self):
+        self.generation_kwargs = None
+
+    def generate(self, **kwargs):
+        self.generation_kwargs = kwargs
+        return "generated"
+
+class FakeAdapters:
+    def __init__(self, model, wait:float = 0):
+        self.model = model
+        self.wait = wait
+
+    @contextmanager
+    def activate(self, model_id):
+        time.sleep(self.wait)
+        yield self.model, "my-org--lora-a"
+
+def fake_generation(wait:float = 0) -> TransformerInference:
+    under_test = TransformerInference(FakeAdapterRegistry())
+    under_test.model_id = "my-org/base"
+    under_test.loader = types.SimpleNamespace(execution_context=lambda loaded: contextmanager(lambda: (yield))())
+    under_test.adapters = FakeAdapters(FakeGenerationModel(), wait)
+    return under_test
+
+def test_generate_selects_the_adapter_per_row():
+    import torch
+    under_test = fake_generation()
+
+    under_test._generate(Dialog(user_input=Message(role="user", content="Hi")), None, input_ids=torch.zeros((1, 3)), num_return_sequences=2)
+
+    assert under_test.adapters.model.generation_kwargs["adapter_names"] == ["my-org--lora-a"] * 2
+
+def test_generate_deadline_excludes_the_wait_for_the_adapter():
+    import torch
+    under_test = fake_generation(wait=0.3)
+    dialog = Dialog(user_input=Message(role="user", content="Hi"), deadline=time.time() + 1)
+
+    under_test._generate(dialog, None, input_ids=torch.zeros((1, 3)), max_time=1)
+    assert under_test.adapters.model.generation_kwargs["max_time"] <= 0.75
+
+    dialog.deadline = time.time() + 0.1
+    with pytest.raises(TimeoutError):
+        under_test._generate(dialog, None, input_ids=torch.zeros((1, 3)), max_time=1)
+
+def test_apply_deadline_bounds_the_generation_time():
+    under_test = fake_generation()
+    config_kwargs = {}
+
+    under_test._apply_deadline(Dialog(user_input=Message(role="user", content="Hi")), config_kwargs)
+    assert config_kwargs == {}
+
+    under_test._apply_deadline(Dialog(user_input=Message(role="user", content="Hi"), deadline=time.time() + 10), config_kwargs)
+    assert 9 < config_kwargs["max_time"] <= 10
+
+    # The shorter of the configured time and the time that remains
+    config_kwargs["max_time"] = 2
+    under_test._apply_deadline(Dialog(user_input=Message(role="user", content="Hi"), deadline=time.time() + 10), config_kwargs)
+    assert config_kwargs["max_time"] == 2
+
+    with pytest.raises(TimeoutError):
+        under_test._apply_deadline(Dialog(user_input=Message(role="user", content="Hi"), deadline=time.time() - 1), config_kwargs)
+
+def test_finish_reason():
+    under_test = fake_generation()
+    dialog = Dialog(user_input=Message(role="user", content="Hi"))
+    guard = types.SimpleNamespace(triggered={1})
+
+    assert under_test._finish_reason(guard, 0, 3, 10, dialog) == "stop"
+    assert under_test._finish_reason(guard, 0, 10, 10, dialog) == "length"
+    assert under_test._finish_reason(guard, 1, 3, 10, dialog) == "repetition"
+    assert under_test._finish_reason(None, 0, None, None, dialog) == "stop"
+
+    # Stopped by the deadline, with fewer tokens than the maximum
+    dialog.deadline = time.time() - 1
+    assert under_test._finish_reason(guard, 0, 3, 10, dialog) == "length"
+    dialog.deadline = time.time() + 60
+    assert under_test._finish_reason(guard, 0, 3, 10, dialog) == "stop"
@@ -4,6 +4,7 @@ from services.internal.registry import Models
 from services.internal.loader import (
     AutoModelForCausalLMLoader,
     SentenceTransformerLoader, 
+    CrossEncoderLoader,
     ImageTextToTextModelLoader,
     SUPPORTED, 
     )
@@ -55,6 +56,24 @@ def test_load_unload_SentenceTransformerLoader_ALL(registry, model_id):
     assert loaded.pre_processor_model  is None
 
 
+@pytest.mark.parametrize("model_id", [id for id, type in SUPPORTED.items() if type == CrossEncoderLoader])
+def test_load_unload_CrossEncoderLoader_ALL(registry, model_id):
+    under_test = CrossEncoderLoader(registry, max_length=256)
+
+    logger.info("Loading: %s", model_id)
+    info = registry.models[model_id]
+    loaded = under_test.load(info)
+
+    assert loaded.entry_point_model is not None
+    assert loaded.entry_point_model.max_length == 256
+    assert loaded.pre_processor_model == loaded.post_processor_model
+
+    under_test.unload(loaded)
+
+    assert loaded.entry_point_model is None
+    assert loaded.pre_processor_model is None
+
+
 @pytest.mark.parametrize("model_id", [id for id, type in SUPPORTED.items() if type == ImageTextToTextModelLoader])
 def test_load_unload_ImageTextToTextModelLoaderr_ALL(registry, model_id):
     under_test = ImageTextToTextModelLoader(registry)
@@ -72,3 +91,39 @@ def test_load_unload_ImageTextToTextModelLoaderr_ALL(registry, model_id):
     assert loaded.entry_point_model is None
     assert loaded.pre_processor_model is None
     assert loaded.pre_processor_model  is None
+
+
+def test_read_ahead_weights_reads_all_shards(tmp_path, monkeypatch):
+    from services.internal import loader
+    monkeypatch.setattr(loader, "SHARD_READ_CHUNK_SIZE", 1024)
+    monkeypatch.setattr(loader, "SHARD_READ_BUFFER_SIZE", 100)
+    (tmp_path / "model-00001-of-00002.safetensors").write_bytes(b"\0" * 3000)
+    (tmp_path / "model-00002-of-00002.safetensors").write_bytes(b"\0" * 1000)
+    (tmp_path / "config.json").write_text("{}")
+
+    assert loader.read_ahead_weights(tmp_path) == 4000
+    assert loader.read_ahead_weights(tmp_path / "config.json") == 0
+
+
+@pytest.mark.parametrize("backend", ["onnx", "onnx-int8"])
+def test_SentenceTransformerLoader_onnx_backend(registry, monkeypatch, backend):
+    pytest.importorskip("onnxruntime")
+    from services.internal import loader
+    model_id = "sentence-transformers/all-MiniLM-L6-v2"
+    under_test = SentenceTransformerLoader(registry)
+    sentences = ["The weather is lovely today.", "It's so sunny outside!"]
+
+    eager = under_test.load(registry.models[model_id])
+    expected = eager.entry_point_model.encode(sentences, normalize_embeddings=True)
+    under_test.unload(eager)
+
+    monkeypatch.setitem(loader.MODEL_EMBEDDINGS_BACKENDS, model_id, backend)
+    loaded = under_test.load(registry.models[model_id])
+    actual = loaded.entry_point_model.encode(sentences, normalize_embeddings=True)
+    under_test.unload(loaded)
+
+    location = registry.models[model_id].location
+    assert loader.onnx_artifacts(location)[backend].exists()
+    # Exported under .cache, so that the model's files (and so its fingerprint and footprint) are left as they were
+    assert loader.onnx_artifacts(location)[backend].relative_to(location).parts[0] == ".cache"
+    assert (expected * actual).sum(axis=1).min() > 0.95
@@ -0,0 +1,24 @@
+import multiprocessing
+from services.internal.metrics import RequestCounters
+
+def _handle_requests(counters:RequestCounters, worker:int, requests:int):
+    counters.attach(worker)
+    for _ in range(requests):
+        counters.started()
+        counters.finished()
+    counters.started()
+
+def test_request_counters_are_shared_between_forked_workers():
+    under_test = RequestCounters(workers=3)
+    context = multiprocessing.get_context("fork")
+    workers = [context.Process(target=_handle_requests, args=(under_test, worker, 5)) for worker in range(1, 3)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    snapshot = under_test.snapshot()
+
+    assert snapshot["total"] == 12
+    assert snapshot["in_flight"] == 2
+    assert [worker["pid"] for worker in snapshot["workers"][1:]] == [worker.pid for worker in workers]
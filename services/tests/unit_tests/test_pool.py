@@ -0,0 +1,196 @@
+import pytest
+import threading
+from services.internal.loader import AutoModelForCausalLMLoader
+from services.internal.inference import BaseInference
+from services.internal.placement import ModelTooLargeError
+from services.internal.pool import InferencePool, POOLS, preload, model_states
+
+class FakeRegistry:
+    def __init__(self):
+        self.models = dict()
+
+    def base_model_of(self, model_id):
+        return model_id
+
+class FakeLoader:
+    @staticmethod
+    def model_bytes(model):
+        return 10
+
+class FakeInference(BaseInference):
+    LOADERS = (AutoModelForCausalLMLoader,)
+
+    def __init__(self, registry):
+        super().__init__(registry)
+        self.loader = FakeLoader()
+        self.loaded = object()
+        self.loads = 0
+        self.hibernating = False
+
+    def hibernate(self):
+        self.hibernating = True
+        return True
+
+    def wake(self):
+        self.hibernating = False
+
+    def serve(self, model_id, **kwargs):
+        if not self.ready:
+            self.loads += 1
+        self.model_id = model_id
+        self.ready = True
+
+    def reset(self):
+        self.model_id = None
+        self.ready = False
+
+@pytest.fixture
+def placement(monkeypatch):
+    too_large = set()
+    def plan_model_placement(registry, model_id):
+        if model_id in too_large:
+            raise ModelTooLargeError(model_id)
+    monkeypatch.setattr("services.internal.pool.plan_model_placement", plan_model_placement)
+    return too_large
+
+@pytest.fixture
+def under_test(placement):
+    pool = InferencePool(FakeRegistry(), FakeInference, capacity=2)
+    yield pool
+    POOLS.remove(pool)
+
+def test_acquire_evicts_least_recently_used(under_test:InferencePool):
+    for model_id in ["meta-llama/Llama-3.2-1B-Instruct", "Qwen/Qwen3-4B", "meta-llama/Llama-3.2-1B-Instruct", "Qwen/Qwen2.5-Coder-3B-Instruct"]:
+        under_test.release(under_test.acquire(model_id))
+
+    assert list(under_test.inferences.keys()) == ["meta-llama/Llama-3.2-1B-Instruct", "Qwen/Qwen2.5-Coder-3B-Instruct"]
+    assert under_test.states["Qwen/Qwen3-4B"] == "unloaded"
+
+def test_acquire_does_not_evict_models_in_use(under_test:InferencePool):
+    in_use = [under_test.acquire(model_id) for model_id in ["meta-llama/Llama-3.2-1B-Instruct", "Qwen/Qwen3-4B", "Qwen/Qwen2.5-Coder-3B-Instruct"]]
+
+    assert len(under_test.inferences) == 3
+    assert all(inference.ready for inference in in_use)
+
+def test_acquire_not_supported(under_test:InferencePool):
+    with pytest.raises(NotImplementedError):
+        under_test.acquire("sentence-transformers/all-MiniLM-L6-v2")
+
+def test_preload_reports_readiness(under_test:InferencePool):
+    preload(["meta-llama/Llama-3.2-1B-Instruct", "TEST/TEST"])
+
+    assert model_states()["meta-llama/Llama-3.2-1B-Instruct"] == "ready"
+    assert "TEST/TEST" not in model_states()
+    assert not under_test.in_use
+
+def test_acquire_evicts_idle_models_until_it_fits(under_test:InferencePool, placement):
+    under_test.release(under_test.acquire("Qwen/Qwen3-4B"))
+    placement.add("Qwen/Qwen2.5-Coder-3B-Instruct")
+    under_test.evict = lambda model_id, **kwargs: placement.discard("Qwen/Qwen2.5-Coder-3B-Instruct") or InferencePool.evict(under_test, model_id, **kwargs)
+
+    under_test.release(under_test.acquire("Qwen/Qwen2.5-Coder-3B-Instruct"))
+
+    assert list(under_test.inferences.keys()) == ["Qwen/Qwen2.5-Coder-3B-Instruct"]
+
+def test_acquire_fails_fast_when_too_large(under_test:InferencePool, placement):
+    in_use = under_test.acquire("Qwen/Qwen3-4B")
+    placement.add("Qwen/Qwen2.5-Coder-3B-Instruct")
+
+    with pytest.raises(ModelTooLargeError):
+        under_test.acquire("Qwen/Qwen2.5-Coder-3B-Instruct")
+
+    assert list(under_test.inferences.keys()) == ["Qwen/Qwen3-4B"]
+    assert in_use.ready
+
+def test_evicted_models_hibernate_within_budget(placement):
+    under_test = InferencePool(FakeRegistry(), FakeInference, capacity=1, hibernation_budget=15)
+    try:
+        llama = under_test.acquire("meta-llama/Llama-3.2-1B-Instruct")
+        under_test.release(llama)
+        under_test.release(under_test.acquire("Qwen/Qwen3-4B"))
+
+        assert under_test.states["meta-llama/Llama-3.2-1B-Instruct"] == "hibernated"
+        assert llama.hibernating and llama.ready
+
+        assert under_test.acquire("meta-llama/Llama-3.2-1B-Instruct") is llama
+        assert not llama.hibernating and llama.loads == 1
+        # Only one model fits the budget
+        assert under_test.states["Qwen/Qwen3-4B"] == "hibernated"
+        under_test.release(llama)
+        under_test.release(under_test.acquire("Qwen/Qwen2.5-Coder-3B-Instruct"))
+        assert list(under_test.hibernated.keys()) == ["meta-llama/Llama-3.2-1B-Instruct"]
+        assert under_test.states["Qwen/Qwen3-4B"] == "unloaded"
+    finally:
+        POOLS.remove(under_test)
+
+def test_prefetch_counts_hits_and_wasted_loads(under_test:InferencePool):
+    assert under_test.prefetch("Qwen/Qwen3-4B")
+    under_test.release(under_test.acquire("Qwen/Qwen3-4B"))
+    assert under_test.prefetch("meta-llama/Llama-3.2-1B-Instruct")
+    under_test.evict("meta-llama/Llama-3.2-1B-Instruct")
+
+    assert under_test.prefetch_stats == {"loads": 2, "hits": 1, "wasted": 1}
+    assert not under_test.prefetched
+
+def test_prefetch_does_not_evict_models_in_use(under_test:InferencePool):
+    in_use = [under_test.acquire(model_id) for model_id in ["meta-llama/Llama-3.2-1B-Instruct", "Qwen/Qwen3-4B"]]
+
+    assert not under_test.prefetch("Qwen/Qwen2.5-Coder-3B-Instruct")
+    assert all(inference.ready for inference in in_use)
+
+def test_prefetch_leaves_room_for_models_being_loaded(under_test:InferencePool):
+    under_test.acquire("meta-llama/Llama-3.2-1B-Instruct")
+    under_test.loading["Qwen/Qwen3-4B"] = threading.Event() # Reserved by a concurrent acquire
+
+    assert not under_test.prefetch("Qwen/Qwen2.5-Coder-3B-Instruct")
+    assert "Qwen/Qwen2.5-Coder-3B-Instruct" not in under_test.inferences
+
+def test_prefetch_needs_a_spare_slot(placement):
+    under_test = InferencePool(FakeRegistry(), FakeInference, capacity=1)
+    try:
+        under_test.acquire("meta-llama/Llama-3.2-1B-Instruct")
+        assert not under_test.prefetch("Qwen/Qwen3-4B")
+    finally:
+        POOLS.remove(under_test)
+
+def test_invalidate_unloads_models_in_use_once_released(under_test:InferencePool):
+    idle = under_test.acquire("Qwen/Qwen3-4B")
+    under_test.release(idle)
+    in_use = under_test.acquire("meta-llama/Llama-3.2-1B-Instruct")
+
+    assert under_test.invalidate("Qwen/Qwen3-4B")
+    assert under_test.invalidate("meta-llama/Llama-3.2-1B-Instruct")
+
+    assert not idle.ready
+    assert in_use.ready
+    under_test.release(in_use)
+    assert not in_use.ready
+    assert not under_test.inferences
+
+def test_acquire_does_not_hold_the_pool_while_loading(under_test:InferencePool):
+    loading, proceed = threading.Event(), threading.Event()
+    serve = FakeInference.serve
+    def slow_serve(self, model_id, **kwargs):
+        if model_id == "Qwen/Qwen3-4B" and not self.ready:
+            loading.set()
+            proceed.wait()
+        serve(self, model_id, **kwargs)
+    FakeInference.serve = slow_serve
+    try:
+        acquired = list[BaseInference]()
+        threads = [threading.Thread(target=lambda: acquired.append(under_test.acquire("Qwen/Qwen3-4B"))) for _ in range(2)]
+        threads[0].start()
+        assert loading.wait(timeout=1)
+        threads[1].start()
+
+        # Another model is served meanwhile, while the second request waits for the model that is loading
+        under_test.release(under_test.acquire("meta-llama/Llama-3.2-1B-Instruct"))
+        assert under_test.states["Qwen/Qwen3-4B"] == "loading" and not acquired
+
+        proceed.set()
+        for thread in threads:
+            thread.join(timeout=1)
+        assert len(acquired) == 2 and acquired[0] is acquired[1] and acquired[0].loads == 1
+        assert under_test.in_use["Qwen/Qwen3-4B"] == 2
+    finally:
+        FakeInference.serve = serve
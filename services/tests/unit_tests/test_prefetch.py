@@ -0,0 +1,24 @@
+from services.internal.prefetch import Prefetcher
+
+RESEARCH_LOOP = ["Qwen/Qwen2.5-Coder-3B-Instruct", "meta-llama/Llama-3.2-1B-Instruct", "Qwen/Qwen3-4B", "deepseek-ai/DeepSeek-R1-Distill-Llama-8B"]
+
+def test_predicts_the_most_frequent_next_model(tmp_path):
+    under_test = Prefetcher(tmp_path / "prefetch.json", min_probability=0.5, min_observations=2)
+    for _ in range(2):
+        for model_id in RESEARCH_LOOP:
+            under_test.observe(model_id, "loop")
+            # Requests of another sequence don't count as transitions of this one
+            under_test.observe("sentence-transformers/all-MiniLM-L6-v2", "other")
+
+    assert under_test.predict(RESEARCH_LOOP[0]) == RESEARCH_LOOP[1]
+    assert under_test.predict(RESEARCH_LOOP[2]) == RESEARCH_LOOP[3]
+    # Observed only once
+    assert under_test.predict(RESEARCH_LOOP[3]) is None
+
+def test_transitions_are_persisted(tmp_path):
+    under_test = Prefetcher(tmp_path / "prefetch.json", min_observations=1)
+    for model_id in RESEARCH_LOOP:
+        under_test.observe(model_id)
+    under_test.save()
+
+    assert Prefetcher(tmp_path / "prefetch.json", min_observations=1).predict(RESEARCH_LOOP[1]) == RESEARCH_LOOP[2]
@@ -1,4 +1,5 @@
 import os
+import json
 from pathlib import Path
 from services.internal.registry import Models, UNSUPPORTED_MODELS
 from services.internal.loader import SUPPORTED
@@ -32,3 +33,98 @@ def test_import_models_stress():
     for model_id, _ in SUPPORTED.items():
         model_info = under_test.import_model(model_id, token=os.getenv("HF_TOKEN"))
         assert model_info.model_id == model_id
+
+
+def test_adapter_declares_base_model(tmp_path):
+    adapter_dir = tmp_path / "hub" / "my-org" / "Llama-3.2-1B-Instruct-pirate"
+    adapter_dir.mkdir(parents=True)
+    (adapter_dir / "adapter_config.json").write_text('{"base_model_name_or_path": "meta-llama/Llama-3.2-1B-Instruct", "peft_type": "LORA"}')
+
+    under_test = Models(str(tmp_path))
+
+    model_info = under_test.models["my-org/Llama-3.2-1B-Instruct-pirate"]
+    assert model_info.adapter_of == "meta-llama/Llama-3.2-1B-Instruct"
+    assert under_test.base_model_of("my-org/Llama-3.2-1B-Instruct-pirate") == "meta-llama/Llama-3.2-1B-Instruct"
+    assert under_test.base_model_of("meta-llama/Llama-3.2-1B-Instruct") == "meta-llama/Llama-3.2-1B-Instruct"
+
+
+def test_revision_from_download_metadata(tmp_path):
+    model_dir = tmp_path / "hub" / "my-org" / "my-model"
+    (model_dir / ".cache" / "huggingface" / "download").mkdir(parents=True)
+    (model_dir / "config.json").write_text("{}")
+    (model_dir / ".cache" / "huggingface" / "download" / "config.json.metadata").write_text("0123abcd\netag\n1700000000\n")
+    local_dir = tmp_path / "hub" / "my-org" / "my-local-model"
+    local_dir.mkdir()
+    (local_dir / "config.json").write_text("{}")
+
+    under_test = Models(str(tmp_path))
+
+    assert under_test.models["my-org/my-model"].revision == "0123abcd"
+    assert under_test.models["my-org/my-local-model"].revision.startswith("local-")
+
+
+def test_index_inspects_only_changed_directories(tmp_path):
+    for name in ["model-a", "model-b"]:
+        (tmp_path / "hub" / "my-org" / name).mkdir(parents=True)
+        (tmp_path / "hub" / "my-org" / name / "config.json").write_text("{}")
+    (tmp_path / "hub" / "my-org" / "not-a-model").mkdir()
+    (tmp_path / "hub" / "my-org" / "not-a-model" / "README.md").write_text("")
+
+    first = Models(str(tmp_path))
+    assert first.inspected == 3
+    assert set(first.models.keys()) == {"my-org/model-a", "my-org/model-b"}
+
+    (tmp_path / "hub" / "my-org" / "model-c").mkdir()
+    (tmp_path / "hub" / "my-org" / "model-c" / "config.json").write_text("{}")
+    second = Models(str(tmp_path))
+
+    assert second.inspected == 1
+    assert set(second.models.keys()) == {"my-org/model-a", "my-org/model-b", "my-org/model-c"}
+    assert second.models["my-org/model-a"] == first.models["my-org/model-a"]
+    assert Models(str(tmp_path)).inspected == 0
+
+
+def test_footprint_is_computed_at_scan_time(tmp_path):
+    model_dir = tmp_path / "hub" / "my-org" / "my-model"
+    model_dir.mkdir(parents=True)
+    (model_dir / "config.json").write_text(json.dumps({
+        "num_hidden_layers": 2,
+        "num_attention_heads": 4,
+        "hidden_size": 8,
+        "max_position_embeddings": 1024,
+        "torch_dtype": "float16",
+    }))
+
+    Models(str(tmp_path))
+    under_test = Models(str(tmp_path))
+
+    assert under_test.inspected == 0
+    footprint = under_test.models["my-org/my-model"].footprint
+    assert footprint.context_length == 1024
+    assert footprint.num_layers == 2
+    assert footprint.kv_bytes_per_token == 2 * 2 * 4 * 2 * 2
+    assert footprint.disk_bytes == (model_dir / "config.json").stat().st_size
+
+
+def test_version_and_change_feed(tmp_path):
+    (tmp_path / "hub" / "my-org" / "model-a").mkdir(parents=True)
+    (tmp_path / "hub" / "my-org" / "model-a" / "config.json").write_text("{}")
+    under_test = Models(str(tmp_path), use_index=False)
+    version = under_test.version
+    assert under_test.providers == {"my-org": ["model-a"]}
+    assert under_test.changes_since(version).changes == []
+
+    assert not under_test.refresh()
+    assert under_test.version == version
+
+    (tmp_path / "hub" / "my-org" / "model-b").mkdir()
+    (tmp_path / "hub" / "my-org" / "model-b" / "config.json").write_text("{}")
+    under_test.refresh()
+    assert under_test.version == version + 1
+    assert under_test.providers == {"my-org": ["model-a", "model-b"]}
+
+    feed = under_test.changes_since(version)
+    assert not feed.reset
+    assert [(change.model_id, change.change) for change in feed.changes] == [("my-org/model-b", "added")]
+    assert under_test.changes_since(version, epoch="another").reset
+    assert under_test.changes_since(version + 2).reset
@@ -0,0 +1,22 @@
+import numpy as np
+from services.internal.rerank import dynamic_batches, top_n
+
+def test_dynamic_batches_fit_the_token_budget():
+    lengths = [10, 300, 12, 40, 11, 600, 38, 9]
+
+    batches = list(dynamic_batches(lengths, max_tokens=100, max_batch_size=4))
+
+    assert sorted(i for batch in batches for i in batch) == list(range(len(lengths)))
+    # Sorted by length, the short pairs are batched together and the long ones are on their own
+    assert batches[0] == [7, 0, 4, 2]
+    assert batches[-2:] == [[1], [5]]
+    for batch in batches:
+        assert len(batch) == 1 or len(batch) * max(lengths[i] for i in batch) <= 100
+
+def test_top_n_in_decreasing_order():
+    scores = np.array([0.1, 0.9, -2.0, 0.5, 0.8], dtype=np.float32)
+
+    assert top_n(scores, 2) == [1, 4]
+    assert top_n(scores) == [1, 4, 3, 0, 2]
+    assert top_n(scores, 10) == [1, 4, 3, 0, 2]
+    assert top_n(scores, 0) == []
@@ -0,0 +1,93 @@
+import torch
+from services.internal.stopping import RunawayGenerationConfig, RunawayGenerationCriteria
+
+def test_repeated_phrase_is_aborted():
+    under_test = RunawayGenerationCriteria(prompt_length=3, config=RunawayGenerationConfig(min_repeats=4, min_repeated_tokens=16))
+    phrase = [11, 12, 13, 14, 15]
+    input_ids = torch.tensor([[1, 2, 3] + [7, 8] + phrase * 4])
+
+    is_done = under_test(input_ids, None)
+
+    assert is_done.tolist() == [True]
+    assert under_test.triggered == {0}
+
+def test_short_repetition_is_not_aborted():
+    under_test = RunawayGenerationCriteria(prompt_length=3, config=RunawayGenerationConfig(min_repeats=4, min_repeated_tokens=16))
+    input_ids = torch.tensor([[1, 2, 3] + [9] * 8 + [10, 11, 12]])
+
+    is_done = under_test(input_ids, None)
+
+    assert is_done.tolist() == [False]
+    assert not under_test.triggered
+
+def test_only_looping_sequence_is_aborted():
+    under_test = RunawayGenerationCriteria(prompt_length=1, config=RunawayGenerationConfig(min_repeats=3, min_repeated_tokens=6))
+    input_ids = torch.tensor([
+        [1] + [5, 6] * 3,
+        [1, 2, 3, 4, 5, 6, 7],
+    ])
+
+    is_done = under_test(input_ids, None)
+
+    assert is_done.tolist() == [True, False]
+    assert under_test.generated_tokens == 6
+
+def test_stalled_entropy_is_aborted():
+    under_test = RunawayGenerationCriteria(prompt_length=1, config=RunawayGenerationConfig(entropy_threshold=0.1, entropy_patience=2))
+    confident = torch.tensor([[100.0, 0.0, 0.0]])
+    input_ids = torch.tensor([[1, 2, 3]])
+
+    under_test.entropy_monitor.observe(confident)
+    assert under_test(input_ids, None).tolist() == [False]
+    under_test.entropy_monitor.observe(confident)
+    assert under_test(input_ids, None).tolist() == [True]
+
+def test_entropy_is_observed_on_raw_logits():
+    class Model(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.lm_head = torch.nn.Linear(2, 3, bias=False)
+
+        def get_output_embeddings(self):
+            return self.lm_head
+
+    model = Model()
+    under_test = RunawayGenerationCriteria(prompt_length=1, config=RunawayGenerationConfig(entropy_threshold=0.1, entropy_patience=1))
+    with torch.no_grad():
+        model.lm_head.weight.copy_(torch.tensor([[100.0, 0.0], [0.0, 0.0], [0.0, 0.0]]))
+        with under_test.watching(model):
+            # The logits of the last position of each sequence, a confident one and a uniform one
+            model.lm_head(torch.tensor([[[0.0, 0.0], [1.0, 0.0]], [[1.0, 0.0], [0.0, 0.0]]]))
+        model.lm_head(torch.tensor([[[1.0, 0.0]], [[1.0, 0.0]]])) # Not observed anymore
+
+    assert under_test.entropy_monitor.stalled_steps.tolist() == [1, 0]
+    assert under_test(torch.tensor([[1, 2], [1, 3]]), None).tolist() == [True, False]
+
+def test_long_period_loop_in_a_long_generation_is_aborted():
+    config = RunawayGenerationConfig(max_period=64, min_repeats=4, min_repeated_tokens=64)
+    under_test = RunawayGenerationCriteria(prompt_length=2, config=config)
+    phrase = list(range(100, 130))
+    input_ids = torch.tensor([
+        [1, 2] + list(range(500, 800)) + phrase * 4,
+        [1, 2] + list(range(500, 800)) + phrase * 3 + list(range(900, 930)),
+    ])
+
+    assert under_test(input_ids, None).tolist() == [True, False]
+    assert under_test.triggered == {0}
+
+def test_finished_sequence_is_not_aborted():
+    eos, pad = 2, 0
+    under_test = RunawayGenerationCriteria(prompt_length=1, config=RunawayGenerationConfig(min_repeats=3, min_repeated_tokens=6), eos_token_ids=[eos, pad])
+    input_ids = torch.tensor([
+        # Ended early, and padded while the other sequence is generating
+        [1, 7, 8, eos] + [pad] * 8,
+        [1, 3, 4, 5, 6, 9, 10, 11, 12, 13, 14, 15],
+    ])
+
+    assert under_test(input_ids, None).tolist() == [False, False]
+    assert not under_test.triggered
+
+    # The padding is the EOS token when the model has no pad token
+    under_test = RunawayGenerationCriteria(prompt_length=1, config=RunawayGenerationConfig(min_repeats=3, min_repeated_tokens=6), eos_token_ids=[eos])
+    assert under_test(torch.tensor([[1, 7, 8] + [eos] * 9, [1] + [5, 6] * 4 + [5, 6, 5]]), None).tolist() == [False, True]
+    assert under_test.triggered == {1}
@@ -0,0 +1,74 @@
+import pytest
+import numpy as np
+import services.internal.vectors as vectors_module
+from services.internal.vectors import VectorCollection, VectorCollections, CollectionInfo
+
+@pytest.mark.parametrize("metric", ["cosine", "dot", "euclidean"])
+def test_query_matches_exhaustive_search(tmp_path, metric):
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(3000, 8)).astype(np.float32)
+    queries = rng.normal(size=(5, 8)).astype(np.float32)
+    under_test = VectorCollection(tmp_path, CollectionInfo(name="test", model="my-org/model", dimensions=8, metric=metric))
+    under_test.upsert([str(i) for i in range(len(vectors))], vectors)
+
+    # Across several blocks, so that the per block top-k are merged
+    matches = under_test.query(queries, k=5, block_rows=700)
+
+    if metric == "dot":
+        scores = queries @ vectors.T
+    elif metric == "cosine":
+        scores = (queries / np.linalg.norm(queries, axis=1, keepdims=True)) @ (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).T
+    else:
+        scores = -np.linalg.norm(queries[:, None, :] - vectors[None, :, :], axis=2)
+    expected = np.argsort(-scores, axis=1)[:, :5]
+    assert [[int(match.id) for match in query_matches] for query_matches in matches] == expected.tolist()
+    assert np.allclose([[match.score for match in query_matches] for query_matches in matches], np.take_along_axis(scores, expected, axis=1), atol=1e-4)
+
+def test_upsert_delete_and_reload(tmp_path):
+    collections = VectorCollections(tmp_path)
+    under_test = collections.create(CollectionInfo(name="test", model="my-org/model", dimensions=2, metric="dot"))
+    under_test.upsert(["a", "b", "c"], np.array([[1, 0], [0, 1], [1, 1]]), [{"n": 1}, None, None])
+    under_test.upsert(["b"], np.array([[2, 2]]))
+    assert under_test.delete(["a", "missing"]) == 1
+
+    reloaded = VectorCollections(tmp_path).collections["test"]
+
+    assert reloaded.info.count == 2
+    assert [match.id for match in reloaded.query(np.array([[1, 1]]), k=10)[0]] == ["b", "c"]
+    assert reloaded.query(np.array([[1, 1]]), k=1)[0][0].score == 4
+    with pytest.raises(FileExistsError):
+        collections.create(CollectionInfo(name="test", model="my-org/model", dimensions=3))
+
+def test_collections_shared_by_workers(tmp_path):
+    # Two worker processes, each with its own view of the same directory
+    worker_a, worker_b = VectorCollections(tmp_path), VectorCollections(tmp_path)
+    collection_a = worker_a.create(CollectionInfo(name="test", model="my-org/model", dimensions=2, metric="dot"))
+    collection_a.upsert(["a", "b"], np.array([[1, 0], [0, 1]]), [{"n": 1}, None])
+
+    collection_b = worker_b.get("test")
+    collection_b.upsert(["c", "a"], np.array([[1, 1], [3, 0]]))
+    assert collection_b.delete(["b"]) == 1
+
+    matches = collection_a.query(np.array([[1, 0]]), k=10)[0]
+    assert [(match.id, match.score) for match in matches] == [("a", 3), ("c", 1)]
+    assert collection_a.info.count == 2 and matches[0].metadata is None
+    assert list(worker_b.load()) == ["test"]
+
+    assert worker_a.delete("test")
+    with pytest.raises(KeyError):
+        worker_b.get("test")
+    assert worker_b.load() == {}
+
+def test_upsert_appends_to_the_log_and_compacts_it(tmp_path, monkeypatch):
+    monkeypatch.setattr(vectors_module, "COMPACT_LOG_LINES", 4)
+    under_test = VectorCollection(tmp_path, CollectionInfo(name="test", model="my-org/model", dimensions=2, metric="dot"))
+    other = VectorCollection(tmp_path, under_test.info.model_copy())
+    under_test.upsert(["a", "b"], np.array([[1, 0], [0, 1]]))
+    assert other.query(np.array([[1, 1]]), k=10)[0][0].score == 1
+
+    for i in range(4):
+        under_test.upsert(["a"], np.array([[i + 2, 0]]))
+
+    # Rewritten with a line per row, and replayed from the start by the other process
+    assert len((tmp_path / vectors_module.LOG_FILE).read_text().splitlines()) == 2
+    assert [(match.id, match.score) for match in other.query(np.array([[1, 1]]), k=10)[0]] == [("a", 5), ("b", 1)]
@@ -0,0 +1,63 @@
+import time
+from services.internal.registry import Models
+from services.internal.watcher import RegistryWatcher
+
+def add_model(root, model_id:str):
+    model_dir = root / "hub" / model_id
+    model_dir.mkdir(parents=True)
+    (model_dir / "config.json").write_text("{}")
+    return model_dir
+
+def test_apply_reports_added_changed_and_removed_models(tmp_path):
+    add_model(tmp_path, "my-org/model-a")
+    model_b = add_model(tmp_path, "my-org/model-b")
+    registry = Models(str(tmp_path))
+    notified = []
+    under_test = RegistryWatcher(registry, on_change=notified.append, use_inotify=False)
+
+    add_model(tmp_path, "my-org/model-c")
+    (model_b / "config.json").unlink()
+    model_b.rmdir()
+    # Modified in place, which doesn't change the directory's fingerprint
+    (tmp_path / "hub" / "my-org" / "model-a" / "config.json").write_text('{"num_hidden_layers": 2}')
+    changes = under_test.apply({under_test.model_id_of(tmp_path / "hub" / "my-org" / "model-a" / "config.json")})
+
+    assert changes.added == {"my-org/model-c"}
+    assert changes.changed == {"my-org/model-a"}
+    assert changes.removed == {"my-org/model-b"}
+    assert set(registry.models.keys()) == {"my-org/model-a", "my-org/model-c"}
+    assert notified == [changes]
+    assert not under_test.apply()
+    assert len(notified) == 1
+
+def test_model_id_of_ignores_caches(tmp_path):
+    add_model(tmp_path, "my-org/model-a")
+    under_test = RegistryWatcher(Models(str(tmp_path)), use_inotify=False)
+    hub = tmp_path / "hub"
+
+    assert under_test.model_id_of(hub / "my-org" / "model-a" / "model.safetensors") == "my-org/model-a"
+    assert under_test.model_id_of(hub / "my-org" / "model-a" / ".cache" / "huggingface" / "download" / "x.metadata") is None
+    assert under_test.model_id_of(hub / ".locks" / "my-org") is None
+    assert under_test.model_id_of(hub / "my-org") is None
+    assert under_test.model_id_of(hub / "my-org" / "model-a" / "tokenizer.json.1234.blob") is None
+    assert under_test.model_id_of(tmp_path / "elsewhere" / "file") is None
+
+def test_follow_the_index_of_another_worker(tmp_path):
+    add_model(tmp_path, "my-org/model-a")
+    watching, following = Models(str(tmp_path)), Models(str(tmp_path))
+    notified = []
+    under_test = RegistryWatcher(following, on_change=notified.append, debounce=0.05, follow=True)
+    under_test.start()
+    try:
+        add_model(tmp_path, "my-org/model-b")
+        (tmp_path / "hub" / "my-org" / "model-a" / "config.json").write_text('{"num_hidden_layers": 2}')
+        RegistryWatcher(watching, use_inotify=False).apply({"my-org/model-a"})
+
+        deadline = time.monotonic() + 5
+        while not notified and time.monotonic() < deadline:
+            time.sleep(0.05)
+    finally:
+        under_test.stop()
+
+    assert notified[0].added == {"my-org/model-b"} and notified[0].changed == {"my-org/model-a"}
+    assert following.models == watching.models